@@ -7,6 +7,7 @@ pyinstaller main.spec
 # Create settings, and log directories
 New-Item -Path "./dist" -Name "settings" -ItemType "directory"
 New-Item -Path "./dist" -Name "log" -ItemType "directory"
+New-Item -Path "./dist" -Name "cache" -ItemType "directory"
 
 # Copy stuff over
 Copy-Item -Path "./settings/tickers.xlsx" -Destination "./dist/settings/"
@@ -18,8 +19,10 @@ $default = @'
     "TWS_port" : 7497,
     "TWS_id" : 0,
     "TWS_account" : "",
+    "TWS_accounts" : [],
     "timezone" : "US/Eastern",
     "max_portfolio_size" : 13, 
+    "max_position_percent" : 25,
     "round_quantities_to" : 25,
     "primary_sell_type" : "MIDPRICE",
     "auxiliary_sell_type" : "MKT",
@@ -28,7 +31,37 @@ $default = @'
     "sell_wait_duration" : "",
     "sell_wait_until" : "16:00",
     "buy_wait_duration" : "",
-    "buy_wait_until" : ""
+    "buy_wait_until" : "",
+    "pipelined_execution" : false,
+    "buying_power_buffer" : 2,
+    "reprice_steps" : 4,
+    "reprice_interval" : 60,
+    "metrics_json" : true,
+    "metrics_prometheus_path" : "",
+    "history_concurrency" : 8,
+    "history_timeout" : 60,
+    "history_retries" : 2,
+    "history_shards" : 1,
+    "history_shard_size" : 50,
+    "history_shard_retries" : 2,
+    "price_preference" : ["last", "mid", "close"],
+    "price_timeout" : 10,
+    "daemon_schedule" : "35 15 * * 1-5",
+    "daemon_port" : 7901,
+    "reconnect_interval" : 5,
+    "run_journal" : true,
+    "journal_max_age_minutes" : 120,
+    "pacing_messages_per_second" : 45,
+    "pacing_history_requests" : 60,
+    "pacing_history_seconds" : 600,
+    "pacing_backoff" : 10,
+    "bar_cache" : true,
+    "bar_cache_refresh_days" : 7,
+    "contract_cache_ttl_days" : 7,
+    "sharpe_windows" : [52, 26, 13],
+    "incremental_sharpe" : true,
+    "sharpe_floor" : 0.2,
+    "sharpe_exponent" : 1.5
 }
 '@
 New-Item -Path "./dist/settings" -Name "settings.json" -Value $default
@@ -1,32 +1,460 @@
-from typing import Set, Dict, List
-from datetime import datetime, timedelta
+from __future__ import annotations
+
+from typing import Set, Dict, List, Tuple, TYPE_CHECKING
+from datetime import date, datetime, timedelta
+from collections import deque, namedtuple
+import contextlib
+import contextvars
+import itertools
+import asyncio
+import heapq
 import logging
+import sqlite3
 import math
 import json
 import time
+import os
 import pytz
 
 from ib_insync import *
-import pandas as pd
+import numpy as np
+
+# Only sharded runs need multiprocessing, it is imported when they start
+if TYPE_CHECKING:
+    import multiprocessing
 
 
 SETTINGS_PATH = 'settings\\settings.json'
 TICKERS_PATH = 'settings\\tickers.xlsx'
 LOG_DIR = 'log\\'
+CACHE_PATH = 'cache\\cache.db'
+
+# Priorities of requests going through the request scheduler, lower
+# goes first
+PRIORITY_ORDER = 0
+PRIORITY_QUOTES = 1
+PRIORITY_DATA = 2
+
+# Request class of TWS pacing violation error codes, None for the
+# message rate
+PACING_ERRORS = {100: None, 162: 'history', 420: 'market data'}
+
+# Analysis stages checkpointed in the run journal, mapped to the
+# portfolio columns they produce (None for global historical_data). The
+# account stage is not, positions move while orders fill
+JOURNAL_STAGES = {
+    'history': None,
+    'sharpe': ['Sharpe (unadjusted)', 'Sharpe (adjusted)'],
+    'prices': ['Price'],
+    'target': ['Sharpe (adjusted)', 'Target (cnt)', 'Target ($)',
+               'Target (%)'],
+}
+
+# Result of allocate, arrays are in order of descending sharpe ratio
+Allocation = namedtuple('Allocation',
+                        ['tickers', 'weights', 'shares', 'values', 'counts'])
+
+
+class LazyModule:
+    """
+    Stand-in for a module that is only imported when one of its
+    attributes is first used, so starting up and connecting to TWS does
+    not wait for it.
+
+    load -- function importing and returning the module
+    """
+
+    def __init__(self, load):
+        self.load = load
+        self.module = None
+
+    def __getattr__(self, name: str):
+        if self.module is None:
+            self.module = self.load()
+
+        return getattr(self.module, name)
+
+
+def import_pandas():
+    """ Internal helper function. Import pandas for LazyModule """
+
+    import pandas
+    return pandas
+
+
+# pandas takes longer to import than everything needed to connect, it is
+# not loaded until the analysis uses it
+pd = LazyModule(import_pandas)
+
+
+class TokenBucket:
+    """
+    Token bucket rate limiter for requests to TWS. Tokens refill at rate
+    per second up to capacity. Waiting requests are served in order of
+    priority, then arrival.
+
+    rate -- tokens added per second
+    capacity -- maximum number of tokens, also the largest burst
+    """
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.resume_at = 0.0
+        self.waiting = list()
+        self.sequence = itertools.count()
+        self.timer = None
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity,
+                          self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def take(self, cost: float = 1):
+        """ Take tokens without waiting, going into debt if needed """
+
+        self.refill()
+        self.tokens -= cost
+
+    def pause(self, seconds: float):
+        """ Hand out no tokens for the next seconds """
+
+        self.resume_at = max(self.resume_at, time.monotonic() + seconds)
+
+    async def acquire(self, cost: float = 1,
+                      priority: int = PRIORITY_DATA):
+        """
+        Wait until cost tokens are available and take them. Costs larger
+        than capacity wait for a full bucket and go into debt.
+
+        cost -- number of tokens
+        priority -- lower priorities are served first
+        """
+
+        future = asyncio.get_event_loop().create_future()
+        heapq.heappush(self.waiting,
+                       (priority, next(self.sequence), cost, future))
+        self.dispatch()
+
+        await future
+
+    def dispatch(self):
+        """
+        Internal helper function.
+
+        Hand out tokens to waiting requests, then schedule the next
+        dispatch for when the first waiting request can be served.
+        """
+
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+
+        self.refill()
+        now = time.monotonic()
+
+        while self.waiting:
+            priority, _, cost, future = self.waiting[0]
+
+            if future.done():
+                heapq.heappop(self.waiting)
+                continue
+
+            if now < self.resume_at:
+                wait = self.resume_at - now
+                break
+
+            needed = min(cost, self.capacity)
+            if self.tokens < needed:
+                wait = (needed - self.tokens) / self.rate
+                break
+
+            heapq.heappop(self.waiting)
+            self.tokens -= cost
+            future.set_result(None)
+        else:
+            return
+
+        self.timer = asyncio.get_event_loop().call_later(wait, self.dispatch)
+
+
+class RequestScheduler:
+    """
+    Paces all requests to TWS. Every request takes tokens from a shared
+    message bucket (TWS allows 50 messages per second) and historical
+    data requests also from a history bucket (60 requests per 10
+    minutes). Order placement and cancellation take message tokens
+    without ever waiting, so data requests queue behind them. Identical
+    requests in flight at the same time are made once. Pacing violations
+    reported by TWS pause the offending bucket, with the pause doubling
+    on each violation until a request succeeds.
+
+    messages_per_second -- message bucket rate and burst
+    history_requests -- historical data requests per history_seconds
+    history_seconds -- window of the historical data limit
+    backoff -- first pause after a pacing violation (seconds)
+    """
+
+    def __init__(self, messages_per_second: float = 45,
+                 history_requests: int = 60, history_seconds: float = 600,
+                 backoff: float = 10):
+        self.messages = TokenBucket(messages_per_second, messages_per_second)
+        self.buckets = {'history': TokenBucket(
+            history_requests / history_seconds, history_requests)}
+        self.backoff = backoff
+        self.backoffs = dict()
+        self.in_flight = dict()
+
+    async def request(self, kind: str, factory, key: tuple = None,
+                      cost: float = 1, priority: int = PRIORITY_DATA,
+                      timeout: float = None):
+        """
+        Make a request once the pacing limits allow it. Return its
+        result.
+
+        kind -- request class, eg. 'history' or 'market data'
+        factory -- function returning the request coroutine
+        key -- identical requests share a key and are made once, None to
+               never share
+        cost -- number of messages the request sends
+        priority -- lower priorities are served first
+        timeout -- seconds the request itself (not the wait for pacing)
+                   may take
+        """
+
+        if key is None:
+            return await self.paced(kind, factory, cost, priority, timeout)
+
+        if key not in self.in_flight:
+            future = asyncio.ensure_future(
+                self.paced(kind, factory, cost, priority, timeout))
+            self.in_flight[key] = future
+            future.add_done_callback(
+                lambda _: self.in_flight.pop(key, None))
+
+        # Shielded so one caller giving up does not cancel the request
+        # for the others
+        return await asyncio.shield(self.in_flight[key])
+
+    async def paced(self, kind: str, factory, cost: float, priority: int,
+                    timeout: float):
+        """
+        Internal helper function.
+
+        Wait for the buckets of a request, then make it.
+        """
+
+        start = time.monotonic()
+
+        if kind in self.buckets:
+            await self.buckets[kind].acquire(1, priority)
+        await self.messages.acquire(cost, priority)
+
+        waited = time.monotonic() - start
+        if waited > 0.01:
+            count('pacing_waits')
+            count('pacing_wait_seconds', waited)
+
+        result = await asyncio.wait_for(factory(), timeout)
+
+        if result:
+            self.backoffs.pop(kind, None)
+
+        return result
+
+    def order(self, cost: float = 1):
+        """ Take message tokens for an order request without waiting """
+
+        self.messages.take(cost)
+
+    def pacing_violation(self, kind: str = None):
+        """
+        Pause requests after TWS reported a pacing violation.
+
+        kind -- request class that violated pacing, None for the message
+                rate
+        """
+
+        bucket = self.buckets.get(kind, self.messages)
+        backoff = self.backoffs.get(kind, self.backoff)
+
+        logging.warning(f'Pacing violation ({kind or "messages"}), '
+                        f'pausing requests for {backoff} seconds')
+
+        bucket.pause(backoff)
+        self.backoffs[kind] = min(backoff * 2, 600)
+
+
+class Portfolio:
+    """
+    Working state of one portfolio: a row per ticker with the float
+    columns in COLUMNS, held as one numpy array, and the account it
+    belongs to with its value and available funds. Missing values are
+    NaN. Columns are read and written for many tickers at once, never
+    cell by cell.
+
+    portfolio['Target (%)'] gives a column as a Series indexed by ticker
+    and to_frame() the whole table as a DataFrame, for logging and
+    exports.
+
+    tickers -- ticker symbols of the first rows
+    account -- account id, None for the TWS_account setting
+    """
+
+    COLUMNS = ['Price', 'Sharpe (unadjusted)', 'Sharpe (adjusted)',
+               'Actual (cnt)', 'Actual ($)', 'Actual (%)',
+               'Target (cnt)', 'Target ($)', 'Target (%)']
+
+    POSITIONS = {column: index for index, column in enumerate(COLUMNS)}
+
+    def __init__(self, tickers: List[str] = (), account: str = None):
+        self.account = account
+        self.value = 0.0
+        self.funds = 0.0
+        self.tickers = list()
+        self.rows = dict()
+        self.data = np.full((len(self.COLUMNS), 0), np.nan)
+        self.add(tickers)
+
+    def __len__(self) -> int:
+        return len(self.tickers)
+
+    def __contains__(self, ticker: str) -> bool:
+        return ticker in self.rows
+
+    def __getitem__(self, column: str) -> pd.Series:
+        return pd.Series(self.column(column), index=self.tickers,
+                         name=column, copy=True)
+
+    def __str__(self) -> str:
+        return str(self.to_frame())
+
+    def column(self, column: str) -> np.ndarray:
+        """ Return a column as an array in row order, not a copy """
+        return self.data[self.POSITIONS[column]]
+
+    def add(self, tickers: List[str]):
+        """
+        Add a row of NaN for each ticker that has none yet, in sorted
+        order after the existing rows.
+
+        tickers -- ticker symbols
+        """
+
+        new = sorted(set(tickers) - set(self.rows))
+
+        if not new:
+            return
+
+        self.rows.update((ticker, len(self.tickers) + index)
+                         for index, ticker in enumerate(new))
+        self.tickers.extend(new)
+        self.data = np.concatenate(
+            [self.data, np.full((len(self.COLUMNS), len(new)), np.nan)],
+            axis=1)
+
+    def set(self, column: str, tickers: List[str], values):
+        """
+        Set a column for some tickers, adding rows for new ones.
+
+        column -- column name
+        tickers -- ticker symbols
+        values -- a value for each ticker, or one for all of them
+        """
+
+        tickers = list(tickers)
+        self.add(tickers)
+        self.column(column)[[self.rows[t] for t in tickers]] = values
+
+    def get(self, column: str, ticker: str) -> float:
+        """ Return the value of a column for one ticker """
+        return float(self.column(column)[self.rows[ticker]])
+
+    def fillna(self, columns: List[str], value: float = 0):
+        """ Replace NaN in columns with value """
+
+        for column in columns:
+            values = self.column(column)
+            values[np.isnan(values)] = value
+
+    def sort(self, column: str):
+        """ Order rows by a column, highest first and NaN last """
+
+        values = self.column(column)
+        order = np.argsort(-np.where(np.isnan(values), -np.inf, values),
+                           kind='stable')
+
+        self.data = self.data[:, order]
+        self.tickers = [self.tickers[row] for row in order]
+        self.rows = {ticker: row for row, ticker in enumerate(self.tickers)}
+
+    def to_dict(self, columns: List[str]) -> dict:
+        """ Return the tickers and some columns as a json ready dict """
+
+        return {'tickers': list(self.tickers),
+                'columns': {column: self.column(column).tolist()
+                            for column in columns}}
+
+    def update(self, data: dict):
+        """ Set the columns of a dict made by to_dict """
+
+        for column, values in data['columns'].items():
+            self.set(column, data['tickers'], values)
+
+    def copy(self) -> 'Portfolio':
+        """ Return an independent copy """
+
+        state = Portfolio(account=self.account)
+        state.value = self.value
+        state.funds = self.funds
+        state.tickers = list(self.tickers)
+        state.rows = dict(self.rows)
+        state.data = self.data.copy()
+
+        return state
+
+    def to_frame(self) -> pd.DataFrame:
+        """ Return the table as a DataFrame indexed by ticker """
+        return pd.DataFrame(self.data.T, index=self.tickers,
+                            columns=self.COLUMNS)
+
 
 ib = IB()
+scheduler = RequestScheduler()
 settings = dict()
+
+# Cache database, read by everything using the cache when called, so
+# runs against a fake TWS can point it somewhere else
+cache_path = CACHE_PATH
 contracts = dict()
-historical_data = pd.DataFrame()
-portfolio_value = float()
-portfolio = pd.DataFrame(columns=[
-    'Price', 'Sharpe (unadjusted)', 'Sharpe (adjusted)',
-    'Actual (cnt)', 'Actual ($)', 'Actual (%)',
-    'Target (cnt)', 'Target ($)', 'Target (%)'
-])
+qualified_contracts = dict()
+historical_data = None
+portfolio = Portfolio()
+sharpe_state = dict()
+cached_closes = dict()
+cached_refreshes = dict()
 sell_orders = list()
 buy_orders = list()
 
+# Portfolio of each account of a multi account rebalance, see
+# rebalance_accounts()
+account_portfolios = dict()
+journal_run = ''
+journal_connection = None
+journal_stages = dict()
+journal_trades = dict()
+
+# Metrics of each stage of the current run in order, see stage()
+timeline = list()
+
+# Metrics of the stage the running code belongs to. Every asyncio task
+# has its own, so stages running at the same time keep their counters
+# apart
+current_stage = contextvars.ContextVar('current_stage', default=None)
+
 
 def start_logging():
     timestr = time.strftime("%Y-%m-%d_%H-%M-%S")
@@ -55,20 +483,267 @@ def load_settings():
         logging.error('Loading settings failed ' + str(e))
 
 
-def connect():
-    """ Connect to TWS with provided credentials """
+def connect(client: IB = None):
+    """
+    Connect to TWS with provided credentials
+
+    client -- object to connect with instead of a new IB, eg. a
+              fake_ib.FakeIB to run without TWS
+    """
 
     logging.info('Connecting to TWS')
 
     try:
         global ib
-        ib = IB()
+        global scheduler
+        ib = client if client is not None else IB()
+        ib.errorEvent += on_error
+        scheduler = RequestScheduler(
+            settings.get('pacing_messages_per_second', 45),
+            settings.get('pacing_history_requests', 60),
+            settings.get('pacing_history_seconds', 600),
+            settings.get('pacing_backoff', 10))
         ib.connect(settings['TWS_ip'],
                    settings['TWS_port'], settings['TWS_id'])
     except Exception as e:
         logging.error('Connecting to tws failed ' + str(e))
 
 
+def on_error(req_id: int, error_code: int, error_string: str,
+             contract: Contract):
+    """
+    Internal helper function.
+
+    Count pacing violations reported by TWS in the running stage and
+    back off the requests that caused them.
+    """
+
+    if error_code == 100 or 'pacing violation' in error_string.lower():
+        count('pacing_violations')
+        scheduler.pacing_violation(PACING_ERRORS.get(error_code))
+
+
+def schedule(kind: str, factory, key: tuple = None, cost: float = 1,
+             priority: int = PRIORITY_DATA):
+    """
+    Make a request through the request scheduler and wait for its
+    result. See RequestScheduler.request.
+    """
+
+    return ib.run(scheduler.request(kind, factory, key, cost, priority))
+
+
+def place_order(contract: Contract, order: Order) -> Trade:
+    """
+    Place or modify an order, counting it against the message rate.
+    Return Trade object.
+
+    contract -- Contract object
+    order -- Order object
+    """
+
+    scheduler.order()
+
+    # Orders of a journaled run are tagged with it, so they can be found
+    # among the open orders after a restart
+    if journal_run and not order.orderRef:
+        order.orderRef = journal_run
+
+    trade = ib.placeOrder(contract, order)
+    journal_trade(trade)
+
+    return trade
+
+
+def cancel_order(order: Order):
+    """
+    Cancel an order, counting it against the message rate.
+
+    order -- Order object
+    """
+
+    scheduler.order()
+    ib.cancelOrder(order)
+
+
+def connection_stats() -> Tuple[int, int]:
+    """
+    Internal helper function.
+
+    Return tuple of (messages sent, bytes received) over the TWS
+    connection so far, zeros if not connected.
+    """
+
+    try:
+        stats = ib.client.connectionStats()
+    except (AttributeError, ConnectionError):
+        return 0, 0
+
+    return stats.numMsgSent, stats.numBytesRecv
+
+
+def count(name: str, amount: float = 1):
+    """
+    Add to a counter of the running stage, eg. bars received. Does
+    nothing outside of a stage.
+
+    name -- counter name
+    amount -- amount to add
+    """
+
+    metrics = current_stage.get()
+
+    if metrics is not None:
+        counters = metrics['counters']
+        counters[name] = counters.get(name, 0) + amount
+
+
+def observe(name: str, values: List[float]):
+    """
+    Record observations of the running stage, eg. order fill latencies.
+    Does nothing outside of a stage.
+
+    name -- observation name
+    values -- observed values
+    """
+
+    metrics = current_stage.get()
+
+    if metrics is not None:
+        metrics['observations'].setdefault(name, []).extend(values)
+
+
+@contextlib.contextmanager
+def stage(name: str):
+    """
+    Context manager measuring one stage of the run. The wall time, TWS
+    API calls and bytes received during the stage are added to global
+    timeline together with anything count and observe record. API calls
+    and bytes of stages that overlap (see run_stages_async) include
+    those of the other stages in flight.
+
+    name -- stage name
+    """
+
+    calls, received = connection_stats()
+    start = time.time()
+
+    metrics = {'stage': name,
+               'start': datetime.fromtimestamp(start).isoformat(),
+               'counters': dict(), 'observations': dict()}
+    timeline.append(metrics)
+    token = current_stage.set(metrics)
+
+    try:
+        yield metrics
+    finally:
+        current_stage.reset(token)
+        end_calls, end_received = connection_stats()
+
+        # Stats start from zero when connecting during the stage
+        if end_calls < calls:
+            calls, received = 0, 0
+
+        metrics['api_calls'] = end_calls - calls
+        metrics['bytes_received'] = end_received - received
+        metrics['seconds'] = time.time() - start
+
+        logging.info(f'Stage {name} took {metrics["seconds"]:.3f} seconds, '
+                     f'{metrics["api_calls"]} API calls')
+
+
+def write_timeline(path: str):
+    """
+    Write global timeline to a json file.
+
+    path -- path to json file
+    """
+
+    with open(path, 'w') as file:
+        json.dump({'stages': timeline,
+                   'seconds': sum(metrics.get('seconds', 0)
+                                  for metrics in timeline)},
+                  file, indent=2)
+
+
+def write_prometheus(path: str):
+    """
+    Write global timeline in the Prometheus textfile collector format.
+    The file is replaced in one step so the collector never reads a half
+    written file.
+
+    path -- path to .prom file
+    """
+
+    lines = list()
+
+    def metric(name: str, kind: str, description: str, samples: list):
+        lines.append(f'# HELP autobroker_{name} {description}')
+        lines.append(f'# TYPE autobroker_{name} {kind}')
+        for labels, value in samples:
+            label_text = ','.join(f'{key}="{label}"'
+                                  for key, label in labels.items())
+            if label_text:
+                label_text = '{' + label_text + '}'
+            lines.append(f'autobroker_{name}{label_text} {value}')
+
+    metric('stage_seconds', 'gauge', 'Wall time of each run stage',
+           [({'stage': m['stage']}, m.get('seconds', 0)) for m in timeline])
+    metric('stage_api_calls', 'gauge', 'TWS API calls of each run stage',
+           [({'stage': m['stage']}, m.get('api_calls', 0))
+            for m in timeline])
+    metric('stage_bytes_received', 'gauge',
+           'Bytes received from TWS in each run stage',
+           [({'stage': m['stage']}, m.get('bytes_received', 0))
+            for m in timeline])
+    metric('stage_count', 'gauge', 'Counters of each run stage',
+           [({'stage': m['stage'], 'counter': name}, value)
+            for m in timeline for name, value in m['counters'].items()])
+
+    summaries = list()
+    for m in timeline:
+        for name, values in m['observations'].items():
+            labels = {'stage': m['stage'], 'observation': name}
+            for quantile in (0.5, 0.9, 1):
+                summaries.append((dict(labels, quantile=quantile),
+                                  np.quantile(values, quantile)))
+    metric('stage_observation', 'gauge',
+           'Quantiles of observations of each run stage, eg. order fill '
+           'latencies', summaries)
+
+    metric('run_seconds', 'gauge', 'Wall time of the last run',
+           [({}, sum(m.get('seconds', 0) for m in timeline))])
+    metric('run_timestamp_seconds', 'gauge', 'Time the last run ended',
+           [({}, time.time())])
+
+    with open(path + '.tmp', 'w') as file:
+        file.write('\n'.join(lines) + '\n')
+
+    os.replace(path + '.tmp', path)
+
+
+def write_metrics():
+    """
+    Write the metrics of the run as a json timeline to the log directory,
+    named by the start of the run, if the metrics_json setting is on,
+    and in Prometheus textfile format to metrics_prometheus_path if it
+    is set.
+    """
+
+    try:
+        if settings.get('metrics_json', False) and timeline:
+            started = datetime.fromisoformat(timeline[0]['start'])
+            write_timeline(LOG_DIR + started.strftime('%Y-%m-%d_%H-%M-%S')
+                           + '.json')
+
+        prometheus_path = settings.get('metrics_prometheus_path', '')
+        if prometheus_path:
+            write_prometheus(prometheus_path)
+
+    except Exception as e:
+        logging.error('Writing metrics failed ' + str(e))
+
+
 def get_tickers(path: str = TICKERS_PATH) -> Set[str]:
     """
     Get ticker symbols from an excel sheet. Return ticker symbols as a set
@@ -77,597 +752,2541 @@ def get_tickers(path: str = TICKERS_PATH) -> Set[str]:
     path -- path to excel sheet
     """
 
-    sheet_data = pd.read_excel(path, skipna=True, header=None)
+    tickers = read_tickers(path)
+    set_tickers(tickers)
+
+    return tickers
+
+
+def read_tickers(path: str = TICKERS_PATH,
+                 cache: str = None) -> Set[str]:
+    """
+    Read ticker symbols from an excel sheet. Return ticker symbols as a
+    set of strings.
+
+    Reading the sheet needs pandas and an excel reader, so the ticker
+    list is compiled into the ticker_sheets table of the cache and read
+    from there until the modification time of the sheet changes.
+
+    path -- path to excel sheet
+    cache -- path to the sqlite database file, None for global cache_path
+    """
+
+    sheet = os.path.abspath(path)
+    mtime = os.path.getmtime(path)
+
+    connection = open_cache(cache)
+    compiled = connection.execute(
+        'SELECT mtime, tickers FROM ticker_sheets WHERE path = ?',
+        (sheet,)).fetchone()
+
+    if compiled is not None and compiled[0] == mtime:
+        connection.close()
+        return set(json.loads(compiled[1]))
+
+    logging.info('Compiling ticker sheet')
+
+    sheet_data = pd.read_excel(path, skipna=True, header=None)
+
+    ticker_series = sheet_data.iloc[:, 0].dropna()
+    tickers = set(ticker_series)
+
+    connection.execute(
+        'INSERT OR REPLACE INTO ticker_sheets VALUES (?, ?, ?)',
+        (sheet, mtime, json.dumps(sorted(tickers))))
+    connection.commit()
+    connection.close()
+
+    return tickers
+
+
+def set_tickers(tickers: Set[str]):
+    """
+    Make tickers the universe of the run. Adds them to global portfolio
+    and stores their Contract objects in global contracts.
+
+    tickers -- set of ticker symbols
+    """
+
+    # If tickers are not in portfolio, add them
+    portfolio.add(tickers)
+
+    logging.info(f'Ticker list: {tickers}')
+
+    # Generate all contracts
+    qualify_contracts(list(tickers))
+
+
+def qualify_contracts(symbols: List[str],
+                      path: str = None) -> Dict[str, Contract]:
+    """
+    Get qualified SMART/USD stock contracts for ticker symbols. Return
+    dict of ticker symbols mapped to Contract objects. Also stores them
+    in global contracts.
+
+    SMART contracts already in global contracts or qualified earlier in
+    the process are used as is, then the contract cache is checked for
+    ones qualified less than contract_cache_ttl_days ago. The rest are
+    qualified with TWS in one batched call and added to the cache.
+
+    symbols -- list of ticker symbols
+    path -- path to the sqlite database file, None for global cache_path
+    """
+
+    global contracts
+
+    # Contracts from positions may not be routed through SMART, those
+    # are qualified again
+    known = dict(qualified_contracts, **contracts)
+    result = {symbol: known[symbol] for symbol in symbols
+              if symbol in known and known[symbol].conId
+              and known[symbol].exchange == 'SMART'}
+    missing = [symbol for symbol in symbols if symbol not in result]
+
+    if not missing:
+        contracts.update(result)
+        return result
+
+    ttl = timedelta(days=settings.get('contract_cache_ttl_days', 7))
+    now = datetime.now()
+
+    connection = open_cache(path)
+
+    for symbol, fields, qualified in connection.execute(
+            'SELECT symbol, contract, qualified FROM contracts'):
+        if (symbol in missing
+                and now - datetime.fromisoformat(qualified) < ttl):
+            result[symbol] = Contract.create(**json.loads(fields))
+
+    missing = [symbol for symbol in missing if symbol not in result]
+
+    if missing:
+        logging.info(f'Qualifying {len(missing)} contracts')
+
+        new_contracts = [Stock(symbol, 'SMART', 'USD') for symbol in missing]
+        schedule('contracts',
+                 lambda: ib.qualifyContractsAsync(*new_contracts),
+                 cost=len(new_contracts))
+
+        for symbol, contract in zip(missing, new_contracts):
+            result[symbol] = contract
+
+            if not contract.conId:
+                logging.error(f'Could not qualify contract for {symbol}')
+                continue
+
+            connection.execute(
+                'INSERT OR REPLACE INTO contracts VALUES (?, ?, ?)',
+                (symbol, json.dumps(util.dataclassNonDefaults(contract)),
+                 now.isoformat()))
+
+    connection.commit()
+    connection.close()
+
+    contracts.update(result)
+    qualified_contracts.update((symbol, contract) for symbol, contract
+                               in result.items() if contract.conId)
+
+    return result
+
+
+def fetch_history(cont: Dict[str, Contract],
+                  shards: int = None) -> Dict[str, List[BarData]]:
+    """
+    Request two years of daily bars for every contract. Return dict of
+    ticker symbols mapped to lists of BarData objects in ascending date
+    order.
+
+    weekly_sample needs 53 weeks, a day or more further back than a
+    '1 Y' request reaches. Durations over a year have to be in years,
+    and ADJUSTED_LAST bars can only be requested up to now (TWS rejects
+    an end date with error 321), so '1 Y' can not be topped up with an
+    earlier request either.
+
+    With more than one shard the requests are spread over worker
+    processes with their own TWS connections, see fetch_sharded_async.
+
+    cont -- dict of ticker symbols mapped to their contract objects
+    shards -- number of worker processes, defaults to the history_shards
+              setting
+    """
+
+    return ib.run(fetch_history_async(cont, shards))
+
+
+async def fetch_history_async(
+        cont: Dict[str, Contract],
+        shards: int = None) -> Dict[str, List[BarData]]:
+    """
+    Coroutine version of fetch_history
+
+    cont -- dict of ticker symbols mapped to their contract objects
+    shards -- number of worker processes, defaults to the history_shards
+              setting
+    """
+
+    if shards is None:
+        shards = settings.get('history_shards', 1)
+
+    if shards > 1 and len(cont) > 1:
+        return await fetch_sharded_async(cont, shards)
+
+    return await fetch_bars_async(cont, '2 Y')
+
+
+def init_shard(client_ids: 'multiprocessing.Queue', shard_settings: dict):
+    """
+    Internal helper function.
+
+    Connect a history worker process to TWS with the next free client
+    id. Meant to be the initializer of the worker processes.
+
+    client_ids -- queue of client ids not taken by another worker
+    shard_settings -- settings of the worker
+    """
+
+    global settings
+
+    settings = dict(shard_settings, TWS_id=client_ids.get())
+    connect()
+
+
+def fetch_shard(
+        fields: Dict[str, dict]) -> Dict[str, List[Tuple[str, float]]]:
+    """
+    Internal helper function.
+
+    Request the history of one chunk of tickers in a worker process.
+    Return dict of ticker symbols mapped to lists of (ISO date, close)
+    tuples, which pickle a lot smaller than BarData.
+
+    fields -- dict of ticker symbols mapped to the fields of their
+              qualified contracts
+    """
+
+    if not ib.isConnected():
+        raise ConnectionError(f'Worker with client id {settings["TWS_id"]} '
+                              f'is not connected to TWS')
+
+    cont = {ticker: Contract.create(**contract_fields)
+            for ticker, contract_fields in fields.items()}
+
+    return {ticker: [(bar.date.isoformat(), bar.close) for bar in bars]
+            for ticker, bars in fetch_history(cont, shards=1).items()}
+
+
+async def fetch_sharded_async(
+        cont: Dict[str, Contract],
+        shards: int) -> Dict[str, List[BarData]]:
+    """
+    Request the history of all contracts over shards worker processes.
+    Each worker connects to TWS once with its own client id (TWS_id + 1
+    and up) and is handed chunks of history_shard_size tickers, so the
+    load evens out and a worker dying only loses the chunks it had not
+    returned yet. Return dict like fetch_history.
+
+    TWS paces historical data for the whole session, not per client, so
+    each worker gets an equal share of pacing_history_requests.
+
+    If a worker dies or fails, the chunks that did not come back are
+    retried in a new pool, up to history_shard_retries times, and
+    whatever is still missing after that is requested over the main
+    connection.
+
+    cont -- dict of ticker symbols mapped to their contract objects
+    shards -- number of worker processes
+    """
+
+    # Only sharded runs need process pools, they are not imported at start
+    from concurrent.futures import ProcessPoolExecutor
+    import multiprocessing
+
+    size = settings.get('history_shard_size', 50)
+    retries = settings.get('history_shard_retries', 2)
+
+    tickers = list(cont.keys())
+    chunks = [{ticker: util.dataclassNonDefaults(cont[ticker])
+               for ticker in tickers[i:i + size]}
+              for i in range(0, len(tickers), size)]
+
+    shard_settings = dict(
+        settings, history_shards=1,
+        pacing_history_requests=max(
+            settings.get('pacing_history_requests', 60) // shards, 1))
+
+    # Workers are spawned like on Windows, also because forking a
+    # process in the middle of a running event loop is not safe
+    context = multiprocessing.get_context('spawn')
+
+    all_bars = dict()
+    pending = list(range(len(chunks)))
+
+    for attempt in range(retries + 1):
+        if not pending:
+            break
+
+        workers = min(shards, len(pending))
+        logging.info(f'Requesting history of {len(pending)} chunks over '
+                     f'{workers} worker connections')
+
+        client_ids = context.Queue()
+        for shard in range(workers):
+            client_ids.put(settings['TWS_id'] + 1 + shard)
+
+        loop = asyncio.get_event_loop()
+
+        with ProcessPoolExecutor(workers, context, init_shard,
+                                 (client_ids, shard_settings)) as executor:
+            futures = {index: asyncio.wrap_future(
+                executor.submit(fetch_shard, chunks[index]), loop=loop)
+                for index in pending}
+
+            for index, future in futures.items():
+                try:
+                    result = await future
+                except Exception as e:
+                    # BrokenProcessPool if a worker died
+                    count('history_shard_failures')
+                    logging.warning(f'History chunk {index} failed '
+                                    f'(attempt {attempt + 1}): {e!r}')
+                    continue
+
+                pending.remove(index)
+
+                for ticker, bars in result.items():
+                    all_bars[ticker] = [
+                        BarData(date=date.fromisoformat(day), close=close)
+                        for day, close in bars]
+
+    count('bars', sum(len(bars) for bars in all_bars.values()))
+
+    if pending:
+        rest = {ticker: cont[ticker]
+                for index in pending for ticker in chunks[index]}
+        logging.warning(f'Requesting history of {len(rest)} tickers over '
+                        f'the main connection')
+        all_bars.update(await fetch_history_async(rest, shards=1))
+
+    # Keep the order of cont so results match fetch_history
+    return {ticker: all_bars.get(ticker, []) for ticker in tickers}
+
+
+def fetch_bars(cont: Dict[str, Contract],
+               duration: str) -> Dict[str, List[BarData]]:
+    """
+    Request daily ADJUSTED_LAST bars for every contract. Return dict of
+    ticker symbols mapped to lists of BarData objects.
+
+    If the history_concurrency setting is greater than 1, requests are
+    kept in flight concurrently over the one IB connection, otherwise
+    they are made one at a time.
+
+    cont -- dict of ticker symbols mapped to their contract objects
+    duration -- IB duration string, eg. '2 Y'
+    """
+
+    return ib.run(fetch_bars_async(cont, duration))
+
+
+async def fetch_bars_async(cont: Dict[str, Contract],
+                           duration: str) -> Dict[str, List[BarData]]:
+    """
+    Coroutine version of fetch_bars
+
+    cont -- dict of ticker symbols mapped to their contract objects
+    duration -- IB duration string, eg. '2 Y'
+    """
+
+    concurrency = settings.get('history_concurrency', 1)
+
+    if concurrency and concurrency > 1:
+        all_bars = await fetch_concurrent_async(cont, duration, concurrency)
+    else:
+        all_bars = dict()
+
+        for ticker, contract in cont.items():
+            all_bars[ticker] = await scheduler.request(
+                'history',
+                lambda: ib.reqHistoricalDataAsync(
+                    contract=contract,
+                    endDateTime='',
+                    durationStr=duration,
+                    barSizeSetting='1 day',
+                    whatToShow='ADJUSTED_LAST',
+                    useRTH=True
+                ),
+                key=('history', contract.conId, duration))
+
+    count('bars', sum(len(bars) for bars in all_bars.values()))
+
+    return all_bars
+
+
+async def fetch_concurrent_async(
+        cont: Dict[str, Contract], duration: str,
+        concurrency: int) -> Dict[str, List[BarData]]:
+    """
+    Internal helper function.
+
+    Request daily bars for all contracts with at most concurrency
+    requests in flight at once. Each request is given history_timeout
+    seconds and retried up to history_retries times. Tickers that still
+    fail are logged and mapped to an empty list.
+
+    cont -- dict of ticker symbols mapped to their contract objects
+    duration -- IB duration string, eg. '2 Y'
+    concurrency -- maximum number of requests in flight
+    """
+
+    semaphore = asyncio.Semaphore(concurrency)
+    timeout = settings.get('history_timeout', 60)
+    retries = settings.get('history_retries', 2)
+
+    async def request(ticker: str, contract: Contract) -> List[BarData]:
+        async with semaphore:
+            for attempt in range(retries + 1):
+                try:
+                    bars = await scheduler.request(
+                        'history',
+                        lambda: ib.reqHistoricalDataAsync(
+                            contract=contract,
+                            endDateTime='',
+                            durationStr=duration,
+                            barSizeSetting='1 day',
+                            whatToShow='ADJUSTED_LAST',
+                            useRTH=True
+                        ),
+                        key=('history', contract.conId, duration),
+                        timeout=timeout)
+                except asyncio.TimeoutError:
+                    bars = None
+
+                if bars:
+                    return bars
+
+                count('history_retries')
+                logging.warning(f'Historical data request for {ticker} '
+                                f'failed (attempt {attempt + 1})')
+
+        logging.error(f'Could not get historical data for {ticker}')
+        return []
+
+    tickers = list(cont.keys())
+    results = await asyncio.gather(
+        *[request(ticker, cont[ticker]) for ticker in tickers])
+
+    return dict(zip(tickers, results))
+
+
+def open_cache(path: str = None) -> sqlite3.Connection:
+    """
+    Open the local cache database, creating it and its tables if they
+    do not exist yet. Return the sqlite3 connection.
+
+    path -- path to the sqlite database file, None for global cache_path
+    """
+
+    if path is None:
+        path = cache_path
+
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+
+    connection = sqlite3.connect(path)
+    connection.execute(
+        'CREATE TABLE IF NOT EXISTS bars ('
+        'symbol TEXT, date TEXT, close REAL, PRIMARY KEY (symbol, date))')
+    connection.execute(
+        'CREATE TABLE IF NOT EXISTS bar_refresh ('
+        'symbol TEXT PRIMARY KEY, refreshed TEXT)')
+    connection.execute(
+        'CREATE TABLE IF NOT EXISTS sharpe_state ('
+        'symbol TEXT PRIMARY KEY, state TEXT)')
+    connection.execute(
+        'CREATE TABLE IF NOT EXISTS contracts ('
+        'symbol TEXT PRIMARY KEY, contract TEXT, qualified TEXT)')
+    connection.execute(
+        'CREATE TABLE IF NOT EXISTS ticker_sheets ('
+        'path TEXT PRIMARY KEY, mtime REAL, tickers TEXT)')
+    connection.execute(
+        'CREATE TABLE IF NOT EXISTS journal ('
+        'run TEXT, stage TEXT, data TEXT, written TEXT, '
+        'PRIMARY KEY (run, stage))')
+    connection.execute(
+        'CREATE TABLE IF NOT EXISTS journal_trades ('
+        'run TEXT, orderId INTEGER, data TEXT, '
+        'PRIMARY KEY (run, orderId))')
+
+    return connection
+
+
+def cached_bars(cont: Dict[str, Contract],
+                path: str = None) -> Dict[str, List[BarData]]:
+    """
+    Get daily bars for all contracts, reading the local bar cache first
+    and only asking TWS for the bars that are missing. Return dict of
+    ticker symbols mapped to lists of BarData objects, same as
+    fetch_bars.
+
+    Adjusted prices get restated on dividends and splits, so a ticker
+    is fully refreshed (see fetch_history) if it is not cached, if its
+    last full refresh is older than bar_cache_refresh_days, or if the
+    bars that overlap the tail request no longer match the cached
+    closes.
+
+    Bars dated today are still forming while the market is open, they
+    are returned but not cached, so the next run compares against
+    closes that are final.
+
+    cont -- dict of ticker symbols mapped to their contract objects
+    path -- path to the sqlite database file, None for global cache_path
+    """
+
+    return ib.run(cached_bars_async(cont, path))
+
+
+async def cached_bars_async(
+        cont: Dict[str, Contract],
+        path: str = None) -> Dict[str, List[BarData]]:
+    """
+    Coroutine version of cached_bars
+
+    cont -- dict of ticker symbols mapped to their contract objects
+    path -- path to the sqlite database file, None for global cache_path
+    """
+
+    refresh_days = settings.get('bar_cache_refresh_days', 7)
+    today = date.today()
+
+    connection = open_cache(path)
+
+    # The cache is read once per process and kept in global
+    # cached_closes and cached_refreshes, eg. between daemon rebalances
+    global cached_closes
+    global cached_refreshes
+
+    if not cached_closes:
+        for symbol, day, close in connection.execute(
+                'SELECT symbol, date, close FROM bars'):
+            cached_closes.setdefault(symbol, dict())[
+                date.fromisoformat(day)] = close
+
+        cached_refreshes.update(
+            (symbol, date.fromisoformat(day)) for symbol, day in
+            connection.execute('SELECT symbol, refreshed FROM bar_refresh'))
+
+    cache = {ticker: cached_closes.setdefault(ticker, dict())
+             for ticker in cont.keys()}
+    refreshed = cached_refreshes
+
+    # Sort tickers into ones needing a full refresh and ones that only
+    # need the tail since their last cached bar. Tails are grouped by
+    # duration string so each group is one fetch_bars call
+    full = dict()
+    tails = dict()
+
+    for ticker, contract in cont.items():
+        last_refresh = refreshed.get(ticker)
+
+        if (not cache[ticker] or last_refresh is None
+                or (today - last_refresh).days >= refresh_days):
+            full[ticker] = contract
+            continue
+
+        # Go back to the last cached bar so there is an overlap to check
+        days = (today - max(cache[ticker])).days + 1
+        tails.setdefault(f'{days} D', dict())[ticker] = contract
+
+    all_bars = dict()
+
+    for duration, group in tails.items():
+        for ticker, bars in (await fetch_bars_async(group,
+                                                    duration)).items():
+            overlap = [bar for bar in bars if bar.date in cache[ticker]]
+
+            restated = any(
+                not math.isclose(bar.close, cache[ticker][bar.date],
+                                 rel_tol=1e-6)
+                for bar in overlap)
+
+            if not bars or not overlap or restated:
+                logging.info(f'Cached bars for {ticker} are stale')
+                full[ticker] = cont[ticker]
+                continue
+
+            new_bars = [bar for bar in bars if bar.date not in cache[ticker]
+                        and bar.date < today]
+            connection.executemany(
+                'INSERT OR REPLACE INTO bars VALUES (?, ?, ?)',
+                [(ticker, bar.date.isoformat(), bar.close)
+                 for bar in new_bars])
+
+            for bar in new_bars:
+                cache[ticker][bar.date] = bar.close
+
+            all_bars[ticker] = [BarData(date=day, close=close)
+                                for day, close in sorted(
+                                    cache[ticker].items())]
+            all_bars[ticker].extend(bar for bar in bars if bar.date >= today)
+
+    if full:
+        logging.info(f'Fully refreshing cached bars for {len(full)} '
+                     f'tickers')
+
+    for ticker, bars in (await fetch_history_async(full)).items():
+        all_bars[ticker] = bars
+
+        if not bars:
+            continue
+
+        settled = [bar for bar in bars if bar.date < today]
+
+        connection.execute('DELETE FROM bars WHERE symbol = ?', (ticker,))
+        connection.executemany(
+            'INSERT INTO bars VALUES (?, ?, ?)',
+            [(ticker, bar.date.isoformat(), bar.close) for bar in settled])
+        connection.execute(
+            'INSERT OR REPLACE INTO bar_refresh VALUES (?, ?)',
+            (ticker, today.isoformat()))
+
+        cache[ticker].clear()
+        cache[ticker].update((bar.date, bar.close) for bar in settled)
+        refreshed[ticker] = today
+
+    # Bars older than the longest request are never needed again
+    oldest = today - timedelta(days=2 * 366)
+    connection.execute('DELETE FROM bars WHERE date < ?',
+                       (oldest.isoformat(),))
+
+    for closes in cached_closes.values():
+        for day in [day for day in closes if day < oldest]:
+            del closes[day]
+
+    connection.commit()
+    connection.close()
+
+    # Keep the order of cont so results match fetch_bars
+    return {ticker: all_bars[ticker] for ticker in cont.keys()}
+
+
+def bars_to_frame(all_bars: Dict[str, List[BarData]]) -> pd.DataFrame:
+    """
+    Build a DataFrame of daily closes out of lists of bars. The index is
+    the sorted bar dates and the column names are the ticker symbols.
+    Tickers without any bars are left out.
+
+    all_bars -- dict of ticker symbols mapped to lists of BarData objects
+    """
+
+    columns = {
+        ticker: pd.Series([bar.close for bar in bars],
+                          index=[bar.date for bar in bars], dtype=float)
+        for ticker, bars in all_bars.items() if bars
+    }
+
+    if not columns:
+        return pd.DataFrame()
+
+    data = pd.concat(columns, axis=1)
+    data = data[~data.index.duplicated(keep='last')]
+
+    return data.sort_index()
+
+
+def weekly_sample(daily_data: pd.DataFrame, weeks: int = 53) -> pd.DataFrame:
+    """
+    Sample daily data once a week on the same weekday as its most recent
+    row, keeping the most recent number of weeks. Missing values are
+    filled with the nearest prior value of that ticker, or the nearest
+    next value if there is no prior one.
+
+    daily_data -- DataFrame of daily closes indexed by date, in
+                  ascending order
+    weeks -- number of weekly rows to keep
+    """
+
+    weekdays = pd.DatetimeIndex(daily_data.index).weekday
+    cur_weekday = weekdays[-1]  # last weekday in daily data
+
+    filled = daily_data.ffill().bfill()
+
+    return filled[weekdays == cur_weekday].iloc[-weeks:]
+
+
+def get_historical_data(cont: Dict[str, Contract] = None) -> pd.DataFrame:
+    """
+    Get weekly historical data for all contracts going back 53 weeks.
+
+    Sore result in DataFrame which is returned and stored in global
+    historical_data. The index of this dataframe is a string
+    representation of a datetime.date object, the column names are the
+    ticker symbols and the data is the close value of the ticker as a
+    float.
+
+    cont -- dict of ticker symbols mapped to their contract objects
+    """
+
+    return ib.run(get_historical_data_async(cont))
+
+
+async def get_historical_data_async(
+        cont: Dict[str, Contract] = None) -> pd.DataFrame:
+    """
+    Coroutine version of get_historical_data
+
+    cont -- dict of ticker symbols mapped to their contract objects
+    """
+
+    if cont is None:
+        global contracts
+    else:
+        contracts = cont
+
+    global historical_data
+
+    logging.info('getting historical data')
+
+    start = time.time()
+
+    # Get historical data from ib api
+    # We need 53 weeks of data but all duration strings greater than a
+    # year must be defined in terms of years. A '1 Y' durationStr only
+    # gives 52 weeks of data not the needed 53, so '2 Y' of data is
+    # requested and what we don't need is trimmed
+    if settings.get('bar_cache', False):
+        all_bars = await cached_bars_async(contracts)
+    else:
+        all_bars = await fetch_history_async(contracts)
+
+    data_pull = bars_to_frame(all_bars)
+
+    end = time.time()
+    logging.info(f'Data pull took {end-start} seconds')
+
+    historical_data = weekly_sample(data_pull, 53)
+
+    return historical_data
+
+
+def sharpe_single(ticker_change: pd.Series, weeks: int = 52) -> float:
+    """
+    Get the sharpe ratio of a single ticker going over a certain number
+    of weeks
+
+    ticker_change -- a Series object containting change percentages
+    weeks -- number of weeks to take into account, most recent weeks
+             will be uesed
+    """
+
+    total_weeks = len(ticker_change.index)
+    change = ticker_change[total_weeks-weeks: total_weeks]
+
+    average = change.mean(skipna=True)
+
+    standard_deviation = change.std(skipna=True, ddof=0)
+
+    return average / standard_deviation
+
+
+def window_sharpes(values: np.ndarray, windows: List[int],
+                   ends: np.ndarray = None) -> np.ndarray:
+    """
+    Calculate sharpe ratios of every column of a change matrix over
+    windows ending at certain rows, in one pass over the matrix. Return
+    array of shape (len(windows), len(ends), columns). Missing changes
+    are skipped and standard deviations are population (ddof=0), same
+    as sharpe_single.
+
+    values -- 2D array of change percentages, oldest row first
+    windows -- numbers of rows to calculate ratios over
+    ends -- row numbers each window ends before, defaults to only the
+            end of the matrix
+    """
+
+    values = np.asarray(values, dtype=float)
+    total_weeks, ticker_count = values.shape
+
+    if ends is None:
+        ends = np.array([total_weeks])
+    ends = np.asarray(ends)
+
+    valid = ~np.isnan(values)
+
+    # Center every column first so the sums of squares do not lose
+    # precision, variance does not depend on the center
+    with np.errstate(invalid='ignore'):
+        center = np.nanmean(values, axis=0) if total_weeks else 0
+    center = np.nan_to_num(center)
+    centered = np.where(valid, values - center, 0.0)
+
+    # Prefix sums with a leading row of zeros, the sum over the w rows
+    # before row e is then prefix[e] - prefix[e - w]
+    zeros = np.zeros((1, ticker_count))
+    sums = np.concatenate([zeros, np.cumsum(centered, axis=0)])
+    squares = np.concatenate([zeros, np.cumsum(centered ** 2, axis=0)])
+    counts = np.concatenate([zeros, np.cumsum(valid, axis=0)])
+
+    results = np.empty((len(windows), len(ends), ticker_count))
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for i, weeks in enumerate(windows):
+            first = np.maximum(ends - weeks, 0)
+
+            count = counts[ends] - counts[first]
+            mean = (sums[ends] - sums[first]) / count
+            variance = (squares[ends] - squares[first]) / count - mean ** 2
+
+            std = np.sqrt(np.maximum(variance, 0))
+            results[i] = (mean + center) / std
+
+    return results
+
+
+def sharpe_engine(weekly_change: pd.DataFrame,
+                  windows: List[int] = (52, 26, 13)) -> pd.DataFrame:
+    """
+    Calculate sharpe ratios of every ticker over every window in one
+    pass over the change matrix. Return DataFrame indexed by ticker
+    symbol with one column per window.
+
+    weekly_change -- DataFrame of change percentages, one column per
+                     ticker, oldest row first
+    windows -- numbers of most recent weeks to calculate ratios over
+    """
+
+    ratios = window_sharpes(weekly_change.to_numpy(dtype=float), windows)
+
+    return pd.DataFrame(ratios[:, 0, :].T, index=weekly_change.columns,
+                        columns=list(windows))
+
+
+def adjust_sharpes(average: np.ndarray, floor: float = 0.2,
+                   exponent: float = 1.5) -> np.ndarray:
+    """
+    Return adjusted sharpe ratios, the average sharpe ratio raised to
+    exponent, or zero if it is not above floor (or missing).
+
+    average -- array or Series of average sharpe ratios
+    floor -- ratios at or below this are adjusted to zero
+    exponent -- power the remaining ratios are raised to
+    """
+
+    with np.errstate(invalid='ignore'):
+        return np.where(average > floor,
+                        np.maximum(average, 0) ** exponent, 0.0)
+
+
+class RollingSharpe:
+    """
+    Running sums over the most recent weekly changes of one ticker, so
+    the sharpe ratio can be updated in O(1) when a new week arrives.
+    Missing changes take up a slot in the window but are skipped in the
+    sums, same as sharpe_engine.
+
+    weeks -- number of most recent weeks in the window
+    changes -- optional initial changes, oldest first
+    """
+
+    def __init__(self, weeks: int, changes: List[float] = ()):
+        self.weeks = weeks
+        self.changes = deque(maxlen=weeks)
+        self.total = 0.0
+        self.squares = 0.0
+        self.count = 0
+
+        for change in changes:
+            self.push(change)
+
+    def push(self, change: float):
+        """ Add the newest change and drop the oldest one if full """
+
+        if len(self.changes) == self.weeks:
+            oldest = self.changes[0]
+            if not math.isnan(oldest):
+                self.total -= oldest
+                self.squares -= oldest ** 2
+                self.count -= 1
+
+        self.changes.append(change)
+
+        if not math.isnan(change):
+            self.total += change
+            self.squares += change ** 2
+            self.count += 1
+
+    def sharpe(self) -> float:
+        """ Return the sharpe ratio over the window """
+
+        if not self.count:
+            return math.nan
+
+        mean = self.total / self.count
+        variance = max(self.squares / self.count - mean ** 2, 0)
+
+        if not variance:
+            return math.nan
+
+        return mean / math.sqrt(variance)
+
+
+def rolling_sharpes(weekly_data: pd.DataFrame, windows: List[int],
+                    path: str = None) -> pd.DataFrame:
+    """
+    Calculate sharpe ratios of every ticker over every window using the
+    rolling state kept in global sharpe_state and the cache database.
+    Return DataFrame in the same format as sharpe_engine.
+
+    A ticker whose state ends one week before weekly_data only has the
+    newest change pushed. A ticker whose state already ends on the last
+    week is reused as is. Anything else (no state, different windows or
+    closes that no longer match, eg. after a restatement) is rebuilt
+    from weekly_data.
+
+    weekly_data -- A pandas dataframe following the same format as
+                   global historical data
+    windows -- numbers of weeks to calculate ratios over
+    path -- path to the sqlite database file, None for global cache_path
+    """
+
+    global sharpe_state
+
+    connection = open_cache(path)
+
+    if not sharpe_state:
+        for symbol, state in connection.execute(
+                'SELECT symbol, state FROM sharpe_state'):
+            state = json.loads(state)
+            state['windows'] = {
+                int(weeks): RollingSharpe(int(weeks), changes)
+                for weeks, changes in state['windows'].items()}
+            sharpe_state[symbol] = state
+
+    dates = [str(day) for day in weekly_data.index]
+    weekly_change = weekly_data.pct_change()
+
+    changed = dict()
+    results = dict()
+
+    for ticker in weekly_data.columns:
+        closes = weekly_data[ticker]
+        state = sharpe_state.get(ticker)
+
+        # Which week (-1 or -2) the saved state ends on, if any. Both the
+        # close of that week and of the week before have to match
+        ends_on = None
+        if (state is not None and len(dates) > 2
+                and set(state['windows']) == set(windows)):
+            for week in (-1, -2):
+                if (state['date'] == dates[week]
+                        and math.isclose(state['close'], closes.iloc[week],
+                                         rel_tol=1e-9)
+                        and math.isclose(state['previous'],
+                                         closes.iloc[week - 1],
+                                         rel_tol=1e-9)):
+                    ends_on = week
+                    break
+
+        if ends_on == -2:
+            for rolling in state['windows'].values():
+                rolling.push(weekly_change[ticker].iloc[-1])
+
+        elif ends_on is None:
+            changes = list(weekly_change[ticker])
+            state = {'windows': {
+                weeks: RollingSharpe(weeks, changes[-weeks:])
+                for weeks in windows}}
+
+        if ends_on != -1:
+            state['date'] = dates[-1]
+            state['close'] = float(closes.iloc[-1])
+            state['previous'] = float(closes.iloc[-2])
+            sharpe_state[ticker] = state
+            changed[ticker] = state
+
+        results[ticker] = [state['windows'][weeks].sharpe()
+                           for weeks in windows]
+
+    connection.executemany(
+        'INSERT OR REPLACE INTO sharpe_state VALUES (?, ?)',
+        [(ticker, json.dumps({
+            'date': state['date'],
+            'close': state['close'],
+            'previous': state['previous'],
+            'windows': {weeks: list(rolling.changes)
+                        for weeks, rolling in state['windows'].items()}}))
+         for ticker, state in changed.items()])
+
+    connection.commit()
+    connection.close()
+
+    return pd.DataFrame.from_dict(results, orient='index', columns=windows)
+
+
+def sharpe_ratios(weekly_data: pd.DataFrame = None,
+                  windows: List[int] = None,
+                  state: Portfolio = None) -> Dict[str, float]:
+    """
+    Calculate average sharpe ratio for each ticker.
+
+    Average sharpe ratio is the averege of sharpe ratios calculated over
+    each window, 52, 26 and 13 weeks unless the sharpe_windows setting
+    says otherwise. The adjusted ratio is the average raised to
+    sharpe_exponent (1.5), or zero if it is not above sharpe_floor (0.2).
+    Results will also be stored in the portfolio.
+    Return dict of ticker symbols mapped to average sharpe values.
+
+    weekly_data -- A pandas dataframe following the same format as
+                   global historical data
+    windows -- numbers of weeks to average sharpe ratios over
+    state -- portfolio to store results in, defaults to global portfolio
+    """
+
+    if weekly_data is None:
+        global historical_data
+        weekly_data = historical_data
+
+    if windows is None:
+        windows = settings.get('sharpe_windows', [52, 26, 13])
+
+    if state is None:
+        state = portfolio
+
+    weekly_change = weekly_data.pct_change()
+
+    # if tickers are not in portfolio, add them
+    state.add(weekly_change.columns)
+
+    if settings.get('incremental_sharpe', False):
+        ratios = rolling_sharpes(weekly_data, windows)
+    else:
+        ratios = sharpe_engine(weekly_change, windows)
+
+    average = ratios.mean(axis=1, skipna=False)
+    adjusted = adjust_sharpes(average.to_numpy(dtype=float),
+                              settings.get('sharpe_floor', 0.2),
+                              settings.get('sharpe_exponent', 1.5))
+
+    # Update portfolio
+    state.set('Sharpe (unadjusted)', average.index,
+              average.to_numpy(dtype=float))
+    state.set('Sharpe (adjusted)', average.index, adjusted)
+
+    return average.to_dict()
+
+
+def quote_price(ticker: Ticker,
+                preference: List[str]) -> Tuple[float, str]:
+    """
+    Internal helper function.
+
+    Pick the price of a quote by order of preference. Return tuple of
+    (price, source), (NaN, '') if the quote has none of the prices.
+
+    ticker -- Ticker object, may be None
+    preference -- list of 'last', 'mid' and 'close' in order of
+                  preference
+    """
+
+    if ticker is None:
+        return math.nan, ''
+
+    for source in preference:
+        if source == 'mid':
+            bid, ask = ticker.bid, ticker.ask
+            price = (bid + ask) / 2 if bid > 0 and ask >= bid else math.nan
+        else:
+            price = getattr(ticker, source)
+
+        # TWS sends -1 for prices it does not have
+        if price > 0:
+            return price, source
+
+    return math.nan, ''
+
+
+async def snapshot_async(cont: List[Contract],
+                         deadline: float) -> List[Ticker]:
+    """
+    Request quote snapshots for all contracts at once and wait for them
+    for at most deadline seconds. Return list of Ticker objects in the
+    order of cont, with whatever arrived before the deadline.
+
+    cont -- list of Contract objects
+    deadline -- seconds to wait
+    """
+
+    try:
+        return await asyncio.wait_for(scheduler.request(
+            'market data', lambda: ib.reqTickersAsync(*cont),
+            cost=len(cont)), deadline)
+
+    except asyncio.TimeoutError:
+        logging.warning(f'Price snapshot timed out after {deadline} '
+                        f'seconds')
+
+        return [ib.ticker(contract) for contract in cont]
+
+
+def get_prices(cont: Dict[str, Contract] = None) -> Dict[str, float]:
+    """
+    Get current price of each ticker. Return set of ticker symbols
+    mapped to a float value (USD). Results will also be stored in global
+    portfolio.
+
+    Quotes are requested all at once and waited for at most price_timeout
+    seconds. Each price is the first available of the price_preference
+    setting (last, mid and close by default). Tickers without a quote
+    price fall back to their last historical close.
+
+    cont -- dict of ticker symbols mapped to their contract objects
+    """
+    if cont is None:
+        global contracts
+    else:
+        contracts = cont
+
+    logging.info('Requesting current ticker prices')
+
+    deadline = settings.get('price_timeout', 10)
+    tickers = ib.run(snapshot_async(list(contracts.values()), deadline))
+
+    return store_prices(dict(zip(contracts.keys(), tickers)))
+
+
+def store_prices(quotes: Dict[str, Ticker],
+                 state: Portfolio = None) -> Dict[str, float]:
+    """
+    Pick the price of each ticker out of its quote, see get_prices.
+    Return dict of ticker symbols mapped to float values (USD). Results
+    will also be stored in the portfolio.
+
+    quotes -- dict of ticker symbols mapped to Ticker objects, None
+              where there is no quote
+    state -- portfolio to store results in, defaults to global portfolio
+    """
+
+    if state is None:
+        state = portfolio
+
+    prices = dict()
+
+    preference = settings.get('price_preference', ['last', 'mid', 'close'])
+    symbols = list(quotes.keys())
+
+    for symbol, ticker in quotes.items():
+        price, source = quote_price(ticker, preference)
+
+        if (math.isnan(price) and historical_data is not None
+                and symbol in historical_data.columns):
+            price = float(historical_data[symbol].iloc[-1])
+            source = 'history'
+            logging.warning(f'No quote for {symbol}, using last '
+                            f'historical close {price}')
+
+        count(f'prices_{source or "missing"}')
+        prices[symbol] = price
+
+    state.set('Price', symbols, [prices[symbol] for symbol in symbols])
+
+    return prices
+
+
+def account_of(state: Portfolio) -> str:
+    """
+    Internal helper function.
+
+    Return the account id of a portfolio, the TWS_account setting if it
+    has none.
+    """
+
+    if state.account is None:
+        return settings.get('TWS_account', '')
+
+    return state.account
+
+
+def actual_portfolio(state: Portfolio = None):
+    """
+    Get data on actual positions from TWS, store in the portfolio along
+    with its value and available funds.
+
+    state -- portfolio of the account, defaults to global portfolio
+    """
+
+    logging.info('Requesting current portfolio details')
+
+    if state is None:
+        state = portfolio
+
+    # if account not set, pick active account
+    account = account_of(state)
+
+    if not account:
+        account_value = [v for v in ib.accountValues()
+                         if v.tag == 'NetLiquidation'][0]
+        account = account_value.account
+    else:
+        account_value = [v for v in ib.accountValues(account)
+                         if v.tag == 'NetLiquidation'][0]
+
+    state.value = float(account_value.value)
+
+    funds = [v for v in ib.accountValues(account)
+             if v.tag == 'AvailableFunds']
+    state.funds = float(funds[0].value) if funds else 0.0
+
+    global contracts
+
+    positions = ib.positions(account)
+    tickers = [position.contract.symbol for position in positions]
+    counts = np.array([position.position for position in positions],
+                      dtype=float)
+    prices = np.array([position.avgCost for position in positions],
+                      dtype=float)
+    values = prices * counts
+
+    for ticker, position in zip(tickers, positions):
+        contracts[ticker] = position.contract
+
+    state.set('Actual (cnt)', tickers, np.round(counts, 2))
+    state.set('Price', tickers, prices)
+    state.set('Actual ($)', tickers, np.round(values, 2))
+    state.set('Actual (%)', tickers, values / state.value * 100)
+
+    # Fill blank values with zeros
+    state.fillna(['Actual (cnt)', 'Actual ($)', 'Actual (%)'])
+
+
+def target_shares(sharpes: np.ndarray, adjusted: np.ndarray, max_size: int,
+                  cap: float = 0.25) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Calculate target shares of the portfolio along the last axis of the
+    sharpe arrays, so a 2D array allocates one portfolio per row. Return
+    tuple of (shares, weights) in the same order as the input, shares as
+    fractions of the portfolio and weights as the adjusted sharpe ratios
+    that were actually used.
+
+    Only the max_size tickers with the highest unadjusted sharpe ratio
+    are used. Shares are the adjusted sharpe ratios normalised to sum to
+    one. A share over cap is cut to cap and the excess is carried over
+    to the next used ticker in order of sharpe ratio, anything left over
+    after the last used ticker stays in cash.
+
+    sharpes -- unadjusted sharpe ratios
+    adjusted -- adjusted sharpe ratios
+    max_size -- maximum number of tickers in the portfolio
+    cap -- maximum share of a single ticker, None for no cap
+    """
+
+    sharpes = np.asarray(sharpes, dtype=float)
+    adjusted = np.nan_to_num(np.asarray(adjusted, dtype=float))
+
+    # Rank by descending sharpe ratio, missing ratios last
+    order = np.argsort(-np.where(np.isnan(sharpes), -np.inf, sharpes),
+                       axis=-1, kind='stable')
+    weights = np.take_along_axis(adjusted, order, axis=-1)
+    weights[..., max_size:] = 0
+
+    total = weights.sum(axis=-1, keepdims=True)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        shares = np.where(total > 0, weights / total, 0.0)
+
+    if cap is not None:
+        # The carried excess follows excess = max(0, excess + share - cap)
+        # over the used tickers, which is a running sum minus its running
+        # minimum
+        step = np.where(weights > 0, shares - cap, 0.0)
+        running = np.cumsum(step, axis=-1)
+        excess = running - np.minimum(
+            np.minimum.accumulate(running, axis=-1), 0)
+        carried = np.concatenate(
+            [np.zeros_like(excess[..., :1]), excess[..., :-1]], axis=-1)
+        shares = shares + carried - excess
+
+    # Put results back in input order
+    result_shares = np.empty_like(shares)
+    result_weights = np.empty_like(weights)
+    np.put_along_axis(result_shares, order, shares, axis=-1)
+    np.put_along_axis(result_weights, order, weights, axis=-1)
+
+    return result_shares, result_weights
+
+
+def allocate(sharpes: pd.Series, adjusted: pd.Series, prices: pd.Series,
+             value: float, max_size: int,
+             cap: float = 0.25) -> Allocation:
+    """
+    Allocate a portfolio of a certain value over tickers. Return
+    Allocation of arrays in order of descending sharpe ratio, with
+    shares as fractions of the portfolio, values in USD and counts in
+    number of shares (NaN where the price is missing).
+
+    sharpes -- unadjusted sharpe ratios indexed by ticker symbol
+    adjusted -- adjusted sharpe ratios with the same index
+    prices -- current prices with the same index
+    value -- total portfolio value (USD)
+    max_size -- maximum number of tickers in the portfolio
+    cap -- maximum share of a single ticker, None for no cap
+    """
+
+    shares, weights = target_shares(sharpes, adjusted, max_size, cap)
+
+    sharpes = sharpes.to_numpy(dtype=float)
+    order = np.argsort(-np.where(np.isnan(sharpes), -np.inf, sharpes),
+                       kind='stable')
+
+    shares = shares[order]
+    values = shares * value
+    prices = prices.to_numpy(dtype=float)[order]
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        counts = np.where(prices > 0, values / prices, np.nan)
+
+    return Allocation(tickers=np.asarray(adjusted.index)[order],
+                      weights=weights[order], shares=shares,
+                      values=values, counts=counts)
+
+
+def target_portfolio(state: Portfolio = None):
+    """
+    Calculate target portfolio, store in the portfolio
+
+    state -- portfolio with sharpe ratios, prices and value, defaults to
+             global portfolio
+    """
+
+    logging.info('Generating target portfolio')
+
+    if state is None:
+        state = portfolio
+
+    # Sort portfolio by sharpe ratio
+    state.sort('Sharpe (unadjusted)')
+
+    global settings
+    max_size = settings['max_portfolio_size']
+    cap = settings.get('max_position_percent', 25) / 100
+
+    allocation = allocate(state['Sharpe (unadjusted)'],
+                          state['Sharpe (adjusted)'],
+                          state['Price'], state.value,
+                          max_size, cap)
+
+    excluded = allocation.tickers[(allocation.shares > 0)
+                                  & np.isnan(allocation.counts)]
+    for ticker in excluded:
+        logging.error(f'{ticker} excluded from target portfolio')
+
+    # Adjusted sharpe ratio is zero for tickers that will not be used
+    # (only leave max number of top tickers)
+    tickers = allocation.tickers
+    state.set('Sharpe (adjusted)', tickers, allocation.weights)
+    state.set('Target (%)', tickers, allocation.shares * 100)
+    state.set('Target ($)', tickers, allocation.values)
+    state.set('Target (cnt)', tickers, allocation.counts)
+
+    logging.info(f'Total portfolio value: {state.value}')
+    logging.info('Portfolio:\n' + str(state.to_frame()))
+
+
+def sell_quantities(actual_cnt: np.ndarray, target_cnt: np.ndarray,
+                    actual_pct: np.ndarray, target_pct: np.ndarray,
+                    r: int, threshold: float = 2) -> np.ndarray:
+    """
+    Calculate how many shares of each ticker to sell. Return array of
+    share counts, zero where nothing should be sold.
+
+    Only sell if actual is more than threshold percent above target.
+    Sell everything if the target is zero, otherwise sell the difference
+    rounded up to a multiple of r, but never more than is held. Tickers
+    without a target count are not sold.
+
+    actual_cnt -- number of shares held
+    target_cnt -- target number of shares
+    actual_pct -- actual percentage of the portfolio
+    target_pct -- target percentage of the portfolio
+    r -- number to round quantities to
+    threshold -- percentage difference needed to sell
+    """
+
+    actual_cnt = np.asarray(actual_cnt, dtype=float)
+    target_cnt = np.asarray(target_cnt, dtype=float)
+
+    with np.errstate(invalid='ignore'):
+        selling = (np.asarray(actual_pct, dtype=float)
+                   - np.asarray(target_pct, dtype=float)) > threshold
+
+        number = actual_cnt - target_cnt
+        number = number + (r - (number % r))  # Round up
+        number = np.where(target_cnt == 0, actual_cnt, number)
+
+        # If we want to sell all of the holdings
+        number = np.minimum(number, actual_cnt)
+
+    return np.where(selling, np.nan_to_num(number), 0)
+
+
+def buy_quantities(actual_cnt: np.ndarray, target_cnt: np.ndarray,
+                   actual_pct: np.ndarray, target_pct: np.ndarray,
+                   r: int, threshold: float = 2) -> np.ndarray:
+    """
+    Calculate how many shares of each ticker to buy. Return array of
+    share counts, zero where nothing should be bought.
+
+    Only buy if target is more than threshold percent above actual, and
+    buy the difference rounded down to a multiple of r. Tickers without
+    a target count are not bought.
+
+    actual_cnt -- number of shares held
+    target_cnt -- target number of shares
+    actual_pct -- actual percentage of the portfolio
+    target_pct -- target percentage of the portfolio
+    r -- number to round quantities to
+    threshold -- percentage difference needed to buy
+    """
+
+    actual_cnt = np.asarray(actual_cnt, dtype=float)
+    target_cnt = np.asarray(target_cnt, dtype=float)
+
+    with np.errstate(invalid='ignore'):
+        buying = (np.asarray(target_pct, dtype=float)
+                  - np.asarray(actual_pct, dtype=float)) > threshold
+
+        number = target_cnt - actual_cnt
+        number = number - (number % r)  # Round down
+
+    return np.where(buying, np.maximum(np.nan_to_num(number), 0), 0)
+
+
+def generate_sell_orders(state: Portfolio = None):
+    """
+    Generate sell orders of type specified by setting
+    'primary_sell_type'. Return list of sell orders and store in global
+    sell_orders
+
+    state -- portfolio with actual and target positions, defaults to
+             global portfolio
+    """
+
+    logging.info('Generating sell orders')
+
+    global sell_orders
+
+    global settings
+    r = settings['round_quantities_to']
+    primary_sell_type = settings['primary_sell_type']
+
+    if state is None:
+        state = portfolio
+
+    numbers = sell_quantities(state.column('Actual (cnt)'),
+                              state.column('Target (cnt)'),
+                              state.column('Actual (%)'),
+                              state.column('Target (%)'), r)
+    tickers = [state.tickers[row] for row in np.flatnonzero(numbers > 0)]
+    order_contracts = qualify_contracts(tickers)
+
+    for ticker, number in zip(tickers, numbers[numbers > 0]):
+        order = Order(action='SELL', orderType=primary_sell_type,
+                      totalQuantity=int(number),
+                      account=account_of(state))
+
+        sell_orders.append((order_contracts[ticker], order))
+
+    return sell_orders
+
+
+def trades_complete(trades: List[Trade]) -> bool:
+    """
+    Internal helper function.
+
+    Check if all trades in list are cokmplete. Return true or false
+
+    trades -- list of Trade objects
+    """
+
+    for trade in trades:
+        if not trade.isDone():
+            return False
+
+    return True
+
+
+def order_cutoff(wait_duration: str, wait_until: str,
+                 timezone: pytz.BaseTzInfo) -> datetime:
+    """
+    Internal helper function.
+
+    Return the time to stop waiting for orders submitted now. Defaults
+    to one day from now, or earlier if the wait duration or wait until
+    time come first.
+
+    wait_duration -- 'hh:mm' string or empty string
+    wait_until -- 'hh:mm' string or empty string
+    timezone -- timezone wait_until is in
+    """
+
+    submit_time = datetime.now(timezone)
+    cutoff = submit_time + timedelta(days=1)
+
+    # Modify cutoff time based on settings
+    if wait_duration:
+        hours, minutes = wait_duration.split(':')
+        hours, minutes = int(hours), int(minutes)
+        cutoff = submit_time + timedelta(hours=hours, minutes=minutes)
+
+    if wait_until:
+        hour, minute = wait_until.split(':')
+        hour, minute = int(hour), int(minute)
+        specified_time = datetime.now(timezone).replace(hour=hour,
+                                                        minute=minute)
+
+        if specified_time < cutoff:
+            cutoff = specified_time
+
+    return cutoff
+
+
+def log_fill(trade: Trade, fill: Fill):
+    """
+    Internal helper function.
+
+    Log a fill of a trade as soon as it comes in. Meant to be connected
+    to Trade.fillEvent
+    """
+
+    execution = fill.execution
+    logging.info(f'{execution.side} {execution.shares} shares of '
+                 f'{trade.contract.symbol} at {execution.price} '
+                 f'({trade.filled()}/{trade.order.totalQuantity} filled)')
+
+
+def wait_for_trades(trades: List[Trade], cutoff: datetime = None,
+                    reprice: bool = False) -> bool:
+    """
+    Wait until all trades are done or the cutoff time is reached,
+    whichever comes first. Return True if all trades are done.
+
+    Waiting is driven by the order status events of the trades, so this
+    wakes up as soon as the last trade completes without polling TWS.
+    Fills are logged as they happen and time to fill statistics are
+    logged at the end.
+
+    trades -- list of Trade objects
+    cutoff -- timezone aware time to stop waiting, None to wait forever
+    reprice -- walk the limit prices of LMT orders towards the touch
+               while waiting, see reprice_trades_async
+    """
+
+    return ib.run(wait_for_trades_async(trades, cutoff, reprice))
+
+
+async def wait_for_trades_async(trades: List[Trade], cutoff: datetime = None,
+                                reprice: bool = False) -> bool:
+    """
+    Coroutine version of wait_for_trades
+
+    trades -- list of Trade objects
+    cutoff -- timezone aware time to stop waiting, None to wait forever
+    reprice -- walk the limit prices of LMT orders towards the touch
+    """
+
+    done = asyncio.Event()
+    start = time.time()
+    fill_times = dict()
+
+    def on_status(trade: Trade):
+        if (trade.orderStatus.status == 'Filled'
+                and id(trade) not in fill_times):
+            fill_times[id(trade)] = time.time() - start
+
+        if trades_complete(trades):
+            done.set()
+
+    for trade in trades:
+        trade.statusEvent += on_status
+        trade.fillEvent += log_fill
+
+    timeout = None
+    if cutoff is not None:
+        timeout = max((cutoff - datetime.now(cutoff.tzinfo)).total_seconds(),
+                      0)
+
+    repricer = None
+    if reprice and settings.get('reprice_steps', 0) > 0:
+        repricer = asyncio.ensure_future(reprice_trades_async(
+            trades, settings['reprice_steps'],
+            settings.get('reprice_interval', 60)))
+
+    try:
+        if not trades_complete(trades):
+            await asyncio.wait_for(done.wait(), timeout)
+    except asyncio.TimeoutError:
+        pass
+    finally:
+        if repricer is not None:
+            repricer.cancel()
+
+        for trade in trades:
+            trade.statusEvent -= on_status
+            trade.fillEvent -= log_fill
+
+    if fill_times:
+        times = list(fill_times.values())
+        observe('fill_seconds', times)
+        logging.info(f'Time to fill {len(times)} orders: '
+                     f'mean {np.mean(times):.1f}s, '
+                     f'median {np.median(times):.1f}s, '
+                     f'max {np.max(times):.1f}s')
+
+    return trades_complete(trades)
+
+
+def limit_price(ticker: Ticker, action: str, step: int = 0,
+                steps: int = 1) -> float:
+    """
+    Internal helper function.
+
+    Return the limit price step out of steps of the way from the
+    midpoint to the touch (ask for buys, bid for sells), rounded to the
+    cent. Return NaN if the ticker has no usable bid and ask.
+
+    ticker -- Ticker object with a current quote
+    action -- 'BUY' or 'SELL'
+    step -- how many steps away from the midpoint
+    steps -- number of steps between the midpoint and the touch
+    """
+
+    bid, ask = ticker.bid, ticker.ask
+
+    if not (bid > 0 and ask >= bid):
+        return math.nan
+
+    mid = (bid + ask) / 2
+    touch = ask if action == 'BUY' else bid
+
+    return round(mid + (touch - mid) * step / steps, 2)
+
+
+def price_orders(orders: List[Tuple[Contract, Order]]):
+    """
+    Set the limit price of all LMT orders to the current midpoint, in
+    one batched quote request. Orders without a usable quote are priced
+    at their portfolio price.
+
+    orders -- list of (Contract, Order) tuples
+    """
+
+    limit_orders = [(c, o) for c, o in orders if o.orderType == 'LMT']
+
+    if not limit_orders:
+        return
+
+    tickers = schedule('market data',
+                       lambda: ib.reqTickersAsync(
+                           *[c for c, _ in limit_orders]),
+                       cost=len(limit_orders), priority=PRIORITY_QUOTES)
+
+    for (contract, order), ticker in zip(limit_orders, tickers):
+        price = limit_price(ticker, order.action)
+
+        if math.isnan(price):
+            price = round(portfolio.get('Price', contract.symbol), 2)
+
+        order.lmtPrice = price
+
+
+async def reprice_trades_async(trades: List[Trade], steps: int,
+                               interval: float):
+    """
+    Walk the limit prices of all open LMT trades from the midpoint to
+    the touch in steps, one step every interval seconds. Each step
+    requests quotes for all open trades at once and modifies the orders
+    in place instead of cancelling and resubmitting them. After the last
+    step orders are left at the touch.
+
+    trades -- list of Trade objects
+    steps -- number of steps between the midpoint and the touch
+    interval -- seconds between steps
+    """
+
+    for step in range(1, steps + 1):
+        await asyncio.sleep(interval)
+
+        open_trades = [t for t in trades
+                       if not t.isDone() and t.order.orderType == 'LMT']
+
+        if not open_trades:
+            return
+
+        tickers = await scheduler.request(
+            'market data',
+            lambda: ib.reqTickersAsync(*[t.contract for t in open_trades]),
+            cost=len(open_trades), priority=PRIORITY_QUOTES)
+
+        for trade, ticker in zip(open_trades, tickers):
+            price = limit_price(ticker, trade.order.action, step, steps)
+
+            if math.isnan(price) or price == trade.order.lmtPrice:
+                continue
+
+            logging.info(f'repricing {trade.order.action.lower()} order '
+                         f'for {trade.contract.symbol} to {price} '
+                         f'(step {step}/{steps})')
+
+            trade.order.lmtPrice = price
+            place_order(trade.contract, trade.order)
+
+
+def resubmit_trades(trades: List[Trade], action: str,
+                    order_type: str) -> List[Trade]:
+    """
+    Internal helper function.
+
+    Cancel all incomplete trades and resubmit their remaining quantity
+    as orders of another type. Cancelled trades are removed from trades
+    and the new ones appended. Return list of the new Trade objects.
+
+    trades -- list of Trade objects
+    action -- 'BUY' or 'SELL'
+    order_type -- order type of the new orders
+    """
+
+    incomplete_trades = [t for t in trades if not t.isDone()]
+
+    new_trades = list()
+
+    for trade in incomplete_trades:
+        contract = trade.contract
+        order = Order(action=action, orderType=order_type,
+                      totalQuantity=trade.remaining(),
+                      account=trade.order.account)
+
+        logging.info(f'resubmitting {action.lower()} order for '
+                     f'{contract.symbol}')
+
+        # Cancel incomplete oreders and remove them from trades
+        cancel_order(trade.order)
+        trades.remove(trade)
+
+        # Create new orders of auxiliary type
+        new_trade = place_order(contract, order)
+        new_trades.append(new_trade)
+        trades.append(new_trade)
+
+    return new_trades
+
+
+def execute_sell_orders():
+    """
+    Execute all sell orders in global sell_orders. Wait for one of the
+    followint conditions:
+    1) All trades completed successfully
+    2) Time specified by sell_wait_duration settings expires
+    3) Current time exceeds sell_wait_until setting
+
+    LMT orders are submitted at the midpoint and, if the reprice_steps
+    setting is set, walked towards the touch while waiting.
+
+    If all trades completed successfully return list of Trade objects.
+
+    If either time constraint exceeded, cancel all unfulfilled orders
+    and resubmit them as an order of the type specified by the
+    auxiliary_sell_type setting. Remove cancelled orders from global
+    sell_orders and replace them with the new orders. Wait until new
+    orders are complete (with no time constraint) and return list of
+    Trade objects
+
+    Open sell orders left by an interrupted run are taken over instead
+    of placed again, see reconcile_orders.
+    """
+
+    logging.info('Executing sell orders')
+
+    global sell_orders
+
+    global settings
+    auxiliary_sell_type = settings['auxiliary_sell_type']
+    timezone = pytz.timezone(settings['timezone'])
+    sell_wait_duration = settings['sell_wait_duration']
+    sell_wait_until = settings['sell_wait_until']
+
+    trades = reconcile_orders(sell_orders, 'SELL')
+
+    for order in sell_orders:
+        ticker = order[0].symbol
+        amount = order[1].totalQuantity
+        logging.info(f'selling {amount} shares of {ticker}')
+
+    price_orders(sell_orders)
+    trades += [place_order(*order) for order in sell_orders]
+
+    cutoff = order_cutoff(sell_wait_duration, sell_wait_until, timezone)
+
+    logging.info('Waiting until ' + str(cutoff))
+
+    # If cutoff time was reached and orders are still incomplete
+    if not wait_for_trades(trades, cutoff, reprice=True):
+        new_trades = resubmit_trades(trades, 'SELL', auxiliary_sell_type)
+
+        # Wait for new orders to complete
+        wait_for_trades(new_trades)
+
+    return trades
+
+
+def generate_buy_orders(state: Portfolio = None):
+    """
+    Generate buy orders of type specified by setting
+    'primary_buy_type'. Return list of buy orders and store in global
+    buy_orders
+
+    state -- portfolio with actual and target positions, defaults to
+             global portfolio
+    """
+
+    logging.info('Generating buy orders')
+
+    global buy_orders
+
+    global settings
+    r = settings['round_quantities_to']
+    primary_buy_type = settings['primary_buy_type']
+
+    if state is None:
+        state = portfolio
+
+    numbers = buy_quantities(state.column('Actual (cnt)'),
+                             state.column('Target (cnt)'),
+                             state.column('Actual (%)'),
+                             state.column('Target (%)'), r)
+    tickers = [state.tickers[row] for row in np.flatnonzero(numbers > 0)]
+    order_contracts = qualify_contracts(tickers)
+
+    for ticker, number in zip(tickers, numbers[numbers > 0]):
+        order = Order(action='BUY', orderType=primary_buy_type,
+                      totalQuantity=int(number),
+                      account=account_of(state))
+
+        buy_orders.append((order_contracts[ticker], order))
+
+    return buy_orders
+
+
+def execute_buy_orders():
+    """
+    Execute all sell orders in global buy_orders. Wait for one of the
+    following conditions:
+    1) All trades completed successfully
+    2) Time specified by buy_wait_duration setting expires
+    3) Current time exceeds buy_wait_until setting
+
+    LMT orders are submitted at the midpoint and, if the reprice_steps
+    setting is set, walked towards the touch while waiting.
+
+    If all trades completed successfully return list of Trade objects.
+
+    If either time constraint exceeded, cancel all unfulfilled orders
+    and resubmit them as an order of the type specified by the
+    auxiliary_buy_type setting. Remove cancelled orders from global
+    buy_orders and replace them with the new orders. Wait until new
+    orders are complete (with no time constraint) and return list of
+    Trade objects
+
+    Open buy orders left by an interrupted run are taken over instead
+    of placed again, see reconcile_orders.
+    """
+    global buy_orders
+
+    global settings
+    auxiliary_buy_type = settings['auxiliary_buy_type']
+    timezone = pytz.timezone(settings['timezone'])
+    buy_wait_duration = settings['buy_wait_duration']
+    buy_wait_until = settings['buy_wait_until']
+
+    trades = reconcile_orders(buy_orders, 'BUY')
+
+    for order in buy_orders:
+        ticker = order[0].symbol
+        amount = order[1].totalQuantity
+        logging.info(f'buying {amount} shares of {ticker}')
+
+    price_orders(buy_orders)
+    trades += [place_order(*order) for order in buy_orders]
+
+    cutoff = order_cutoff(buy_wait_duration, buy_wait_until, timezone)
+
+    logging.info('Waiting until ' + str(cutoff))
+
+    if not wait_for_trades(trades, cutoff, reprice=True):
+        resubmit_trades(trades, 'BUY', auxiliary_buy_type)
+
+    return trades
+
+
+def execute_pipelined(funds: Dict[str, float] = None,
+                      deficits: Dict[Tuple[str, str], float] = None):
+    """
+    Execute sell and buy orders in one go. Buy orders are generated up
+    front and ordered by how far each ticker is below its target (USD).
+    They are submitted, in that order, as soon as there is cash for
+    them: first out of available funds, then out of the proceeds of each
+    sell fill as it comes in, so a slow sell order only holds back the
+    buys it is paying for. Cash is kept per account, so the sells of one
+    account only pay for the buys of the same account.
+
+    To avoid overspending buying power every buy is estimated at its
+    portfolio price plus buying_power_buffer percent. Buys that still do
+    not fit once all sells are done are cut down to what the remaining
+    cash allows (rounded down to round_quantities_to) or dropped.
+
+    Sell orders are executed the same as execute_sell_orders and buy
+    orders are waited on and resubmitted the same as execute_buy_orders.
+    Open buy orders left by an interrupted run are waited on with the
+    new ones, their cost is already out of the available funds.
+    Return list of buy Trade objects.
+
+    funds -- dict of accounts mapped to their available funds (USD),
+             None to generate the buy orders of the global portfolio
+             and use its available funds
+    deficits -- dict of (account, ticker symbol) tuples mapped to how
+                far the ticker is below its target in the account (USD),
+                needed if funds is given
+    """
+
+    logging.info('Executing orders pipelined')
+
+    global settings
+    r = settings['round_quantities_to']
+    buffer = 1 + settings.get('buying_power_buffer', 2) / 100
+    timezone = pytz.timezone(settings['timezone'])
+
+    if funds is None:
+        generate_buy_orders()
 
-    ticker_series = sheet_data.iloc[:, 0].dropna()
+        funds = {account_of(portfolio): portfolio.funds}
+        deficits = account_deficits(portfolio)
 
-    tickers = set(ticker_series)
+    open_buys = reconcile_orders(buy_orders, 'BUY')
 
-    # If tickers are not in portfolio, add them
-    global portfolio
-    missing_tickers = list(tickers - set(portfolio.index))
-    portfolio = portfolio.reindex(portfolio.index.union(missing_tickers))
+    pending = sorted(buy_orders,
+                     key=lambda o: deficits[(o[1].account, o[0].symbol)],
+                     reverse=True)
+    price_orders(pending)
 
-    logging.info(f'Ticker list: {tickers}')
+    cash = dict(funds)
+    buy_trades = list(open_buys)
 
-    # Generate all contracts
-    global contracts
-    for ticker in tickers:
-        contract = Stock(ticker, 'SMART', 'USD')
-        ib.qualifyContracts(contract)
-        contracts[ticker] = contract
+    def submit_buys(final: bool = False):
+        # An account waits for cash from its first order that does not
+        # fit, its later orders are not submitted ahead of it
+        waiting = set()
+        remaining = list()
 
-    return tickers
+        for contract, order in pending:
+            account = order.account
+            price = portfolio.get('Price', contract.symbol) * buffer
 
+            if account in waiting:
+                remaining.append((contract, order))
+                continue
 
-def get_historical_data(cont: Dict[str, Contract] = None) -> pd.DataFrame:
-    """
-    Get weekly historical data for all contracts going back 53 weeks.
+            if order.totalQuantity * price > cash[account]:
+                if not final:
+                    waiting.add(account)
+                    remaining.append((contract, order))
+                    continue
 
-    Sore result in DataFrame which is returned and stored in global
-    historical_data. The index of this dataframe is a string
-    representation of a datetime.date object, the column names are the
-    ticker symbols and the data is the close value of the ticker as a
-    float.
+                # Last chance, buy what the remaining cash allows
+                number = cash[account] // price
+                order.totalQuantity = int(number - (number % r))
 
-    cont -- dict of ticker symbols mapped to their contract objects
-    """
+            if order.totalQuantity <= 0:
+                logging.info(f'not enough cash to buy {contract.symbol}')
+                continue
 
-    if cont is None:
-        global contracts
-    else:
-        contracts = cont
+            cash[account] -= order.totalQuantity * price
 
-    global historical_data
+            logging.info(f'buying {order.totalQuantity} shares of '
+                         f'{contract.symbol}')
+            buy_trades.append(place_order(contract, order))
 
-    logging.info('getting historical data')
+        pending[:] = remaining
 
-    start = time.time()
+    def on_execution(trade: Trade, fill: Fill):
+        if trade.order.action == 'SELL' and trade.order.account in cash:
+            cash[trade.order.account] += (fill.execution.shares
+                                          * fill.execution.price)
+            submit_buys()
 
-    data_pull = pd.DataFrame()
+    submit_buys()
 
-    # Get historical data from ib api
-    # There's room for optimization here. We need 53 weeks of data but
-    # all duration strings greater than a year must be defined in terms
-    # of years. A '1 Y' durationStr only gives 52 weeks of data not the
-    # needed 53, so we request '2 Y' of data and trim what we don't
-    # need. If execution time is ever an issue this could be optimized
-    # by requesting first '1 Y' of data then '1 W' of data seperately
-    for ticker in contracts.keys():
-        bars = ib.reqHistoricalData(
-            contract=contracts[ticker],
-            endDateTime='',
-            durationStr='2 Y',
-            barSizeSetting='1 day',
-            whatToShow='ADJUSTED_LAST',
-            useRTH=True
-        )
-
-        for bar in bars:
-            data_pull.loc[bar.date, ticker] = bar.close
+    ib.execDetailsEvent += on_execution
+    try:
+        execute_sell_orders()
+    finally:
+        ib.execDetailsEvent -= on_execution
 
-    end = time.time()
-    logging.info(f'Data pull took {end-start} seconds')
+    submit_buys(final=True)
 
-    cur_weekday = data_pull.index[-1].weekday()  # last weekday in datapull
-    weekday_dates = list(filter(lambda d: d.weekday() ==
-                                cur_weekday, data_pull.index))[-53:]
-    historical_data = data_pull.loc[weekday_dates]
+    cutoff = order_cutoff(settings['buy_wait_duration'],
+                          settings['buy_wait_until'], timezone)
 
-    for ticker, data in historical_data.items():
-        for date, value in data.items():
-            while math.isnan(value):
-                previous_date = date - timedelta(days=1)
-                try:
-                    value = data_pull[ticker][previous_date]
-                except KeyError:
-                    next_date = date + timedelta(days=1)
-                    value = data_pull[ticker][next_date]
+    logging.info('Waiting until ' + str(cutoff))
 
-                historical_data[ticker][date] = value
+    if not wait_for_trades(buy_trades, cutoff, reprice=True):
+        resubmit_trades(buy_trades, 'BUY', settings['auxiliary_buy_type'])
 
-    return historical_data
+    return buy_trades
 
 
-def sharpe_single(ticker_change: pd.Series, weeks: int = 52) -> float:
+def rebalance_accounts() -> List[str]:
     """
-    Get the sharpe ratio of a single ticker going over a certain number
-    of weeks
-
-    ticker_change -- a Series object containting change percentages
-    weeks -- number of weeks to take into account, most recent weeks
-             will be uesed
+    Return list of the accounts to rebalance from the TWS_accounts
+    setting, all managed accounts if it is ['*']. Empty list if only
+    TWS_account is rebalanced.
     """
 
-    total_weeks = len(ticker_change.index)
-    change = ticker_change[total_weeks-weeks: total_weeks]
-
-    average = change.mean(skipna=True)
+    accounts = settings.get('TWS_accounts', [])
 
-    standard_deviation = change.std(skipna=True, ddof=0)
+    if accounts == ['*']:
+        accounts = ib.managedAccounts()
 
-    return average / standard_deviation
+    return list(accounts)
 
 
-def sharpe_ratios(weekly_data: pd.DataFrame = None) -> Dict[str, float]:
+def account_deficits(state: Portfolio) -> Dict[Tuple[str, str], float]:
     """
-    Calculate average sharpe ratio for each ticker.
+    Internal helper function.
 
-    Average sharpe ratio is the averege of sharpe ratios calculated over
-    52, 26 and 13 weeks. Results will also be stored in global portfolio.
-    Return dict of ticker symbols mapped to average sharpe values.
+    Return dict of (account, ticker symbol) tuples mapped to how far each
+    ticker of a portfolio is below its target (USD).
 
-    weekly_data -- A pandas dataframe following the same format as
-                   global historical data
+    state -- portfolio with actual and target positions
     """
 
-    if weekly_data is None:
-        global historical_data
-        weekly_data = historical_data
-
-    weekly_change = weekly_data.pct_change()
-
-    tickers = set(weekly_change.columns)
+    account = account_of(state)
+    deficit = state.column('Target ($)') - state.column('Actual ($)')
 
-    sharpes = dict()
+    return {(account, ticker): value
+            for ticker, value in zip(state.tickers, deficit.tolist())}
 
-    # if tickers are not in portfolio, add them
-    global portfolio
-    missing_tickers = list(tickers - set(portfolio.index))
-    portfolio = portfolio.reindex(portfolio.index.union(missing_tickers))
 
-    for ticker in tickers:
-        ticker_change = weekly_change[ticker]
+def account_orders(account: str, shared: Portfolio) -> Portfolio:
+    """
+    Run actual_portfolio, target_portfolio and order generation for one
+    account on its own copy of the portfolio. Return the account's
+    portfolio, the orders for the account are appended to global
+    sell_orders and buy_orders.
 
-        # Calculate sharpe ratios for ticker
-        sharpe_52 = sharpe_single(ticker_change, 52)
-        sharpe_26 = sharpe_single(ticker_change, 26)
-        sharpe_13 = sharpe_single(ticker_change, 13)
+    account -- account id
+    shared -- portfolio with the sharpe ratios and prices of the universe
+    """
 
-        average = (sharpe_52 + sharpe_26 + sharpe_13) / 3
-        adjusted = average ** 1.5 if average > 0.2 else 0
+    logging.info(f'Rebalancing account {account}')
 
-        sharpes[ticker] = average
+    state = shared.copy()
+    state.account = account
 
-        # Update portfolio
-        portfolio.loc[ticker]['Sharpe (unadjusted)'] = average
-        portfolio.loc[ticker]['Sharpe (adjusted)'] = adjusted
+    actual_portfolio(state)
+    target_portfolio(state)
+    generate_sell_orders(state)
+    generate_buy_orders(state)
 
-    return sharpes
+    return state
 
 
-def get_prices(cont: Dict[str, Contract] = None) -> Dict[str, float]:
+def rebalance_many(accounts: List[str]):
     """
-    Get current price of each ticker. Return set of ticker symbols
-    mapped to a float value (USD). Results will also be stored in global
-    portfolio.
-
-    symbols -- set of ticker symbols
+    Rebalance several accounts over one connection. The universe
+    analysis (history, sharpe ratios, prices) in the global portfolio is
+    shared, only the positions, targets and orders are worked out per
+    account with account_orders. Account values and positions of all
+    managed accounts are kept up to date by ib_insync, so this costs no
+    requests per account.
+
+    The orders of all accounts are then executed together, as one batch
+    of sells and one batch of buys (or one pipeline), so accounts do not
+    wait on each other's fills. Each account's portfolio is kept in
+    global account_portfolios.
+
+    accounts -- list of account ids
     """
-    if cont is None:
-        global contracts
-    else:
-        contracts = cont
-
-    logging.info('Requesting current ticker prices')
 
     global portfolio
-    prices = dict()
+    global sell_orders
+    global buy_orders
 
-    ib.reqTickers(*list(contracts.values()))
+    shared = portfolio.copy()
+    sell_orders = list()
+    buy_orders = list()
 
-    for symbol, contract in contracts.items():
-        ticker = ib.ticker(contract)
+    account_portfolios.clear()
 
-        portfolio.loc[symbol, 'Price'] = ticker.close
-        prices[symbol] = ticker.close
+    with stage('accounts'):
+        for account in accounts:
+            account_portfolios[account] = account_orders(account, shared)
 
-    return prices
+        count('accounts', len(accounts))
 
+    # Orders are priced from the quotes of the universe, and tickers that
+    # are only held fall back to an account's price of them
+    portfolio = shared.copy()
+    for state in account_portfolios.values():
+        held = [t for t in state.tickers if t not in portfolio]
+        portfolio.set('Price', held, [state.get('Price', t) for t in held])
 
-def actual_portfolio():
-    """
-    Get data on actual positions from TWS, store in portfolio dataframe
-    """
+    if settings.get('pipelined_execution', False):
+        funds = {account: state.funds
+                 for account, state in account_portfolios.items()}
+        deficits = dict()
+        for state in account_portfolios.values():
+            deficits.update(account_deficits(state))
 
-    logging.info('Requesting current portfolio details')
+        with stage('pipelined execution'):
+            execute_pipelined(funds, deficits)
+    else:
+        with stage('execute sell orders'):
+            execute_sell_orders()
+        with stage('execute buy orders'):
+            execute_buy_orders()
 
-    # if account not set, pick active account
-    global settings
-    account = settings['TWS_account']
 
-    if not account:
-        account_value = [v for v in ib.accountValues()
-                         if v.tag == 'NetLiquidation'][0]
-        account = account_value.account
-    else:
-        account_value = [v for v in ib.accountValues(account)
-                         if v.tag is 'NetLiquidation'][0]
+async def run_stages_async(stages: Dict[str, Tuple[object, List[str]]]):
+    """
+    Run stages as soon as the stages they need are done, each measured
+    with stage(). A stage is a function without arguments. Coroutine
+    functions overlap with all other stages in flight, plain functions
+    run on the event loop as soon as their inputs are ready and hold up
+    the other stages only while they compute. If a stage fails, the
+    stages still running are cancelled and its exception is raised.
+
+    stages -- dict of stage names mapped to tuples of (function, list of
+              names of the stages it needs)
+    """
 
-    global portfolio_value
-    portfolio_value = float(account_value.value)
+    # Catch unknown and circular dependencies before starting anything
+    ready = set()
+    while len(ready) < len(stages):
+        runnable = [name for name, (_, needs) in stages.items()
+                    if name not in ready and set(needs) <= ready]
+        if not runnable:
+            raise ValueError(f'Stages {sorted(set(stages) - ready)} need '
+                             f'stages that can never run')
+        ready.update(runnable)
 
-    global contracts
-    global portfolio
+    tasks = dict()
 
-    for position in ib.positions(account):
-        ticker = position.contract.symbol
-        count = position.position
-        price = position.avgCost
-        value = price * count
+    async def run_stage(name: str):
+        function, needs = stages[name]
 
-        if ticker not in portfolio.index:
-            portfolio.loc[ticker] = None
+        if needs:
+            await asyncio.gather(*[tasks[need] for need in needs])
 
-        contracts[ticker] = position.contract
-        portfolio.loc[ticker]['Actual (cnt)'] = round(count, 2)
-        portfolio.loc[ticker]['Price'] = price
-        portfolio.loc[ticker]['Actual ($)'] = round(value, 2)
-        portfolio.loc[ticker]['Actual (%)'] = (value / portfolio_value) * 100
+        with stage(name):
+            result = function()
+            if asyncio.iscoroutine(result):
+                await result
 
-    # Fill blank values with zeros
-    portfolio['Actual (cnt)'].fillna(0, inplace=True)
-    portfolio['Actual ($)'].fillna(0, inplace=True)
-    portfolio['Actual (%)'].fillna(0, inplace=True)
+    for name in stages:
+        tasks[name] = asyncio.ensure_future(run_stage(name))
+
+    try:
+        await asyncio.gather(*tasks.values())
+    finally:
+        for task in tasks.values():
+            task.cancel()
 
 
-def target_portfolio():
-    """
-    Calculate target portfolio, store in portfolio dataframe
+def analysis_stages(
+        single_account: bool = True) -> Dict[str, Tuple[object, List[str]]]:
     """
+    Return the analysis stages of a rebalance for run_stages_async.
 
-    logging.info('Generating target portfolio')
+    History and quotes are requested at the same time, sharpe ratios
+    are calculated as soon as the history is in and prices are picked
+    once both are (missing quotes fall back to the last close). The
+    account is read after prices because actual_portfolio prices held
+    tickers at their average cost, and the target needs both.
 
-    # Sort portfolio by sharpe ratio
-    global portfolio
-    portfolio = portfolio.sort_values(by=['Sharpe (unadjusted)'],
-                                      ascending=False)
+    single_account -- include the account and target stages, leave them
+                      out for rebalance_many
+    """
 
-    # Adjust sharpe ratio to zero for tickers that will not be used
-    # (only leave max number of top tickers)
-    global settings
-    max_size = settings['max_portfolio_size']
-    portfolio.iloc[max_size:, 2] = 0
+    quotes = dict()
 
-    sum_sharpe = portfolio.loc[:, 'Sharpe (adjusted)'].sum()
+    async def request_quotes():
+        logging.info('Requesting current ticker prices')
 
-    global portfolio_value
+        deadline = settings.get('price_timeout', 10)
+        tickers = await snapshot_async(list(contracts.values()), deadline)
+        quotes.update(zip(contracts.keys(), tickers))
 
-    # If target is over 25%, store here by how much
-    target_excess = 0
+    stages = {
+        'history': (get_historical_data_async, []),
+        'quotes': (request_quotes, []),
+        'sharpe': (sharpe_ratios, ['history']),
+        'prices': (lambda: store_prices(quotes), ['quotes', 'history']),
+    }
 
-    # Populate portfolio dataframe
-    for ticker, row in portfolio.iterrows():
-        target_percentage = row['Sharpe (adjusted)'] / sum_sharpe
-        target_percentage = target_percentage + target_excess
+    if single_account:
+        stages['account'] = (actual_portfolio, ['prices'])
+        stages['target'] = (target_portfolio, ['sharpe', 'account'])
 
-        if target_percentage > 25:
-            target_excess = target_percentage - 25
-            target_percentage = 25
+    return stages
 
-        target_value = target_percentage * portfolio_value
-        if row['Price']:
-            target_cnt = target_value / row['Price']
-        else:
-            logging.error(f'{ticker} excluded from target portfolio')
-            target_cnt = None
 
-        portfolio.loc[ticker, 'Target (%)'] = target_percentage * 100
-        portfolio.loc[ticker, 'Target ($)'] = target_value
-        portfolio.loc[ticker, 'Target (cnt)'] = target_cnt
+def start_journal(tickers: Set[str], path: str = None) -> bool:
+    """
+    Start the run journal of a rebalance, kept in the journal and
+    journal_trades tables of the cache. The last run is resumed if it
+    did not finish, started less than journal_max_age_minutes ago and
+    has the same tickers, its checkpoints are loaded into global
+    journal_stages and its trades into global journal_trades. Otherwise
+    a new run is started and older journals are dropped. Return True if
+    resuming.
 
-    logging.info(f'Total portfolio value: {portfolio_value}')
-    logging.info('Portfolio:\n' + str(portfolio))
+    The journal keeps one connection to the cache open until
+    close_journal or the next start_journal.
 
+    Does nothing if the run_journal setting is off.
 
-def generate_sell_orders():
-    """
-    Generate sell orders of type specified by setting
-    'primary_sell_type'. Return list of sell orders and store in global
-    sell_orders
+    tickers -- set of ticker symbols of the rebalance
+    path -- path to the sqlite database file, None for global cache_path
     """
 
-    logging.info('Generating sell orders')
+    global journal_run
+    global journal_connection
+    global journal_stages
+    global journal_trades
 
-    global sell_orders
+    close_journal()
 
-    global settings
-    r = settings['round_quantities_to']
-    primary_sell_type = settings['primary_sell_type']
+    journal_stages = dict()
+    journal_trades = dict()
 
-    for ticker, row in portfolio.iterrows():
+    if not settings.get('run_journal', True):
+        return False
 
-        # Only generate sell order if difference between actual and
-        # target portfolio is more than 2%
-        if row['Actual (%)'] - row['Target (%)'] > 2:
-            contract = Stock(ticker, 'SMART', 'USD')
-            ib.qualifyContracts(contract)
+    connection = open_cache(path)
 
-            if row['Target (cnt)'] == 0:
-                number = row['Actual (cnt)']
-            else:
-                number = row['Actual (cnt)'] - row['Target (cnt)']
-                number = number + (r - (number % r))  # Round up
+    runs = dict()
+    for run, name, data in connection.execute(
+            'SELECT run, stage, data FROM journal'):
+        runs.setdefault(run, dict())[name] = json.loads(data)
 
-            # If we want to sell all of the  holdings
-            if number > row['Actual (cnt)']:
-                number = row['Actual (cnt)']
+    last = runs[max(runs)] if runs else dict()
+    max_age = timedelta(minutes=settings.get('journal_max_age_minutes', 120))
 
-            order = Order(action='SELL', orderType=primary_sell_type,
-                          totalQuantity=int(number))
+    if ('run' in last and 'done' not in last
+            and last['run']['tickers'] == sorted(tickers)
+            and datetime.now()
+            - datetime.fromisoformat(last['run']['started']) < max_age):
+        journal_run = max(runs)
+        journal_connection = connection
+        journal_stages = last
+        journal_trades = {str(order_id): json.loads(data)
+                          for order_id, data in connection.execute(
+                              'SELECT orderId, data FROM journal_trades '
+                              'WHERE run = ?', (journal_run,))}
 
-            sell_orders.append((contract, order))
+        done = [name for name in last if name != 'run']
+        logging.info(f'Resuming {journal_run}, done: {done}')
+        return True
 
-    return sell_orders
+    connection.execute('DELETE FROM journal')
+    connection.execute('DELETE FROM journal_trades')
+    connection.commit()
 
+    started = datetime.now().isoformat(timespec='seconds')
+    journal_run = f'AutoBroker {started}'
+    journal_connection = connection
+    checkpoint('run', {'started': started, 'tickers': sorted(tickers)})
 
-def trades_complete(trades: List[Trade]) -> bool:
-    """
-    Internal helper function.
+    return False
 
-    Check if all trades in list are cokmplete. Return true or false
 
-    trades -- list of Trade objects
+def close_journal():
+    """
+    Stop journaling and close the connection of the run journal. Does
+    nothing if no run is journaled.
     """
 
-    for trade in trades:
-        if not trade.isDone():
-            return False
-
-    return True
+    global journal_run
+    global journal_connection
 
+    journal_run = ''
 
-def execute_sell_orders():
-    """
-    Execute all sell orders in global sell_orders. Wait for one of the
-    followint conditions:
-    1) All trades completed successfully
-    2) Time specified by sell_wait_duration settings expires
-    3) Current time exceeds sell_wait_until setting
+    if journal_connection is not None:
+        journal_connection.commit()
+        journal_connection.close()
+        journal_connection = None
 
-    If all trades completed successfully return list of Trade objects.
 
-    If either time constraint exceeded, cancel all unfulfilled orders
-    and resubmit them as an order of the type specified by the
-    auxiliary_sell_type setting. Remove cancelled orders from global
-    sell_orders and replace them with the new orders. Wait until new
-    orders are complete (with no time constraint) and return list of
-    Trade objects
+def checkpoint(name: str, data):
     """
+    Write the output of a stage to the run journal, replacing what was
+    written for it before. Does nothing if no run is journaled.
 
-    logging.info('Executing sell orders')
-
-    global sell_orders
-
-    global settings
-    auxiliary_sell_type = settings['auxiliary_sell_type']
-    timezone = pytz.timezone(settings['timezone'])
-    sell_wait_duration = settings['sell_wait_duration']
-    sell_wait_until = settings['sell_wait_until']
+    name -- stage name
+    data -- json serializable output of the stage
+    """
 
-    for order in sell_orders:
-        ticker = order[0].symbol
-        amount = order[1].totalQuantity
-        logging.info(f'selling {amount} shares of {ticker}')
+    if not journal_run:
+        return
 
-    trades = [ib.placeOrder(*order) for order in sell_orders]
+    journal_stages[name] = data
 
-    submit_time = datetime.now(timezone)
-    cutoff = submit_time + timedelta(days=1)
+    journal_connection.execute(
+        'INSERT OR REPLACE INTO journal VALUES (?, ?, ?, ?)',
+        (journal_run, name, json.dumps(data),
+         datetime.now().isoformat(timespec='seconds')))
+    journal_connection.commit()
 
-    # Modify cutoff time based on settings
-    if sell_wait_duration:
-        hours, minutes = sell_wait_duration.split(':')
-        hours, minutes = int(hours), int(minutes)
-        cutoff = submit_time + timedelta(hours=hours, minutes=minutes)
 
-    if sell_wait_until:
-        hour, minute = sell_wait_until.split(':')
-        hour, minute = int(hour), int(minute)
-        specified_time = datetime.now(timezone).replace(hour=hour,
-                                                        minute=minute)
+def journal_trade(trade: Trade):
+    """
+    Internal helper function.
 
-        if specified_time < cutoff:
-            cutoff = specified_time
+    Record the ids and fill state of a trade of the journaled run in the
+    run journal, and keep recording them on every status change. Only
+    the row of the trade is written, and only if its state changed.
+    """
 
-    logging.info('Waiting until ' + str(cutoff))
+    if not journal_run or trade.order.orderRef != journal_run:
+        return
 
-    status = 'WAIT'  # Status can be 'WAIT', 'COMPLETE' or 'REVISE'
+    if journal_trade not in trade.statusEvent:
+        trade.statusEvent += journal_trade
 
-    while status == 'WAIT':
-        ib.reqAllOpenOrders()
+    record = {
+        'orderId': trade.order.orderId, 'permId': trade.order.permId,
+        'symbol': trade.contract.symbol, 'action': trade.order.action,
+        'account': trade.order.account, 'orderType': trade.order.orderType,
+        'quantity': trade.order.totalQuantity, 'filled': trade.filled(),
+        'status': trade.orderStatus.status}
 
-        if trades_complete(trades):
-            status = 'COMPLETE'
-            break
+    if journal_trades.get(str(trade.order.orderId)) == record:
+        return
 
-        if datetime.now(timezone) >= cutoff:
-            status = 'REVISE'
-            break
+    journal_trades[str(trade.order.orderId)] = record
 
-        time.sleep(.5)
+    journal_connection.execute(
+        'INSERT OR REPLACE INTO journal_trades VALUES (?, ?, ?)',
+        (journal_run, trade.order.orderId, json.dumps(record)))
+    journal_connection.commit()
 
-    # If cutoff time was reached and orders are still incomplete
-    if status == 'REVISE':
-        incomplete_trades = [t for t in trades if not t.isDone()]
 
-        new_trades = list()
+def reconcile_orders(orders: List[Tuple[Contract, Order]],
+                     action: str) -> List[Trade]:
+    """
+    Internal helper function.
 
-        for trade in incomplete_trades:
-            contract = trade.contract
-            order = Order(action='SELL', orderType=auxiliary_sell_type,
-                          totalQuantity=trade.remaining())
+    Take over the open trades of the journaled run with action, eg. the
+    ones left by a run that was interrupted, instead of placing orders
+    on top of them. The quantity they still have to fill is taken off
+    the orders for the same ticker, orders with nothing left are removed
+    from orders. Return list of the open Trade objects.
 
-            logging.info(f'resubmitting sell order for {contract.symbol}')
+    orders -- list of (Contract, Order) tuples, changed in place
+    action -- 'BUY' or 'SELL'
+    """
 
-            # Cancel incomplete oreders and remove them from trades
-            ib.cancelOrder(trade.order)
-            trades.remove(trade)
+    if not journal_run:
+        return list()
 
-            # Create new orders of auxiliary sell type
-            new_trade = ib.placeOrder(contract, order)
-            new_trades.append(new_trade)
-            trades.append(new_trade)
+    trades = [trade for trade in ib.openTrades()
+              if trade.order.orderRef == journal_run
+              and trade.order.action == action]
 
-        status = 'WAIT'
+    for contract, order in list(orders):
+        remaining = sum(
+            trade.remaining() for trade in trades
+            if trade.contract.symbol == contract.symbol
+            and (not order.account or not trade.order.account
+                 or trade.order.account == order.account))
 
-    # Wait for new orders to complete
-    while status == 'WAIT':
-        ib.reqAllOpenOrders()
+        order.totalQuantity = int(order.totalQuantity - remaining)
 
-        if trades_complete(new_trades):
-            status = 'COMPLETE'
-            break
+        if order.totalQuantity <= 0:
+            orders.remove((contract, order))
 
-        time.sleep(.5)
+    for trade in trades:
+        logging.info(f'resuming {action.lower()} order for '
+                     f'{trade.remaining()} shares of {trade.contract.symbol}')
+        journal_trade(trade)
 
     return trades
 
 
-def generate_buy_orders():
-    """
-    Generate buy orders of type specified by setting
-    'primary_buy_type'. Return list of buy orders and store in global
-    buy_orders
+def journaled_stages(
+        stages: Dict[str, Tuple[object, List[str]]]
+) -> Dict[str, Tuple[object, List[str]]]:
     """
+    Return stages for run_stages_async with the stages in JOURNAL_STAGES
+    checkpointed when they are done, or restored from the run journal
+    if the resumed run got past them. Quotes are not requested again if
+    the prices are restored.
 
-    logging.info('Generating buy orders')
+    stages -- dict of stage names mapped to tuples of (function, list of
+              names of the stages it needs)
+    """
 
-    global buy_orders
+    def restore(name: str):
+        global historical_data
 
-    global settings
-    r = settings['round_quantities_to']
-    primary_buy_type = settings['primary_buy_type']
+        logging.info(f'Restoring {name} from run journal')
+        data = journal_stages[name]
 
-    for ticker, row in portfolio.iterrows():
-        if row['Target (%)'] - row['Actual (%)'] > 2:
-            contract = Stock(ticker, 'SMART', 'USD')
-            ib.qualifyContracts(contract)
+        if JOURNAL_STAGES[name] is None:
+            historical_data = pd.DataFrame(
+                data['data'], columns=data['columns'], dtype=float,
+                index=[date.fromisoformat(day) for day in data['index']])
+        else:
+            portfolio.update(data)
+
+        if name == 'target':
+            portfolio.sort('Sharpe (unadjusted)')
+
+    def checkpointed(name: str, function):
+        async def run_and_checkpoint():
+            result = function()
+            if asyncio.iscoroutine(result):
+                await result
+
+            if JOURNAL_STAGES[name] is None:
+                checkpoint(name, {
+                    'index': [day.isoformat()
+                              for day in historical_data.index],
+                    'columns': list(historical_data.columns),
+                    'data': historical_data.to_numpy().tolist()})
+            else:
+                checkpoint(name, portfolio.to_dict(JOURNAL_STAGES[name]))
 
-            number = row['Target (cnt)'] - row['Actual (cnt)']
-            number = number - (number % r)  # Round down
+        return run_and_checkpoint
 
-            order = Order(action='BUY', orderType=primary_buy_type,
-                          totalQuantity=int(number))
+    result = dict(stages)
 
-            buy_orders.append((contract, order))
+    for name, (function, needs) in stages.items():
+        if name not in JOURNAL_STAGES or not journal_run:
+            continue
 
-    return buy_orders
+        if name in journal_stages:
+            result[name] = (lambda name=name: restore(name), needs)
+        else:
+            result[name] = (checkpointed(name, function), needs)
 
+    if 'prices' in journal_stages and 'quotes' in stages:
+        result['quotes'] = (lambda: None, list())
 
-def execute_buy_orders():
-    """
-    Execute all sell orders in global buy_orders. Wait for one of the
-    following conditions:
-    1) All trades completed successfully
-    2) Time specified by buy_wait_duration setting expires
-    3) Current time exceeds buy_wait_until setting
+    return result
 
-    If all trades completed successfully return list of Trade objects.
 
-    If either time constraint exceeded, cancel all unfulfilled orders
-    and resubmit them as an order of the type specified by the
-    auxiliary_buy_type setting. Remove cancelled orders from global
-    buy_orders and replace them with the new orders. Wait until new
-    orders are complete (with no time constraint) and return list of
-    Trade objects
+def reset_state():
+    """
+    Clear the portfolio, contracts and orders of a previous rebalance in
+    the same process. Qualified contracts, cached bars and sharpe state
+    are kept.
     """
-    global buy_orders
-
-    global settings
-    auxiliary_buy_type = settings['auxiliary_buy_type']
-    timezone = pytz.timezone(settings['timezone'])
-    buy_wait_duration = settings['buy_wait_duration']
-    buy_wait_until = settings['buy_wait_until']
-
-    for order in buy_orders:
-        ticker = order[0].symbol
-        amount = order[1].totalQuantity
-        logging.info(f'buying {amount} shares of {ticker}')
-
-    trades = [ib.placeOrder(*order) for order in buy_orders]
 
-    submit_time = datetime.now(timezone)
-    cutoff = submit_time + timedelta(days=1)
+    global portfolio
+    global contracts
+    global sell_orders
+    global buy_orders
 
-    if buy_wait_duration:
-        hours, minutes = buy_wait_duration.split(':')
-        hours, minutes = int(hours), int(minutes)
-        cutoff = submit_time + timedelta(hours=hours, minutes=minutes)
+    portfolio = Portfolio()
+    contracts = dict()
+    sell_orders = list()
+    buy_orders = list()
+    account_portfolios.clear()
 
-    if buy_wait_until:
-        hour, minute = buy_wait_until.split(':')
-        hour, minute = int(hour), int(minute)
-        specified_time = datetime.now(timezone).replace(hour=hour,
-                                                        minute=minute)
 
-        if specified_time < cutoff:
-            cutoff = specified_time
+def rebalance(tickers: Set[str] = None):
+    """
+    Perform one rebalance over an open connection, from reading the
+    ticker list to executing orders. Each step is a stage of global
+    timeline.
 
-    logging.info('Waiting until ' + str(cutoff))
+    The rebalance is journaled, see start_journal. If the last one was
+    interrupted it is resumed: analysis stages it finished are restored
+    from the journal, the account is read again and its open orders are
+    taken over, so only what is still missing is ordered.
 
-    ib.openTrades()
+    tickers -- set of ticker symbols, None to read them from the ticker
+               sheet
+    """
 
-    status = 'WAIT'  # Status can be 'WAIT', 'COMPLETE' or 'REVISE'
+    reset_state()
 
-    while status == 'WAIT':
-        ib.reqAllOpenOrders()
+    with stage('tickers'):
+        if tickers is None:
+            tickers = get_tickers()
+        else:
+            set_tickers(tickers)
 
-        if trades_complete(trades):
-            status = 'COMPLETE'
-            break
+    start_journal(tickers)
 
-        if datetime.now(timezone) >= cutoff:
-            status = 'REVISE'
-            break
+    accounts = rebalance_accounts()
 
-        time.sleep(.5)
+    start = time.time()
+    ib.run(run_stages_async(journaled_stages(
+        analysis_stages(single_account=not accounts))))
 
-    if status == 'REVISE':
-        incomplete_trades = [t for t in trades if not t.isDone()]
+    if accounts:
+        rebalance_many(accounts)
+        logging.info(f'Rebalancing {len(accounts)} accounts took '
+                     f'{time.time() - start} seconds')
+        checkpoint('done', True)
+        return
 
-        new_trades = list()
+    end = time.time()
 
-        for trade in incomplete_trades:
-            contract = trade.contract
-            order = Order(action='BUY', orderType=auxiliary_buy_type,
-                          totalQuantity=trade.remaining())
+    logging.info(f'Analyzing data took {end - start} seconds')
 
-            ib.cancelOrder(trade.order)
-            trades.remove(trade)
+    # A resumed run whose sells are done only has buys left
+    if 'sells' not in journal_stages:
+        with stage('generate sell orders'):
+            generate_sell_orders()
 
-            logging.info(f'resubmitting sell order for {contract.symbol}')
+    if settings.get('pipelined_execution', False):
+        with stage('pipelined execution'):
+            execute_pipelined()
+    else:
+        if 'sells' not in journal_stages:
+            with stage('execute sell orders'):
+                execute_sell_orders()
+            checkpoint('sells', True)
+        with stage('generate buy orders'):
+            generate_buy_orders()
+        with stage('execute buy orders'):
+            execute_buy_orders()
 
-            new_trade = ib.placeOrder(contract, order)
-            new_trades.append(new_trade)
-            trades.append(new_trade)
+    checkpoint('done', True)
 
-    return trades
 
+def run(client: IB = None):
+    """
+    Perform the whole process
 
-def run():
-    """ Perform the whole process """
+    client -- object to connect with instead of a new IB, eg. a
+              fake_ib.FakeIB to run without TWS
+    """
 
     start_logging()
-    load_settings()
-    connect()
-    get_tickers()
-
-    get_historical_data()
+    timeline.clear()
 
-    start = time.time()
-    sharpe_ratios()
-    get_prices()
-    actual_portfolio()
-    target_portfolio()
-    end = time.time()
+    try:
+        with stage('settings'):
+            load_settings()
+        with stage('connect'):
+            connect(client)
 
-    logging.info(f'Analyzing data took {end - start} seconds')
+        rebalance()
 
-    generate_sell_orders()
-    execute_sell_orders()
-    generate_buy_orders()
-    execute_buy_orders()
+    finally:
+        close_journal()
+        write_metrics()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,325 @@
+from typing import List, Tuple
+from collections import namedtuple
+import argparse
+import logging
+import json
+import time
+
+import numpy as np
+import pandas as pd
+
+try:
+    from autobroker import AutoBroker
+except ImportError:
+    import AutoBroker
+
+
+# Result of run_backtest. equity is a Series of portfolio values indexed
+# by rebalance date, holdings a DataFrame of share counts with the same
+# index and stats a dict of summary statistics
+Backtest = namedtuple('Backtest', ['equity', 'holdings', 'stats'])
+
+
+def load_prices(path: str) -> pd.DataFrame:
+    """
+    Load daily closes from a csv file in the format of
+    tests/resources/SampleData.csv (dates in the first column, one
+    column per ticker, any row order). Return DataFrame in ascending
+    date order.
+
+    path -- path to csv file
+    """
+
+    prices = pd.read_csv(path, index_col=0)
+    prices.index = pd.to_datetime(prices.index)
+
+    return prices.sort_index()
+
+
+def weekly_closes(daily_data: pd.DataFrame) -> Tuple[pd.Index, np.ndarray]:
+    """
+    Sample the whole daily history once a week, the same way
+    get_historical_data does for the live run. Return tuple of (dates,
+    closes) with closes as a 2D array, one column per ticker.
+
+    Closes from before a ticker's first price are set to NaN, so the
+    backward fill of weekly_sample can not leak future prices into the
+    backtest.
+
+    daily_data -- DataFrame of daily closes in ascending date order
+    """
+
+    weekly = AutoBroker.weekly_sample(daily_data, len(daily_data))
+    listed = daily_data.notna().cummax().loc[weekly.index]
+
+    closes = np.array(weekly, dtype=float)
+    closes[~listed.to_numpy()] = np.nan
+
+    return weekly.index, closes
+
+
+def average_sharpes(closes: np.ndarray, windows: List[int]) -> np.ndarray:
+    """
+    Calculate the average sharpe ratio of every ticker for every week at
+    once. Return array with the same shape as closes. Tickers without a
+    full max(windows) weeks of changes are NaN.
+
+    closes -- 2D array of weekly closes, one column per ticker
+    windows -- numbers of weeks to average sharpe ratios over
+    """
+
+    total_weeks = closes.shape[0]
+
+    changes = np.full(closes.shape, np.nan)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        changes[1:] = closes[1:] / closes[:-1] - 1
+
+    ratios = AutoBroker.window_sharpes(changes, windows,
+                                       np.arange(1, total_weeks + 1))
+    average = ratios.mean(axis=0)
+
+    history = np.cumsum(~np.isnan(changes), axis=0)
+    average[history < max(windows)] = np.nan
+
+    return average
+
+
+def model_targets(closes: np.ndarray, windows: List[int], max_size: int,
+                  cap: float, floor: float, exponent: float,
+                  average: np.ndarray = None) -> np.ndarray:
+    """
+    Calculate Model 4 target shares for every week at once. Return array
+    with the same shape as closes, each row the target shares (fractions
+    of the portfolio) after that week's close.
+
+    closes -- 2D array of weekly closes, one column per ticker
+    windows -- numbers of weeks to average sharpe ratios over
+    max_size -- maximum number of tickers in the portfolio
+    cap -- maximum share of a single ticker, None for no cap
+    floor -- average sharpe ratios at or below this are not used
+    exponent -- power average sharpe ratios are raised to
+    average -- average sharpe ratios from average_sharpes, if they are
+               already known
+    """
+
+    if average is None:
+        average = average_sharpes(closes, windows)
+
+    adjusted = AutoBroker.adjust_sharpes(average, floor, exponent)
+    shares, _ = AutoBroker.target_shares(average, adjusted, max_size, cap)
+
+    return shares
+
+
+def first_week(total_weeks: int, windows: List[int]) -> int:
+    """
+    Return the first week to rebalance on, the first with a full window
+    of changes for some ticker. Raise ValueError if no week of returns
+    is left after it.
+
+    total_weeks -- number of weekly closes
+    windows -- numbers of weeks to average sharpe ratios over
+    """
+
+    start = max(windows)
+
+    if total_weeks - 1 - start < 1:
+        raise ValueError(f'{total_weeks} weeks of prices only cover the '
+                         f'{start} week sharpe window, at least '
+                         f'{start + 2} are needed')
+
+    return start
+
+
+def simulate(closes: np.ndarray, shares: np.ndarray, capital: float,
+             r: int, start: int, threshold: float = 2,
+             cost: float = 0) -> Tuple[np.ndarray, np.ndarray, dict]:
+    """
+    Simulate weekly rebalancing towards target shares, generating orders
+    the same way generate_sell_orders and generate_buy_orders do (drift
+    threshold and rounding to r). Orders fill at the week's close. Buys
+    are scaled down to the available cash. Return tuple of (equity,
+    holdings, totals) where equity has one value per week (NaN before
+    start), holdings one row of share counts per week and totals the
+    traded value and number of orders.
+
+    Each week is one vector operation over all tickers, so the cost
+    grows with the number of weeks, not weeks times tickers.
+
+    closes -- 2D array of weekly closes, one column per ticker
+    shares -- target shares with the same shape as closes
+    capital -- starting cash
+    r -- number to round quantities to
+    start -- first week to rebalance on
+    threshold -- percentage difference needed to trade a ticker
+    cost -- transaction cost as a fraction of traded value
+    """
+
+    total_weeks, ticker_count = closes.shape
+
+    cash = float(capital)
+    held = np.zeros(ticker_count)
+
+    equity = np.full(total_weeks, np.nan)
+    holdings = np.zeros((total_weeks, ticker_count))
+    traded = 0.0
+    orders = 0
+
+    for week in range(start, total_weeks):
+        priced = closes[week] > 0
+        prices = np.where(priced, closes[week], 0)
+
+        value = cash + held @ prices
+        actual_pct = held * prices / value * 100
+        target_pct = np.where(priced, shares[week], 0) * 100
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            target_cnt = np.where(priced, shares[week] * value / prices,
+                                  np.nan)
+
+        # Both are generated off the portfolio before any trade, same as
+        # the live run
+        sells = AutoBroker.sell_quantities(held, target_cnt, actual_pct,
+                                           target_pct, r, threshold)
+        buys = AutoBroker.buy_quantities(held, target_cnt, actual_pct,
+                                         target_pct, r, threshold)
+
+        proceeds = sells @ prices
+        cash += proceeds * (1 - cost)
+        held -= sells
+
+        spend = buys @ prices * (1 + cost)
+        if spend > cash:
+            buys = buys * (cash / spend)
+            buys = buys - (buys % r)
+            spend = buys @ prices * (1 + cost)
+
+        cash -= spend
+        held += buys
+
+        equity[week] = cash + held @ prices
+        holdings[week] = held
+        traded += proceeds + buys @ prices
+        orders += int(np.count_nonzero(sells) + np.count_nonzero(buys))
+
+    return equity, holdings, {'traded': traded, 'orders': orders}
+
+
+def statistics(equity: np.ndarray, traded: float, orders: int) -> dict:
+    """
+    Summarise a weekly equity curve. Return dict of total return, CAGR,
+    annualised volatility and sharpe ratio, maximum drawdown, annual
+    turnover and number of orders.
+
+    equity -- weekly portfolio values, without NaN
+    traded -- total traded value
+    orders -- total number of orders
+    """
+
+    returns = equity[1:] / equity[:-1] - 1
+    years = max(len(returns), 1) / 52
+
+    volatility = returns.std() * np.sqrt(52) if len(returns) else np.nan
+    mean = returns.mean() * 52 if len(returns) else np.nan
+    drawdown = 1 - equity / np.maximum.accumulate(equity)
+
+    return {
+        'total_return': equity[-1] / equity[0] - 1,
+        'cagr': (equity[-1] / equity[0]) ** (1 / years) - 1,
+        'volatility': volatility,
+        'sharpe': mean / volatility if volatility else np.nan,
+        'max_drawdown': drawdown.max(),
+        'turnover': traded / equity.mean() / years,
+        'orders': orders,
+    }
+
+
+def run_backtest(daily_data: pd.DataFrame, capital: float = 100000,
+                 max_size: int = 13, r: int = 25, cap: float = 0.25,
+                 floor: float = 0.2, exponent: float = 1.5,
+                 windows: List[int] = (52, 26, 13), threshold: float = 2,
+                 cost: float = 0) -> Backtest:
+    """
+    Backtest Model 4 with weekly rebalances over a daily price matrix.
+    Return Backtest of the equity curve, holdings and statistics.
+
+    The first max(windows) weeks only warm up the sharpe ratios. Raise
+    ValueError if that leaves no week of returns after the first
+    rebalance, and log a warning if it leaves less than a year, since
+    the statistics are annualised.
+
+    daily_data -- DataFrame of daily closes in ascending date order
+    capital -- starting cash
+    max_size -- maximum number of tickers in the portfolio
+    r -- number to round quantities to
+    cap -- maximum share of a single ticker, None for no cap
+    floor -- average sharpe ratios at or below this are not used
+    exponent -- power average sharpe ratios are raised to
+    windows -- numbers of weeks to average sharpe ratios over
+    threshold -- percentage difference needed to trade a ticker
+    cost -- transaction cost as a fraction of traded value
+    """
+
+    dates, closes = weekly_closes(daily_data)
+    shares = model_targets(closes, windows, max_size, cap, floor, exponent)
+
+    start = first_week(len(dates), windows)
+    weeks = len(dates) - 1 - start
+
+    if weeks < 52:
+        logging.warning(f'Only {weeks} weeks of returns, statistics are '
+                        f'annualised from less than a year')
+
+    equity, holdings, totals = simulate(closes, shares, capital, r, start,
+                                        threshold, cost)
+
+    equity = pd.Series(equity[start:], index=dates[start:])
+    holdings = pd.DataFrame(holdings[start:], index=dates[start:],
+                            columns=daily_data.columns)
+
+    stats = statistics(equity.to_numpy(), **totals)
+
+    return Backtest(equity=equity, holdings=holdings, stats=stats)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Backtest Model 4 over a csv of daily closes')
+    parser.add_argument('prices', help='csv file of daily closes')
+    parser.add_argument('--settings', default=AutoBroker.SETTINGS_PATH,
+                        help='settings file to take model parameters from')
+    parser.add_argument('--capital', type=float, default=100000,
+                        help='starting cash')
+    parser.add_argument('--cost', type=float, default=0,
+                        help='transaction cost as a fraction of value')
+    parser.add_argument('--output', help='csv file to write equity to')
+    args = parser.parse_args()
+
+    with open(args.settings, 'r') as file:
+        settings = json.load(file)
+
+    start = time.time()
+
+    daily_data = load_prices(args.prices)
+    result = run_backtest(
+        daily_data, args.capital,
+        max_size=settings['max_portfolio_size'],
+        r=settings['round_quantities_to'],
+        cap=settings.get('max_position_percent', 25) / 100,
+        floor=settings.get('sharpe_floor', 0.2),
+        exponent=settings.get('sharpe_exponent', 1.5),
+        windows=settings.get('sharpe_windows', [52, 26, 13]),
+        cost=args.cost)
+
+    end = time.time()
+
+    for name, value in result.stats.items():
+        print(f'{name}: {value}')
+    print(f'Backtest took {end - start} seconds')
+
+    if args.output:
+        result.equity.to_csv(args.output, header=['Equity'])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,382 @@
+from typing import List, Set
+from datetime import datetime, timedelta
+import argparse
+import asyncio
+import logging
+import socket
+import json
+import time
+import os
+
+import pytz
+from ib_insync import IB, util
+
+try:
+    from autobroker import AutoBroker
+except ImportError:
+    import AutoBroker
+
+
+# Ticker symbols of the last rebalance and the modification time of the
+# ticker sheet they were read at
+tickers = None
+tickers_mtime = None
+
+busy = False
+stopping = False
+next_run = None
+last_run = dict()
+reconnecting = None
+
+
+def parse_schedule(expression: str) -> List[Set[int]]:
+    """
+    Parse a cron expression of five fields (minute, hour, day of month,
+    month, day of week). Fields can be *, numbers, ranges (1-5), lists
+    (1,15) and steps (*/15). Unlike cron, day of month and day of week
+    must both match. Return list of sets of allowed values, day of week
+    as datetime.weekday() (Monday is 0).
+
+    expression -- cron expression, eg. '35 15 * * 1-5'
+    """
+
+    limits = [(0, 59), (0, 23), (1, 31), (1, 12), (0, 7)]
+    fields = expression.split()
+
+    if len(fields) != 5:
+        raise ValueError(f'Schedule must have 5 fields: {expression}')
+
+    schedule = list()
+
+    for field, (low, high) in zip(fields, limits):
+        values = set()
+
+        for part in field.split(','):
+            part, _, step = part.partition('/')
+
+            if part == '*':
+                start, end = low, high
+            elif '-' in part:
+                start, end = map(int, part.split('-'))
+            else:
+                start = int(part)
+                end = high if step else start
+
+            if start < low or end > high:
+                raise ValueError(f'Schedule value out of range: {field}')
+
+            values.update(range(start, end + 1, int(step or 1)))
+
+        schedule.append(values)
+
+    # Cron counts days of the week from Sunday (0 or 7)
+    schedule[4] = {(day - 1) % 7 for day in schedule[4]}
+
+    return schedule
+
+
+def next_time(schedule: List[Set[int]], after: datetime) -> datetime:
+    """
+    Return the first minute after a time that matches a schedule, None
+    if there is none within a year.
+
+    schedule -- schedule from parse_schedule
+    after -- naive local time
+    """
+
+    minutes, hours, days, months, weekdays = schedule
+
+    candidate = after.replace(second=0, microsecond=0) + timedelta(minutes=1)
+    limit = after + timedelta(days=366)
+
+    while candidate < limit:
+        if (candidate.month not in months or candidate.day not in days
+                or candidate.weekday() not in weekdays):
+            candidate = (candidate + timedelta(days=1)).replace(hour=0,
+                                                                minute=0)
+        elif candidate.hour not in hours:
+            candidate = (candidate + timedelta(hours=1)).replace(minute=0)
+        elif candidate.minute not in minutes:
+            candidate += timedelta(minutes=1)
+        else:
+            return candidate
+
+    return None
+
+
+def load_tickers() -> Set[str]:
+    """
+    Internal helper function.
+
+    Return the ticker symbols of the ticker sheet, reading it only if it
+    changed since the last read.
+    """
+
+    global tickers
+    global tickers_mtime
+
+    mtime = os.path.getmtime(AutoBroker.TICKERS_PATH)
+
+    if tickers is None or mtime != tickers_mtime:
+        tickers = AutoBroker.read_tickers()
+        tickers_mtime = mtime
+
+    return tickers
+
+
+def rebalance_now() -> dict:
+    """
+    Rebalance over the warm connection, reusing the contracts, bars and
+    sharpe state kept in memory since the last rebalance. Settings are
+    read again every time. Return dict describing the result.
+
+    This blocks: it is called from coroutines of the daemon's event loop
+    (run_schedule, handle_command) and the blocking AutoBroker calls run
+    that same loop again, nested. That only works because serve patches
+    asyncio with util.patchAsyncio(). Commands sent meanwhile are
+    answered once the rebalance is done.
+    """
+
+    global busy
+
+    if busy:
+        return {'status': 'busy'}
+
+    if not AutoBroker.ib.isConnected():
+        return {'status': 'error', 'error': 'not connected to TWS'}
+
+    busy = True
+    start = time.time()
+    AutoBroker.timeline.clear()
+
+    try:
+        with AutoBroker.stage('settings'):
+            AutoBroker.load_settings()
+
+        AutoBroker.rebalance(load_tickers())
+        result = {'status': 'done'}
+
+    except Exception as e:
+        logging.exception('Rebalance failed')
+        result = {'status': 'error', 'error': str(e)}
+
+    finally:
+        AutoBroker.close_journal()
+        AutoBroker.write_metrics()
+        busy = False
+
+    result['start'] = datetime.fromtimestamp(start).isoformat()
+    result['seconds'] = time.time() - start
+
+    last_run.clear()
+    last_run.update(result)
+
+    return result
+
+
+def status() -> dict:
+    """ Return dict describing the state of the daemon """
+
+    return {
+        'connected': AutoBroker.ib.isConnected(),
+        'busy': busy,
+        'next_run': next_run.isoformat() if next_run else None,
+        'last_run': last_run,
+    }
+
+
+async def reconnect():
+    """
+    Reconnect to TWS until it succeeds, waiting reconnect_interval
+    seconds after the first failure and doubling the wait after each
+    next one, up to a minute.
+    """
+
+    settings = AutoBroker.settings
+    wait = settings.get('reconnect_interval', 5)
+
+    while not stopping and not AutoBroker.ib.isConnected():
+        logging.info('Reconnecting to TWS')
+
+        try:
+            await AutoBroker.ib.connectAsync(
+                settings['TWS_ip'], settings['TWS_port'], settings['TWS_id'])
+            logging.info('Reconnected to TWS')
+            return
+
+        except Exception as e:
+            logging.error(f'Reconnecting to TWS failed {e}, retrying in '
+                          f'{wait} seconds')
+
+        await asyncio.sleep(wait)
+        wait = min(wait * 2, 60)
+
+
+def on_disconnected():
+    """
+    Internal helper function.
+
+    Start reconnecting when the connection to TWS drops.
+    """
+
+    global reconnecting
+
+    if stopping:
+        return
+
+    logging.warning('Disconnected from TWS')
+
+    if reconnecting is None or reconnecting.done():
+        reconnecting = asyncio.ensure_future(reconnect())
+
+
+async def run_schedule(expression: str):
+    """
+    Rebalance every time the schedule matches, in the timezone setting.
+
+    expression -- cron expression, see parse_schedule
+    """
+
+    global next_run
+
+    schedule = parse_schedule(expression)
+    timezone = pytz.timezone(AutoBroker.settings.get('timezone',
+                                                     'US/Eastern'))
+
+    while not stopping:
+        now = datetime.now(timezone).replace(tzinfo=None)
+        upcoming = next_time(schedule, now)
+
+        if upcoming is None:
+            logging.error(f'Schedule {expression} never matches')
+            return
+
+        next_run = timezone.localize(upcoming)
+        logging.info(f'Next rebalance at {next_run}')
+
+        await asyncio.sleep((next_run - datetime.now(timezone))
+                            .total_seconds())
+
+        # Blocks this coroutine, running the event loop nested
+        rebalance_now()
+
+
+async def handle_command(reader: asyncio.StreamReader,
+                         writer: asyncio.StreamWriter):
+    """
+    Internal helper function.
+
+    Answer one command from the command socket with a json line. The
+    commands are rebalance, status, reload (forget the cached ticker
+    list and contracts) and stop.
+    """
+
+    global stopping
+    global tickers
+
+    command = (await reader.readline()).decode().strip()
+    logging.info(f'Command: {command}')
+
+    if command == 'rebalance':
+        # Blocks this coroutine, running the event loop nested
+        result = rebalance_now()
+    elif command == 'status':
+        result = status()
+    elif command == 'reload':
+        tickers = None
+        AutoBroker.qualified_contracts.clear()
+        result = {'status': 'done'}
+    elif command == 'stop':
+        stopping = True
+        result = {'status': 'stopping'}
+    else:
+        result = {'status': 'error', 'error': f'unknown command {command}'}
+
+    writer.write((json.dumps(result) + '\n').encode())
+    await writer.drain()
+    writer.close()
+
+    if stopping:
+        asyncio.get_event_loop().stop()
+
+
+def serve(client: IB = None):
+    """
+    Run as a daemon: stay connected to TWS, rebalance on the
+    daemon_schedule setting (a cron expression, empty for none) and
+    answer commands on 127.0.0.1:daemon_port until stopped.
+
+    client -- object to connect with instead of a new IB, eg. a
+              fake_ib.FakeIB to run without TWS
+    """
+
+    AutoBroker.start_logging()
+    AutoBroker.load_settings()
+    settings = AutoBroker.settings
+
+    # Rebalances run the event loop from within its own callbacks
+    util.patchAsyncio()
+
+    AutoBroker.connect(client if client is not None else IB())
+    AutoBroker.ib.disconnectedEvent += on_disconnected
+
+    if not AutoBroker.ib.isConnected():
+        on_disconnected()
+
+    loop = asyncio.get_event_loop()
+
+    port = settings.get('daemon_port', 7901)
+    server = loop.run_until_complete(asyncio.start_server(
+        handle_command, '127.0.0.1', port))
+    logging.info(f'Listening for commands on port {port}')
+
+    schedule = settings.get('daemon_schedule', '')
+    if schedule:
+        asyncio.ensure_future(run_schedule(schedule))
+
+    try:
+        loop.run_forever()
+    finally:
+        server.close()
+        AutoBroker.ib.disconnect()
+        logging.info('Daemon stopped')
+
+
+def send(command: str, port: int) -> dict:
+    """
+    Send a command to a running daemon. Return its answer.
+
+    command -- rebalance, status, reload or stop
+    port -- command port of the daemon
+    """
+
+    with socket.create_connection(('127.0.0.1', port)) as connection:
+        connection.sendall((command + '\n').encode())
+        answer = connection.makefile().readline()
+
+    return json.loads(answer)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Keep AutoBroker connected to TWS and rebalance on a '
+                    'schedule or on command')
+    parser.add_argument('command', nargs='?', default='serve',
+                        choices=['serve', 'rebalance', 'status', 'reload',
+                                 'stop'],
+                        help='serve to run the daemon, anything else is '
+                             'sent to a running daemon')
+    args = parser.parse_args()
+
+    if args.command == 'serve':
+        serve()
+        return
+
+    with open(AutoBroker.SETTINGS_PATH, 'r') as file:
+        port = json.load(file).get('daemon_port', 7901)
+
+    print(json.dumps(send(args.command, port), indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,731 @@
+from typing import Dict, List
+from datetime import date, datetime, timedelta
+import contextlib
+import argparse
+import asyncio
+import tempfile
+import logging
+import random
+import json
+import math
+import time
+import zlib
+import os
+
+from ib_insync import *
+import pandas as pd
+
+
+class FakeClient:
+    """
+    Stand-in for the ib_insync Client of a FakeIB, only reporting
+    connection stats. Every request counts as one message sent.
+    """
+
+    def __init__(self, fake: 'FakeIB'):
+        self.fake = fake
+        self.start = time.time()
+
+    def connectionStats(self) -> ConnectionStats:
+        if not self.fake.connected:
+            raise ConnectionError('Not connected')
+
+        sent = sum(self.fake.requests.values())
+        return ConnectionStats(self.start, time.time() - self.start,
+                               0, 0, 0, sent)
+
+
+class FakeIB:
+    """
+    Local stand-in for ib_insync.IB, serving historical bars, quotes,
+    account values and positions from memory and simulating order fills,
+    so the whole of AutoBroker.run() can be exercised without TWS.
+
+    Only the parts of the IB interface AutoBroker uses are implemented.
+    Every request waits latency seconds. Orders fill fill_delay seconds
+    after they are placed: MKT at the touch, MIDPRICE at the midpoint and
+    LMT at the limit once it is marketable (modifying the order with
+    placeOrder re-checks it). Fills update positions and cash, so a
+    second run sees the portfolio the first one left behind.
+
+    Fills happen on the asyncio event loop, so like with a real IB they
+    only progress while the loop is running (ib.run, ib.sleep, ...).
+
+    bars -- dict of ticker symbols mapped to lists of BarData objects in
+            ascending date order
+    quotes -- dict of ticker symbols mapped to dicts with bid, ask, last
+              and close prices
+    cash -- starting cash (USD)
+    positions -- dict of ticker symbols mapped to (count, average cost)
+    account -- account name
+    accounts -- dict of names of further managed accounts mapped to
+                tuples of (cash, positions), like cash and positions
+                above. Orders fill into the account they are placed for
+    latency -- seconds every request takes
+    fill_delay -- seconds between placing an order and its fill, None to
+                  never fill
+    history_pacing -- tuple of (requests, seconds), historical data
+                      requests over this rate fail with a pacing
+                      violation like TWS does, None for no limit
+    """
+
+    def __init__(self, bars: Dict[str, List[BarData]] = None,
+                 quotes: Dict[str, dict] = None, cash: float = 100000,
+                 positions: Dict[str, tuple] = None, account: str = 'DU0',
+                 accounts: Dict[str, tuple] = None,
+                 latency: float = 0, fill_delay: float = 0.1,
+                 history_pacing: tuple = None):
+        self.bars = bars or dict()
+        self.quotes = quotes or dict()
+        self.account = account
+
+        # Cash and holdings of every managed account
+        self.books = {account: {'cash': cash,
+                                'holdings': dict(positions or dict())}}
+        for name, (book_cash, book_positions) in (accounts or dict()).items():
+            self.books[name] = {'cash': book_cash,
+                                'holdings': dict(book_positions or dict())}
+
+        self.latency = latency
+        self.fill_delay = fill_delay
+        self.history_pacing = history_pacing
+        self.history_times = list()
+
+        self.connected = False
+        self.tickers = dict()
+        self.open_trades = dict()
+        self.all_trades = list()
+        self.next_order_id = 1
+        self.next_exec_id = 1
+
+        # Number of requests of each kind, eg. for benchmarks
+        self.requests = dict()
+        self.client = FakeClient(self)
+
+        self.connectedEvent = Event('connectedEvent')
+        self.disconnectedEvent = Event('disconnectedEvent')
+        self.errorEvent = Event('errorEvent')
+        self.orderStatusEvent = Event('orderStatusEvent')
+        self.execDetailsEvent = Event('execDetailsEvent')
+        self.pendingTickersEvent = Event('pendingTickersEvent')
+
+    @classmethod
+    def synthetic(cls, symbols: List[str], days: int = 760,
+                  end: date = None, seed: int = 0, **kwargs) -> 'FakeIB':
+        """
+        Create a FakeIB serving random walk daily bars and quotes.
+
+        symbols -- ticker symbols to serve
+        days -- number of calendar days of history
+        end -- date of the last bar, defaults to the last weekday
+        seed -- random seed, the same seed gives the same data
+        """
+
+        rng = random.Random(seed)
+
+        if end is None:
+            end = date.today()
+            while end.weekday() > 4:
+                end -= timedelta(days=1)
+
+        dates = [end - timedelta(days=n) for n in range(days, -1, -1)]
+        dates = [day for day in dates if day.weekday() < 5]
+
+        bars = dict()
+        quotes = dict()
+
+        for symbol in symbols:
+            price = rng.uniform(20, 200)
+            drift = rng.gauss(0.0003, 0.0005)
+            symbol_bars = list()
+
+            for day in dates:
+                price *= math.exp(rng.gauss(drift, 0.01))
+                symbol_bars.append(BarData(
+                    date=day, open=price, high=price, low=price,
+                    close=round(price, 2), volume=1000))
+
+            bars[symbol] = symbol_bars
+
+            close = symbol_bars[-1].close
+            spread = max(round(close * 0.0005, 2), 0.01)
+            quotes[symbol] = {'bid': round(close - spread, 2),
+                              'ask': round(close + spread, 2),
+                              'last': close, 'close': close}
+
+        return cls(bars, quotes, **kwargs)
+
+    @classmethod
+    def from_recording(cls, path: str, **kwargs) -> 'FakeIB':
+        """
+        Create a FakeIB that replays a session recorded by RecordingIB.
+        The same requests get the same answers every time.
+
+        path -- path to the recorded json file
+        """
+
+        with open(path, 'r') as file:
+            session = json.load(file)
+
+        bars = {symbol: [BarData(date=date.fromisoformat(day), open=close,
+                                 high=close, low=close, close=close)
+                         for day, close in symbol_bars]
+                for symbol, symbol_bars in session['bars'].items()}
+
+        fake = cls(bars, session['quotes'], cash=session['cash'],
+                   positions={symbol: tuple(position) for symbol, position
+                              in session['positions'].items()},
+                   account=session['account'], **kwargs)
+        fake.contract_fields = session['contracts']
+
+        return fake
+
+    @property
+    def cash(self) -> float:
+        """ Cash of the main account """
+        return self.books[self.account]['cash']
+
+    @property
+    def holdings(self) -> Dict[str, tuple]:
+        """ Holdings of the main account """
+        return self.books[self.account]['holdings']
+
+    def book(self, account: str = '') -> dict:
+        """ Return cash and holdings of an account, '' for the main one """
+        return self.books[account or self.account]
+
+    def count(self, name: str):
+        self.requests[name] = self.requests.get(name, 0) + 1
+
+    async def wait(self, name: str):
+        """ Count a request and wait for its latency """
+
+        self.count(name)
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+    def run(self, *awaitables, timeout: float = None):
+        return util.run(*awaitables, timeout=timeout)
+
+    def sleep(self, seconds: float = 0.02) -> bool:
+        self.run(asyncio.sleep(seconds))
+        return True
+
+    def waitOnUpdate(self, timeout: float = 0) -> bool:
+        return self.sleep(timeout or 0.02)
+
+    # Connection
+
+    def connect(self, host: str = '127.0.0.1', port: int = 7497,
+                clientId: int = 1, timeout: float = 4, **kwargs):
+        self.connected = True
+        self.connectedEvent.emit()
+        return self
+
+    async def connectAsync(self, *args, **kwargs):
+        return self.connect(*args, **kwargs)
+
+    def disconnect(self):
+        if self.connected:
+            self.connected = False
+            self.disconnectedEvent.emit()
+
+    def isConnected(self) -> bool:
+        return self.connected
+
+    # Contracts and market data
+
+    def qualifyContracts(self, *contracts: Contract) -> List[Contract]:
+        return self.run(self.qualifyContractsAsync(*contracts))
+
+    async def qualifyContractsAsync(self, *contracts: Contract):
+        await self.wait('qualifyContracts')
+
+        fields = getattr(self, 'contract_fields', dict())
+        qualified = list()
+
+        for contract in contracts:
+            if contract.symbol not in self.bars:
+                self.errorEvent.emit(-1, 200, 'No security definition',
+                                     contract)
+                continue
+
+            recorded = fields.get(contract.symbol, dict())
+            contract.conId = self.con_id(contract.symbol)
+            contract.primaryExchange = recorded.get('primaryExchange',
+                                                    'ARCA')
+            qualified.append(contract)
+
+        return qualified
+
+    def reqHistoricalData(self, contract: Contract, endDateTime,
+                          durationStr: str, barSizeSetting: str,
+                          whatToShow: str, useRTH: bool,
+                          **kwargs) -> List[BarData]:
+        return self.run(self.reqHistoricalDataAsync(
+            contract, endDateTime, durationStr, barSizeSetting,
+            whatToShow, useRTH, **kwargs))
+
+    async def reqHistoricalDataAsync(self, contract: Contract, endDateTime,
+                                     durationStr: str, barSizeSetting: str,
+                                     whatToShow: str, useRTH: bool,
+                                     **kwargs) -> List[BarData]:
+        await self.wait('reqHistoricalData')
+
+        if endDateTime and whatToShow == 'ADJUSTED_LAST':
+            raise ValueError('Error 321, end date not supported with '
+                             'adjusted last')
+
+        if self.history_pacing:
+            limit, seconds = self.history_pacing
+            now = time.time()
+            self.history_times = [t for t in self.history_times
+                                  if now - t < seconds]
+
+            if len(self.history_times) >= limit:
+                self.errorEvent.emit(
+                    -1, 162, 'Historical Market Data Service error '
+                    'message:Historical data request pacing violation',
+                    contract)
+                return BarDataList()
+
+            self.history_times.append(now)
+
+        bars = self.bars.get(contract.symbol, [])
+        if not bars:
+            return BarDataList()
+
+        end = bars[-1].date
+        if endDateTime:
+            end = endDateTime
+            if isinstance(end, datetime):
+                end = end.date()
+
+        number, unit = durationStr.split()
+        days = int(number) * {'S': 0, 'D': 1, 'W': 7, 'M': 31,
+                              'Y': 365}[unit]
+        start = end - timedelta(days=max(days, 1))
+
+        result = BarDataList()
+        result.extend(bar for bar in bars if start < bar.date <= end)
+
+        if barSizeSetting == '1 week':
+            weekly = dict()
+            for bar in result:
+                weekly[bar.date.isocalendar()[:2]] = bar
+            result = BarDataList(weekly.values())
+
+        return result
+
+    def con_id(self, symbol: str) -> int:
+        """ Return the recorded or made up contract id of a symbol """
+
+        recorded = getattr(self, 'contract_fields', dict()).get(symbol, dict())
+        return recorded.get('conId', zlib.crc32(symbol.encode()) % 10 ** 9)
+
+    def make_ticker(self, contract: Contract) -> Ticker:
+        quote = self.quotes.get(contract.symbol, dict())
+        ticker = Ticker(contract=contract, time=datetime.now(),
+                        bid=quote.get('bid', math.nan),
+                        ask=quote.get('ask', math.nan),
+                        last=quote.get('last', math.nan),
+                        close=quote.get('close', math.nan))
+        self.tickers[contract.symbol] = ticker
+        return ticker
+
+    def reqTickers(self, *contracts: Contract, **kwargs) -> List[Ticker]:
+        return self.run(self.reqTickersAsync(*contracts))
+
+    async def reqTickersAsync(self, *contracts: Contract,
+                              **kwargs) -> List[Ticker]:
+        await self.wait('reqTickers')
+        return [self.make_ticker(contract) for contract in contracts]
+
+    def reqMktData(self, contract: Contract, genericTickList: str = '',
+                   snapshot: bool = False, regulatorySnapshot: bool = False,
+                   mktDataOptions=None) -> Ticker:
+        self.count('reqMktData')
+        ticker = Ticker(contract=contract)
+        self.tickers[contract.symbol] = ticker
+
+        def update():
+            filled = self.make_ticker(contract)
+            for name in ('time', 'bid', 'ask', 'last', 'close'):
+                setattr(ticker, name, getattr(filled, name))
+            self.tickers[contract.symbol] = ticker
+            ticker.updateEvent.emit(ticker)
+            self.pendingTickersEvent.emit({ticker})
+
+        if contract.symbol in self.quotes:
+            asyncio.get_event_loop().call_later(self.latency, update)
+
+        return ticker
+
+    def cancelMktData(self, contract: Contract):
+        self.count('cancelMktData')
+
+    def ticker(self, contract: Contract) -> Ticker:
+        return self.tickers.get(contract.symbol)
+
+    # Account
+
+    def managedAccounts(self) -> List[str]:
+        return list(self.books.keys())
+
+    def price(self, symbol: str) -> float:
+        quote = self.quotes.get(symbol, dict())
+        return quote.get('last', quote.get('close', 0))
+
+    def accountValues(self, account: str = '') -> List[AccountValue]:
+        self.count('accountValues')
+
+        account = account or self.account
+        book = self.book(account)
+        value = book['cash'] + sum(count * self.price(symbol) for symbol,
+                                   (count, _) in book['holdings'].items())
+
+        return [
+            AccountValue(account, 'NetLiquidation', str(value), 'USD', ''),
+            AccountValue(account, 'TotalCashValue', str(book['cash']),
+                         'USD', ''),
+            AccountValue(account, 'AvailableFunds', str(book['cash']),
+                         'USD', ''),
+        ]
+
+    def accountSummary(self, account: str = '') -> List[AccountValue]:
+        return self.accountValues(account)
+
+    async def accountSummaryAsync(self, account: str = ''):
+        await self.wait('accountSummary')
+        return self.accountValues(account)
+
+    def positions(self, account: str = '') -> List[Position]:
+        self.count('positions')
+
+        # Like TWS, no account means the positions of every account
+        accounts = [account] if account else list(self.books.keys())
+
+        return [Position(name, Stock(symbol, 'SMART', 'USD',
+                                     conId=self.con_id(symbol)), count, cost)
+                for name in accounts
+                for symbol, (count, cost) in self.books[name]['holdings']
+                .items()
+                if count]
+
+    async def reqPositionsAsync(self) -> List[Position]:
+        await self.wait('reqPositions')
+        return self.positions()
+
+    # Orders
+
+    def placeOrder(self, contract: Contract, order: Order) -> Trade:
+        self.count('placeOrder')
+
+        # Placing an order that is already open modifies it
+        if order.orderId in self.open_trades:
+            trade = self.open_trades[order.orderId]
+            trade.log.append(TradeLogEntry(datetime.now(), 'Modified'))
+            trade.modifyEvent.emit(trade)
+            self.schedule_fill(trade)
+            return trade
+
+        order.orderId = self.next_order_id
+        order.permId = self.next_order_id
+        self.next_order_id += 1
+
+        trade = Trade(contract, order,
+                      OrderStatus(orderId=order.orderId, status='Submitted',
+                                  remaining=order.totalQuantity))
+        trade.log.append(TradeLogEntry(datetime.now(), 'Submitted'))
+
+        self.open_trades[order.orderId] = trade
+        self.all_trades.append(trade)
+        self.schedule_fill(trade)
+
+        return trade
+
+    def schedule_fill(self, trade: Trade):
+        if self.fill_delay is None:
+            return
+
+        asyncio.get_event_loop().call_later(self.fill_delay,
+                                            self.try_fill, trade)
+
+    def fill_price(self, trade: Trade) -> float:
+        """ Return the price an order fills at now, NaN if it does not """
+
+        quote = self.quotes.get(trade.contract.symbol, dict())
+        bid = quote.get('bid', quote.get('close', math.nan))
+        ask = quote.get('ask', quote.get('close', math.nan))
+        buying = trade.order.action == 'BUY'
+        order_type = trade.order.orderType
+
+        if order_type == 'MIDPRICE':
+            return round((bid + ask) / 2, 2)
+
+        if order_type == 'LMT':
+            limit = trade.order.lmtPrice
+            if buying and limit >= ask or not buying and limit <= bid:
+                return limit
+            return math.nan
+
+        return ask if buying else bid
+
+    def try_fill(self, trade: Trade):
+        if trade.isDone():
+            return
+
+        price = self.fill_price(trade)
+        if math.isnan(price):
+            return
+
+        order = trade.order
+        shares = trade.remaining()
+        buying = order.action == 'BUY'
+
+        execution = Execution(
+            execId=str(self.next_exec_id), time=datetime.now(),
+            acctNumber=order.account or self.account,
+            side='BOT' if buying else 'SLD',
+            shares=shares, price=price, orderId=order.orderId,
+            permId=order.permId, cumQty=order.totalQuantity, avgPrice=price)
+        self.next_exec_id += 1
+
+        fill = Fill(trade.contract, execution, CommissionReport(),
+                    execution.time)
+
+        # Update positions and cash
+        book = self.book(order.account)
+        symbol = trade.contract.symbol
+        count, cost = book['holdings'].get(symbol, (0, 0))
+        signed = shares if buying else -shares
+        if buying:
+            cost = (count * cost + shares * price) / (count + shares)
+        book['holdings'][symbol] = (count + signed, cost)
+        book['cash'] -= signed * price
+
+        trade.fills.append(fill)
+        trade.orderStatus.status = 'Filled'
+        trade.orderStatus.filled = order.totalQuantity
+        trade.orderStatus.remaining = 0
+        trade.orderStatus.avgFillPrice = price
+        trade.log.append(TradeLogEntry(execution.time, 'Filled'))
+        del self.open_trades[order.orderId]
+
+        trade.fillEvent.emit(trade, fill)
+        self.execDetailsEvent.emit(trade, fill)
+        trade.filledEvent.emit(trade)
+        trade.statusEvent.emit(trade)
+        self.orderStatusEvent.emit(trade)
+
+    def cancelOrder(self, order: Order):
+        self.count('cancelOrder')
+
+        trade = self.open_trades.pop(order.orderId, None)
+        if trade is None:
+            return
+
+        trade.orderStatus.status = 'Cancelled'
+        trade.log.append(TradeLogEntry(datetime.now(), 'Cancelled'))
+        trade.cancelledEvent.emit(trade)
+        trade.statusEvent.emit(trade)
+        self.orderStatusEvent.emit(trade)
+
+    def reqAllOpenOrders(self) -> List[Order]:
+        self.count('reqAllOpenOrders')
+        return [trade.order for trade in self.open_trades.values()]
+
+    def openTrades(self) -> List[Trade]:
+        return list(self.open_trades.values())
+
+    def trades(self) -> List[Trade]:
+        return list(self.all_trades)
+
+    def fills(self) -> List[Fill]:
+        return [fill for trade in self.all_trades for fill in trade.fills]
+
+
+class RecordingIB:
+    """
+    Wrapper around a connected ib_insync.IB that records the answers to
+    the data requests AutoBroker makes (contracts, historical bars,
+    quotes, account values and positions), so the session can be saved
+    and replayed offline with FakeIB.from_recording. Everything else is
+    passed through to the wrapped IB.
+
+    ib -- the IB object to wrap
+    """
+
+    def __init__(self, ib: IB):
+        self.ib = ib
+        self.session = {'contracts': dict(), 'bars': dict(),
+                        'quotes': dict(), 'cash': 0, 'positions': dict(),
+                        'account': ''}
+
+    def __getattr__(self, name: str):
+        return getattr(self.ib, name)
+
+    def record_contracts(self, contracts: List[Contract]):
+        for contract in contracts:
+            if contract.conId:
+                self.session['contracts'][contract.symbol] = \
+                    util.dataclassNonDefaults(contract)
+
+    def record_bars(self, contract: Contract, bars: List[BarData]):
+        recorded = dict(self.session['bars'].get(contract.symbol, []))
+        for bar in bars:
+            recorded[str(bar.date)] = bar.close
+        self.session['bars'][contract.symbol] = sorted(recorded.items())
+
+    def record_tickers(self, tickers: List[Ticker]):
+        for ticker in tickers:
+            self.session['quotes'][ticker.contract.symbol] = {
+                name: getattr(ticker, name)
+                for name in ('bid', 'ask', 'last', 'close')
+                if not math.isnan(getattr(ticker, name))}
+
+    def qualifyContracts(self, *contracts):
+        result = self.ib.qualifyContracts(*contracts)
+        self.record_contracts(result)
+        return result
+
+    async def qualifyContractsAsync(self, *contracts):
+        result = await self.ib.qualifyContractsAsync(*contracts)
+        self.record_contracts(result)
+        return result
+
+    def reqHistoricalData(self, contract, *args, **kwargs):
+        bars = self.ib.reqHistoricalData(contract, *args, **kwargs)
+        self.record_bars(contract, bars)
+        return bars
+
+    async def reqHistoricalDataAsync(self, contract, *args, **kwargs):
+        bars = await self.ib.reqHistoricalDataAsync(contract, *args,
+                                                    **kwargs)
+        self.record_bars(contract, bars)
+        return bars
+
+    def reqTickers(self, *contracts, **kwargs):
+        tickers = self.ib.reqTickers(*contracts, **kwargs)
+        self.record_tickers(tickers)
+        return tickers
+
+    async def reqTickersAsync(self, *contracts, **kwargs):
+        tickers = await self.ib.reqTickersAsync(*contracts, **kwargs)
+        self.record_tickers(tickers)
+        return tickers
+
+    def accountValues(self, account: str = ''):
+        values = self.ib.accountValues(account)
+        for value in values:
+            if value.tag == 'TotalCashValue' and value.currency == 'USD':
+                self.session['cash'] = float(value.value)
+                self.session['account'] = value.account
+        return values
+
+    def positions(self, account: str = ''):
+        positions = self.ib.positions(account)
+        for position in positions:
+            self.session['positions'][position.contract.symbol] = \
+                (position.position, position.avgCost)
+        return positions
+
+    def save(self, path: str):
+        """ Save the recorded session to a json file """
+
+        with open(path, 'w') as file:
+            json.dump(self.session, file, indent=1)
+
+
+@contextlib.contextmanager
+def temporary_cache(module):
+    """
+    Point the cache of AutoBroker at a new database in a temporary
+    directory for the duration of the block, so contract ids, bars,
+    sharpe state and run journals of fake or recorded runs never end
+    up in the cache live runs use.
+
+    module -- the imported AutoBroker module
+    """
+
+    cache_path = module.cache_path
+
+    with tempfile.TemporaryDirectory() as directory:
+        module.cache_path = os.path.join(directory, 'cache.db')
+
+        try:
+            yield module.cache_path
+        finally:
+            module.cache_path = cache_path
+
+
+def record(path: str, client: IB = None):
+    """
+    Connect to TWS and run the analysis stages of AutoBroker (up to and
+    including target_portfolio, no orders are placed) while recording
+    every answer, then save the session to path.
+
+    The run uses an empty temporary cache, so every answer is requested
+    from TWS and recorded.
+
+    path -- path to write the recorded json file to
+    client -- IB object to record, defaults to a new IB
+    """
+
+    import AutoBroker
+
+    AutoBroker.start_logging()
+    AutoBroker.load_settings()
+
+    recorder = RecordingIB(client if client is not None else IB())
+
+    with temporary_cache(AutoBroker):
+        AutoBroker.connect(recorder)
+
+        AutoBroker.get_tickers()
+        AutoBroker.get_historical_data()
+        AutoBroker.sharpe_ratios()
+        AutoBroker.get_prices()
+        AutoBroker.actual_portfolio()
+        AutoBroker.target_portfolio()
+
+    recorder.save(path)
+    recorder.disconnect()
+
+    logging.info(f'Recorded session to {path}')
+
+
+def main():
+    import AutoBroker
+
+    parser = argparse.ArgumentParser(
+        description='Run AutoBroker against a fake TWS, or record a real '
+                    'TWS session to replay later')
+    parser.add_argument('mode', choices=['record', 'replay', 'synthetic'])
+    parser.add_argument('session', nargs='?',
+                        help='recorded session json file')
+    parser.add_argument('--latency', type=float, default=0,
+                        help='seconds every fake request takes')
+    parser.add_argument('--fill-delay', type=float, default=0.1,
+                        help='seconds between placing and filling orders')
+    args = parser.parse_args()
+
+    if args.mode == 'record':
+        record(args.session)
+        return
+
+    if args.mode == 'replay':
+        fake = FakeIB.from_recording(args.session, latency=args.latency,
+                                     fill_delay=args.fill_delay)
+    else:
+        sheet_data = pd.read_excel(AutoBroker.TICKERS_PATH, header=None)
+        symbols = list(sheet_data.iloc[:, 0].dropna())
+        fake = FakeIB.synthetic(symbols, latency=args.latency,
+                                fill_delay=args.fill_delay)
+
+    with temporary_cache(AutoBroker):
+        AutoBroker.run(fake)
+
+
+if __name__ == '__main__':
+    main()
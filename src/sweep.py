@@ -0,0 +1,251 @@
+from typing import Dict, Iterator
+from concurrent.futures import ProcessPoolExecutor
+import itertools
+import argparse
+import tempfile
+import logging
+import random
+import json
+import time
+import os
+
+import numpy as np
+import pandas as pd
+
+try:
+    from autobroker import backtest
+except ImportError:
+    import backtest
+
+
+# Values tried for each parameter when no grid file is given. Keys are
+# the settings.json names of the parameters
+DEFAULT_GRID = {
+    'max_portfolio_size': [8, 10, 13, 16, 20],
+    'round_quantities_to': [1, 10, 25],
+    'max_position_percent': [15, 20, 25, 33, 100],
+    'sharpe_floor': [0, 0.1, 0.2, 0.3],
+    'sharpe_exponent': [1, 1.5, 2],
+    'sharpe_windows': [[52, 26, 13], [52, 13], [26, 13], [52]],
+}
+
+# Weekly closes shared by all combinations of a worker process, opened
+# from a memory mapped file by init_worker so no copies are made
+closes = None
+
+# Average sharpe ratios of a worker process, keyed by tuple of windows.
+# Only the windows change the sharpe ratios, so every other parameter
+# reuses them
+averages = dict()
+
+# Arguments every combination is evaluated with, set by init_worker
+options = dict()
+
+
+def combinations(grid: Dict[str, list],
+                 samples: int = None) -> Iterator[Dict[str, object]]:
+    """
+    Generate parameter combinations from a grid. Yield dicts of
+    parameter names mapped to values.
+
+    If samples is given and smaller than the grid, only a random sample
+    of that many distinct combinations is generated, without building
+    the full grid in memory.
+
+    grid -- dict of parameter names mapped to lists of values
+    samples -- number of random combinations, None for the whole grid
+    """
+
+    names = list(grid.keys())
+    sizes = [len(grid[name]) for name in names]
+    total = int(np.prod(sizes))
+
+    if samples is None or samples >= total:
+        for values in itertools.product(*[grid[name] for name in names]):
+            yield dict(zip(names, values))
+        return
+
+    # Decode each sampled index as a mixed radix number, one digit per
+    # parameter
+    for index in random.sample(range(total), samples):
+        combination = dict()
+        for name, size in zip(names, sizes):
+            index, digit = divmod(index, size)
+            combination[name] = grid[name][digit]
+        yield combination
+
+
+def init_worker(path: str, shape: tuple, worker_options: dict):
+    """
+    Internal helper function.
+
+    Open the shared weekly closes in a worker process.
+
+    path -- path to the memory mapped closes
+    shape -- shape of the closes array
+    worker_options -- arguments every combination is evaluated with
+    """
+
+    global closes
+    global options
+
+    closes = np.memmap(path, dtype=float, mode='r', shape=shape)
+    options = worker_options
+
+
+def evaluate(params: Dict[str, object]) -> Dict[str, object]:
+    """
+    Backtest one parameter combination against the shared closes.
+    Return dict of the parameters and the backtest statistics.
+
+    params -- dict of settings.json parameter names mapped to values
+    """
+
+    windows = tuple(params['sharpe_windows'])
+
+    if windows not in averages:
+        averages[windows] = backtest.average_sharpes(closes, windows)
+
+    shares = backtest.model_targets(
+        closes, windows,
+        max_size=params['max_portfolio_size'],
+        cap=params['max_position_percent'] / 100,
+        floor=params['sharpe_floor'],
+        exponent=params['sharpe_exponent'],
+        average=averages[windows])
+
+    start = backtest.first_week(closes.shape[0], windows)
+
+    equity, _, totals = backtest.simulate(
+        closes, shares, options['capital'],
+        params['round_quantities_to'], start, cost=options['cost'])
+
+    stats = backtest.statistics(equity[start:], **totals)
+
+    result = dict(params)
+    result['sharpe_windows'] = '/'.join(str(weeks) for weeks in windows)
+    result.update(stats)
+
+    return result
+
+
+def run_sweep(daily_data: pd.DataFrame, grid: Dict[str, list],
+              samples: int = None, workers: int = None,
+              capital: float = 100000, cost: float = 0,
+              metric: str = 'sharpe') -> pd.DataFrame:
+    """
+    Backtest every parameter combination of a grid (or a random sample
+    of it) over a process pool. Return DataFrame of parameters and
+    statistics, one row per combination, ranked by metric.
+
+    The weekly closes are calculated once and written to a memory mapped
+    file that every worker maps read only, so the price matrix is shared
+    between processes instead of being pickled to each of them.
+
+    Window sets that leave no week of returns after their warm up (see
+    backtest.first_week) are dropped from the grid with a warning, and
+    ValueError is raised if that leaves none.
+
+    daily_data -- DataFrame of daily closes in ascending date order
+    grid -- dict of settings.json parameter names mapped to lists of
+            values, see DEFAULT_GRID
+    samples -- number of random combinations, None for the whole grid
+    workers -- number of worker processes, defaults to the cpu count
+    capital -- starting cash
+    cost -- transaction cost as a fraction of traded value
+    metric -- statistic to rank by, highest first
+    """
+
+    grid = dict(DEFAULT_GRID, **grid)
+
+    _, weekly = backtest.weekly_closes(daily_data)
+
+    usable = list()
+    for windows in grid['sharpe_windows']:
+        try:
+            backtest.first_week(weekly.shape[0], windows)
+        except ValueError as e:
+            logging.warning(f'Skipping sharpe windows {windows}: {e}')
+            continue
+        usable.append(windows)
+
+    if not usable:
+        raise ValueError(f'{weekly.shape[0]} weeks of prices leave no '
+                         f'returns for any of the sharpe windows')
+
+    longest = max(max(windows) for windows in usable)
+    weeks = weekly.shape[0] - 1 - longest
+
+    if weeks < 52:
+        logging.warning(f'Sharpe windows of {longest} weeks leave {weeks} '
+                        f'weeks of returns, statistics are annualised '
+                        f'from less than a year')
+
+    grid['sharpe_windows'] = usable
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'closes.dat')
+
+        shared = np.memmap(path, dtype=float, mode='w+', shape=weekly.shape)
+        shared[:] = weekly
+        shared.flush()
+        del shared
+
+        worker_options = {'capital': capital, 'cost': cost}
+
+        with ProcessPoolExecutor(
+                max_workers=workers, initializer=init_worker,
+                initargs=(path, weekly.shape, worker_options)) as executor:
+            results = list(executor.map(
+                evaluate, combinations(grid, samples), chunksize=16))
+
+    results = pd.DataFrame(results)
+
+    return results.sort_values(by=metric, ascending=False,
+                               ignore_index=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Backtest a grid of Model 4 parameters in parallel')
+    parser.add_argument('prices', help='csv file of daily closes')
+    parser.add_argument('--grid',
+                        help='json file of parameter names mapped to '
+                             'lists of values, missing parameters use '
+                             'the default grid')
+    parser.add_argument('--samples', type=int,
+                        help='number of random combinations to try '
+                             'instead of the whole grid')
+    parser.add_argument('--workers', type=int,
+                        help='number of worker processes')
+    parser.add_argument('--capital', type=float, default=100000,
+                        help='starting cash')
+    parser.add_argument('--cost', type=float, default=0,
+                        help='transaction cost as a fraction of value')
+    parser.add_argument('--metric', default='sharpe',
+                        help='statistic to rank combinations by')
+    parser.add_argument('--output', default='sweep.csv',
+                        help='csv file to write ranked results to')
+    args = parser.parse_args()
+
+    grid = dict()
+    if args.grid:
+        with open(args.grid, 'r') as file:
+            grid = json.load(file)
+
+    start = time.time()
+
+    results = run_sweep(backtest.load_prices(args.prices), grid,
+                        args.samples, args.workers, args.capital,
+                        args.cost, args.metric)
+
+    end = time.time()
+
+    results.to_csv(args.output, index=False)
+
+    print(results.head(10).to_string())
+    print(f'Sweep of {len(results)} combinations took {end - start} seconds')
+
+
+if __name__ == '__main__':
+    main()
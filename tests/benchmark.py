@@ -0,0 +1,462 @@
+from typing import Dict, List
+from datetime import date, datetime
+import contextlib
+import subprocess
+import tracemalloc
+import argparse
+import platform
+import tempfile
+import json
+import time
+import sys
+import os
+
+import pandas as pd
+import numpy as np
+from ib_insync import Contract
+
+from autobroker import AutoBroker
+
+
+RESULTS_PATH = 'tests/benchmark_results.jsonl'
+
+# Last day of every synthetic history, fixed so runs are comparable
+END_DATE = date(2020, 12, 31)
+
+STAGES = ['ingestion', 'weekly sample', 'sharpe ratios', 'target portfolio',
+          'order generation']
+
+STARTUP_STAGES = ['import', 'settings', 'connect', 'time to connect',
+                  'ticker sheet']
+
+# Runs in a fresh interpreter, so imports are timed cold. The connection
+# is not opened, only the work of the process before and around it is
+# timed
+STARTUP_SCRIPT = """
+import time
+start = time.perf_counter()
+
+import json
+import sys
+
+from autobroker import AutoBroker
+from ib_insync import IB
+
+
+class Client(IB):
+    def connect(self, *args, **kwargs):
+        pass
+
+
+times = dict()
+last = start
+
+def lap(name):
+    global last
+    now = time.perf_counter()
+    times[name] = now - last
+    last = now
+
+lap('import')
+AutoBroker.SETTINGS_PATH, AutoBroker.TICKERS_PATH = sys.argv[1:3]
+AutoBroker.load_settings()
+lap('settings')
+AutoBroker.connect(Client())
+lap('connect')
+times['time to connect'] = last - start
+connected_with_pandas = 'pandas' in sys.modules
+
+try:
+    AutoBroker.read_tickers(sys.argv[2], sys.argv[3])
+    lap('ticker sheet')
+except Exception as e:
+    print(f'Reading ticker sheet failed {e}', file=sys.stderr)
+
+print(json.dumps({'times': times, 'pandas': connected_with_pandas}))
+"""
+
+
+class Bar:
+    """
+    Stand-in for ib_insync BarData with only the fields bars_to_frame
+    reads. Millions of full BarData objects do not fit in memory.
+    """
+
+    __slots__ = ('date', 'close')
+
+    def __init__(self, date, close):
+        self.date = date
+        self.close = close
+
+
+def synthetic_universe(tickers: int, years: int,
+                       seed: int = 0) -> Dict[str, List[Bar]]:
+    """
+    Generate random walk daily bars for a universe of tickers. Some
+    tickers start trading late and some days are missing, so the weekly
+    sample has gaps to fill like real data does. Return dict of ticker
+    symbols mapped to lists of bars in ascending date order.
+
+    tickers -- number of tickers
+    years -- years of daily bars
+    seed -- random seed, the same seed gives the same universe
+    """
+
+    rng = np.random.default_rng(seed)
+
+    dates = pd.bdate_range(end=END_DATE, periods=252 * years)
+    dates = [day.date() for day in dates]
+
+    changes = rng.normal(0.0003, 0.01, (len(dates), tickers))
+    closes = np.round(rng.uniform(20, 200, tickers)
+                      * np.exp(np.cumsum(changes, axis=0)), 2)
+
+    missing = rng.random(closes.shape) < 0.01
+    listed = rng.integers(0, len(dates) // 4, tickers)
+    listed[rng.random(tickers) < 0.9] = 0
+    missing |= np.arange(len(dates))[:, None] < listed
+
+    universe = dict()
+    for column in range(tickers):
+        present = np.flatnonzero(~missing[:, column])
+        universe[f'T{column:05d}'] = [
+            Bar(dates[row], close)
+            for row, close in zip(present, closes[present, column].tolist())]
+
+    return universe
+
+
+def reset_state(symbols: List[str]):
+    """
+    Internal helper function.
+
+    Reset AutoBroker globals to a fresh run over symbols with qualified
+    contracts, so no stage needs a TWS connection.
+
+    symbols -- ticker symbols of the universe
+    """
+
+    AutoBroker.settings = {
+        'max_portfolio_size': 13,
+        'max_position_percent': 25,
+        'round_quantities_to': 25,
+        'primary_sell_type': 'MIDPRICE',
+        'primary_buy_type': 'MIDPRICE',
+        'sharpe_windows': [52, 26, 13],
+        'incremental_sharpe': False,
+    }
+    AutoBroker.contracts = {
+        symbol: Contract(conId=index + 1, symbol=symbol, secType='STK',
+                         exchange='SMART', currency='USD')
+        for index, symbol in enumerate(symbols)}
+    AutoBroker.portfolio = AutoBroker.Portfolio()
+    AutoBroker.sell_orders = list()
+    AutoBroker.buy_orders = list()
+
+
+def hold_positions(weekly_data: pd.DataFrame, positions: int = 20,
+                   seed: int = 0):
+    """
+    Internal helper function.
+
+    Fill the price and actual columns of the global portfolio as
+    get_prices and actual_portfolio would, holding a random set of
+    tickers.
+
+    weekly_data -- weekly closes, the last row is used as prices
+    positions -- number of tickers held
+    seed -- random seed
+    """
+
+    rng = np.random.default_rng(seed)
+    portfolio = AutoBroker.portfolio
+
+    prices = weekly_data.iloc[-1]
+    counts = pd.Series(0.0, index=prices.index)
+    held = rng.choice(len(prices), min(positions, len(prices)), replace=False)
+    counts.iloc[held] = rng.integers(1, 40, len(held)) * 25
+
+    values = counts * prices
+    portfolio.value = float(values.sum()) + 10000
+
+    portfolio.set('Price', prices.index, prices.values)
+    portfolio.set('Actual (cnt)', prices.index, counts.values)
+    portfolio.set('Actual ($)', prices.index, values.values)
+    portfolio.set('Actual (%)', prices.index,
+                  values.values / portfolio.value * 100)
+
+
+def run_stages(universe: Dict[str, List[Bar]], memory: bool = False):
+    """
+    Run the analysis pipeline of AutoBroker.run over a universe of bars.
+    Return dict of stage names mapped to seconds taken, or to peak
+    traced memory (bytes) if memory is True.
+
+    universe -- dict of ticker symbols mapped to lists of bars
+    memory -- measure peak memory with tracemalloc instead of time
+    """
+
+    results = dict()
+
+    @contextlib.contextmanager
+    def stage(name):
+        if memory:
+            tracemalloc.start()
+            yield
+            results[name] = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        else:
+            start = time.perf_counter()
+            yield
+            results[name] = time.perf_counter() - start
+
+    reset_state(list(universe.keys()))
+
+    with stage('ingestion'):
+        daily_data = AutoBroker.bars_to_frame(universe)
+
+    with stage('weekly sample'):
+        weekly_data = AutoBroker.weekly_sample(daily_data, 53)
+
+    with stage('sharpe ratios'):
+        AutoBroker.sharpe_ratios(weekly_data)
+
+    hold_positions(weekly_data)
+
+    with stage('target portfolio'):
+        AutoBroker.target_portfolio()
+
+    with stage('order generation'):
+        AutoBroker.generate_sell_orders()
+        AutoBroker.generate_buy_orders()
+
+    return results
+
+
+def run_startup(settings_path: str, tickers_path: str,
+                cache_path: str) -> dict:
+    """
+    Start a new interpreter that imports AutoBroker, loads settings,
+    connects (without opening the connection) and reads the ticker
+    sheet. Return dict of 'times', stage names mapped to seconds taken,
+    and 'pandas', whether pandas was imported before connecting.
+
+    settings_path -- path to settings file
+    tickers_path -- path to excel sheet
+    cache_path -- path to the sqlite database file
+    """
+
+    process = subprocess.run(
+        [sys.executable, '-c', STARTUP_SCRIPT, settings_path, tickers_path,
+         cache_path], capture_output=True, text=True, check=True)
+
+    if process.stderr:
+        print(process.stderr.strip().splitlines()[-1])
+
+    return json.loads(process.stdout.strip().splitlines()[-1])
+
+
+def startup_results(args, commit: str, now: str) -> List[dict]:
+    """
+    Internal helper function.
+
+    Time the start of a run in new interpreters. The first run compiles
+    the ticker sheet into an empty cache, later runs read it from the
+    cache. Return list of result dicts.
+
+    args -- parsed command line arguments
+    commit -- hash of the checked out commit
+    now -- time of the benchmark as an iso string
+    """
+
+    print('Benchmarking startup')
+
+    with tempfile.TemporaryDirectory() as directory:
+        cache_path = os.path.join(directory, 'cache.db')
+        runs = [run_startup(args.settings, args.sheet, cache_path)
+                for _ in range(args.repeat + 1)]
+
+    print('pandas imported before connecting: '
+          + ', '.join(str(run['pandas']) for run in runs))
+
+    results = list()
+    for name in STARTUP_STAGES + ['ticker sheet (cold)']:
+        if name == 'ticker sheet (cold)':
+            seconds = [runs[0]['times'].get('ticker sheet')]
+        else:
+            seconds = [run['times'].get(name) for run in runs[1:]]
+
+        if None in seconds:
+            continue
+
+        results.append({
+            'commit': commit, 'date': now,
+            'python': platform.python_version(),
+            'tickers': 0, 'years': 0, 'stage': name,
+            'seconds': min(seconds), 'peak_mb': None,
+        })
+
+    return results
+
+
+def current_commit() -> str:
+    """ Return the hash of the checked out commit, '' outside git """
+
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'],
+                              capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ''
+
+
+def load_results(path: str = RESULTS_PATH) -> List[dict]:
+    """
+    Load stored benchmark results. Return list of result dicts, oldest
+    first.
+
+    path -- path to results file, one json object per line
+    """
+
+    if not os.path.exists(path):
+        return list()
+
+    with open(path, 'r') as file:
+        return [json.loads(line) for line in file if line.strip()]
+
+
+def save_results(results: List[dict], path: str = RESULTS_PATH):
+    """
+    Append benchmark results to the results file.
+
+    results -- list of result dicts
+    path -- path to results file, one json object per line
+    """
+
+    with open(path, 'a') as file:
+        for result in results:
+            file.write(json.dumps(result) + '\n')
+
+
+def compare(results: List[dict], previous: List[dict],
+            threshold: float = 0.2) -> pd.DataFrame:
+    """
+    Compare results with the most recent stored result of the same
+    scenario and stage from a different commit. Return DataFrame of the
+    results with their change, regressions are changes above threshold.
+
+    results -- list of result dicts of this run
+    previous -- list of stored result dicts, oldest first
+    threshold -- relative slowdown or memory growth that is a regression
+    """
+
+    baseline = dict()
+    for result in previous:
+        if result['commit'] != results[0]['commit']:
+            key = (result['tickers'], result['years'], result['stage'])
+            baseline[key] = result
+
+    rows = list()
+    for result in results:
+        key = (result['tickers'], result['years'], result['stage'])
+        row = {'tickers': result['tickers'], 'years': result['years'],
+               'stage': result['stage'], 'seconds': result['seconds'],
+               'peak (MB)': result['peak_mb']}
+
+        if key in baseline:
+            old = baseline[key]
+            row['baseline'] = old['commit']
+            row['time change'] = result['seconds'] / old['seconds'] - 1
+            if result['peak_mb'] is not None and old['peak_mb']:
+                row['memory change'] = result['peak_mb'] / old['peak_mb'] - 1
+
+            changes = [row.get('time change', 0),
+                       row.get('memory change', 0)]
+            row['regression'] = max(changes) > threshold
+
+        rows.append(row)
+
+    return pd.DataFrame(rows)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark the AutoBroker analysis pipeline over '
+                    'synthetic universes. Run from the repository root '
+                    'as python -m tests.benchmark')
+    parser.add_argument('--tickers', type=int, nargs='+',
+                        default=[50, 1000, 10000],
+                        help='universe sizes to benchmark')
+    parser.add_argument('--years', type=int, nargs='+', default=[1, 2, 10],
+                        help='years of daily bars to benchmark')
+    parser.add_argument('--max-bars', type=int, default=6000000,
+                        help='skip scenarios with more bars than this')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='timing runs per scenario, the fastest counts')
+    parser.add_argument('--no-memory', action='store_true',
+                        help='skip the tracemalloc pass')
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help='relative change reported as a regression')
+    parser.add_argument('--results', default=RESULTS_PATH,
+                        help='file to store results in and compare with')
+    parser.add_argument('--no-save', action='store_true',
+                        help='compare without storing this run')
+    parser.add_argument('--startup', action='store_true',
+                        help='benchmark the start of a run in new '
+                             'interpreters instead of the analysis')
+    parser.add_argument('--settings', default='settings/settings.json',
+                        help='settings file for --startup')
+    parser.add_argument('--sheet', default='settings/tickers.xlsx',
+                        help='ticker sheet for --startup')
+    args = parser.parse_args()
+
+    commit = current_commit()
+    now = datetime.now().isoformat(timespec='seconds')
+
+    results = list()
+
+    if args.startup:
+        results = startup_results(args, commit, now)
+        args.tickers = list()
+
+    for tickers in args.tickers:
+        for years in args.years:
+            if tickers * years * 252 > args.max_bars:
+                print(f'Skipping {tickers} tickers x {years} years, '
+                      f'more than {args.max_bars} bars')
+                continue
+
+            print(f'Benchmarking {tickers} tickers x {years} years')
+            universe = synthetic_universe(tickers, years)
+
+            runs = [run_stages(universe) for _ in range(args.repeat)]
+            peaks = None if args.no_memory else run_stages(universe, True)
+
+            for name in STAGES:
+                results.append({
+                    'commit': commit, 'date': now,
+                    'python': platform.python_version(),
+                    'tickers': tickers, 'years': years, 'stage': name,
+                    'seconds': min(run[name] for run in runs),
+                    'peak_mb': None if peaks is None
+                    else peaks[name] / 2 ** 20,
+                })
+
+            del universe
+
+    if not results:
+        return
+
+    table = compare(results, load_results(args.results), args.threshold)
+
+    with pd.option_context('display.width', 200,
+                           'display.max_columns', 20,
+                           'display.max_rows', 200):
+        print(table.to_string(index=False))
+
+    if not args.no_save:
+        save_results(results, args.results)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,10 +1,25 @@
 import unittest
+import tempfile
+import asyncio
+import concurrent.futures
+import sqlite3
+import json
+import queue
 import math
-from datetime import datetime, timedelta
+import time
+import os
+from datetime import date, datetime, timedelta
+from unittest import mock
+from concurrent.futures.process import BrokenProcessPool
 
 import pandas as pd
+import numpy as np
+import pytz
+from ib_insync import BarData, Order, Stock, Ticker
 
-from autobroker import AutoBroker
+from autobroker import AutoBroker, backtest, daemon, sweep
+from autobroker import fake_ib
+from autobroker.fake_ib import FakeIB
 
 
 def get_sample_data():
@@ -31,11 +46,1241 @@ def get_weekly_data(daily_data):
             while math.isnan(value):
                 previous_date = date - timedelta(days=1)
                 value = daily_data[ticker][previous_date]
-                historical_data[ticker][date] = value
+                historical_data.loc[date, ticker] = value
 
     return historical_data
 
 
+class TestWeeklySample(unittest.TestCase):
+    daily_data = get_sample_data().iloc[::-1]
+
+    def test_matches_reference(self):
+        expected = get_weekly_data(get_sample_data())
+        weekly = AutoBroker.weekly_sample(self.daily_data, 53)
+
+        pd.testing.assert_frame_equal(weekly, expected)
+
+    def test_fills_missing_values(self):
+        daily_data = self.daily_data.copy()
+        fridays = daily_data.index[daily_data.index.weekday == 4]
+        daily_data.loc[fridays[::5], 'VCIT'] = float('nan')
+        daily_data.loc[fridays[-1], 'JNK'] = float('nan')
+
+        expected = get_weekly_data(daily_data.iloc[::-1])
+        weekly = AutoBroker.weekly_sample(daily_data, 53)
+
+        self.assertFalse(weekly.isna().any().any())
+        pd.testing.assert_frame_equal(weekly, expected)
+
+
+class FakeIBTestCase(unittest.TestCase):
+    """
+    Runs each test on a new event loop with a new request scheduler and
+    puts back the AutoBroker globals tests replace.
+    """
+
+    saved_globals = ['ib', 'settings', 'scheduler', 'portfolio',
+                     'contracts', 'sell_orders', 'buy_orders', 'cache_path']
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.saved = {name: getattr(AutoBroker, name)
+                      for name in self.saved_globals}
+        AutoBroker.scheduler = AutoBroker.RequestScheduler()
+
+    def tearDown(self):
+        self.loop.close()
+        for name, value in self.saved.items():
+            setattr(AutoBroker, name, value)
+
+    def contracts(self, symbols):
+        return {symbol: Stock(symbol, 'SMART', 'USD',
+                              conId=AutoBroker.ib.con_id(symbol))
+                for symbol in symbols}
+
+    def use_order_settings(self, **settings):
+        AutoBroker.settings = {
+            'round_quantities_to': 25, 'buying_power_buffer': 0,
+            'timezone': 'US/Eastern', 'sell_wait_duration': '00:01',
+            'sell_wait_until': '', 'buy_wait_duration': '00:01',
+            'buy_wait_until': '', 'auxiliary_sell_type': 'MKT',
+            'auxiliary_buy_type': 'MKT'}
+        AutoBroker.settings.update(settings)
+
+
+class TestHistory(FakeIBTestCase):
+    def test_history_covers_weekly_sample(self):
+        AutoBroker.ib = FakeIB.synthetic(['SPY', 'QQQ'],
+                                         end=date(2020, 12, 31))
+        AutoBroker.settings = {'history_concurrency': 4}
+
+        bars = AutoBroker.fetch_history(self.contracts(['SPY', 'QQQ']))
+        weekly = AutoBroker.weekly_sample(AutoBroker.bars_to_frame(bars), 53)
+
+        self.assertEqual(len(weekly), 53)
+        self.assertFalse(weekly.isna().any().any())
+        self.assertEqual(weekly.index[-1] - weekly.index[0],
+                         timedelta(weeks=52))
+
+    def test_adjusted_last_has_no_end_date(self):
+        AutoBroker.ib = FakeIB.synthetic(['SPY'])
+
+        with self.assertRaises(ValueError):
+            self.loop.run_until_complete(
+                AutoBroker.ib.reqHistoricalDataAsync(
+                    self.contracts(['SPY'])['SPY'], date.today(), '4 W',
+                    '1 day', 'ADJUSTED_LAST', True))
+
+
+class TestContractCache(FakeIBTestCase):
+    def setUp(self):
+        super().setUp()
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'cache.db')
+        self.qualified = dict(AutoBroker.qualified_contracts)
+        AutoBroker.qualified_contracts.clear()
+        AutoBroker.contracts = dict()
+        AutoBroker.settings = {'contract_cache_ttl_days': 7}
+        AutoBroker.ib = FakeIB.synthetic(['SPY', 'QQQ', 'TLT'])
+
+        self.batches = list()
+        qualify = AutoBroker.ib.qualifyContractsAsync
+
+        async def spy(*contracts):
+            self.batches.append([c.symbol for c in contracts])
+            return await qualify(*contracts)
+
+        AutoBroker.ib.qualifyContractsAsync = spy
+
+    def tearDown(self):
+        AutoBroker.qualified_contracts.clear()
+        AutoBroker.qualified_contracts.update(self.qualified)
+        self.directory.cleanup()
+        super().tearDown()
+
+    def qualify(self, symbols):
+        return AutoBroker.qualify_contracts(symbols, self.path)
+
+    def restart(self):
+        # A new process only has the contracts in the cache
+        AutoBroker.qualified_contracts.clear()
+        AutoBroker.contracts = dict()
+
+    def cached(self):
+        connection = sqlite3.connect(self.path)
+        symbols = sorted(symbol for symbol, in connection.execute(
+            'SELECT symbol FROM contracts'))
+        connection.close()
+        return symbols
+
+    def test_misses_qualified_in_one_batch(self):
+        result = self.qualify(['SPY', 'QQQ'])
+
+        self.assertEqual(self.batches, [['SPY', 'QQQ']])
+        self.assertEqual(result['SPY'].conId, AutoBroker.ib.con_id('SPY'))
+        self.assertEqual(set(AutoBroker.contracts), {'SPY', 'QQQ'})
+        self.assertEqual(self.cached(), ['QQQ', 'SPY'])
+
+        # Qualified earlier in the process
+        self.qualify(['SPY', 'QQQ'])
+        self.assertEqual(len(self.batches), 1)
+
+    def test_cache_hits(self):
+        self.qualify(['SPY', 'QQQ'])
+        self.restart()
+
+        result = self.qualify(['SPY', 'QQQ', 'TLT'])
+
+        self.assertEqual(self.batches, [['SPY', 'QQQ'], ['TLT']])
+        self.assertEqual(result['QQQ'].conId, AutoBroker.ib.con_id('QQQ'))
+        self.assertEqual(result['QQQ'].primaryExchange, 'ARCA')
+        self.assertEqual(self.cached(), ['QQQ', 'SPY', 'TLT'])
+
+    def test_expired_contracts(self):
+        self.qualify(['SPY', 'QQQ'])
+        self.restart()
+
+        connection = sqlite3.connect(self.path)
+        connection.execute(
+            'UPDATE contracts SET qualified = ? WHERE symbol = ?',
+            ((datetime.now() - timedelta(days=8)).isoformat(), 'SPY'))
+        connection.commit()
+        connection.close()
+
+        self.qualify(['SPY', 'QQQ'])
+
+        self.assertEqual(self.batches, [['SPY', 'QQQ'], ['SPY']])
+
+    def test_unqualified_contracts_are_not_cached(self):
+        result = self.qualify(['SPY', 'NOPE'])
+
+        self.assertFalse(result['NOPE'].conId)
+        self.assertEqual(self.cached(), ['SPY'])
+        self.assertNotIn('NOPE', AutoBroker.qualified_contracts)
+
+        self.qualify(['SPY', 'NOPE'])
+        self.assertEqual(self.batches, [['SPY', 'NOPE'], ['NOPE']])
+
+    def test_cache_path_read_when_called(self):
+        AutoBroker.cache_path = self.path
+
+        AutoBroker.qualify_contracts(['SPY'])
+
+        self.assertEqual(self.cached(), ['SPY'])
+
+    def test_fake_runs_use_a_temporary_cache(self):
+        AutoBroker.cache_path = self.path
+
+        with fake_ib.temporary_cache(AutoBroker) as path:
+            self.assertEqual(AutoBroker.cache_path, path)
+            self.assertNotEqual(path, self.path)
+
+            AutoBroker.qualify_contracts(['SPY'])
+            self.assertTrue(os.path.exists(path))
+
+        self.assertEqual(AutoBroker.cache_path, self.path)
+        self.assertFalse(os.path.exists(path))
+        self.assertFalse(os.path.exists(self.path))
+
+    def test_contracts_not_on_smart_are_qualified(self):
+        AutoBroker.contracts = {'SPY': Stock(
+            'SPY', 'ARCA', 'USD', conId=AutoBroker.ib.con_id('SPY'))}
+
+        result = self.qualify(['SPY'])
+
+        self.assertEqual(self.batches, [['SPY']])
+        self.assertEqual(result['SPY'].exchange, 'SMART')
+
+
+class TestConcurrentHistory(FakeIBTestCase):
+    symbols = ['SPY', 'QQQ', 'TLT', 'XLK', 'XLY']
+
+    def setUp(self):
+        super().setUp()
+        AutoBroker.ib = FakeIB.synthetic(self.symbols)
+        AutoBroker.settings = {'history_timeout': 0.1, 'history_retries': 2}
+
+        self.attempts = dict()
+        self.in_flight = 0
+        self.most_in_flight = 0
+        self.slow = dict()
+        self.empty = dict()
+        request = AutoBroker.ib.reqHistoricalDataAsync
+
+        # Earlier tickers answer later, a ticker answers too late or
+        # without bars the first slow[ticker] or empty[ticker] times
+        async def spy(**kwargs):
+            symbol = kwargs['contract'].symbol
+            attempt = self.attempts.get(symbol, 0)
+            self.attempts[symbol] = attempt + 1
+            self.in_flight += 1
+            self.most_in_flight = max(self.most_in_flight, self.in_flight)
+
+            try:
+                delay = 0.01 * (len(self.symbols)
+                                - self.symbols.index(symbol))
+                if attempt < self.slow.get(symbol, 0):
+                    delay = 1
+                await asyncio.sleep(delay)
+
+                if attempt < self.empty.get(symbol, 0):
+                    return []
+                return await request(**kwargs)
+            finally:
+                self.in_flight -= 1
+
+        AutoBroker.ib.reqHistoricalDataAsync = spy
+
+    def fetch(self, concurrency):
+        with AutoBroker.stage('history'):
+            bars = self.loop.run_until_complete(
+                AutoBroker.fetch_concurrent_async(
+                    self.contracts(self.symbols), '2 Y', concurrency))
+
+        self.counters = AutoBroker.timeline[-1]['counters']
+        return bars
+
+    def closes(self, bars):
+        return [bar.close for bar in bars]
+
+    def test_results_in_order(self):
+        bars = self.fetch(2)
+
+        self.assertEqual(list(bars), self.symbols)
+        for symbol in self.symbols:
+            self.assertEqual(self.closes(bars[symbol])[-5:],
+                             self.closes(AutoBroker.ib.bars[symbol])[-5:])
+        self.assertEqual(self.most_in_flight, 2)
+        self.assertNotIn('history_retries', self.counters)
+
+    def test_failed_requests_are_retried(self):
+        self.slow = {'QQQ': 1}
+        self.empty = {'XLK': 2}
+
+        bars = self.fetch(3)
+
+        self.assertEqual(self.attempts['QQQ'], 2)
+        self.assertEqual(self.attempts['XLK'], 3)
+        self.assertTrue(bars['QQQ'])
+        self.assertTrue(bars['XLK'])
+        self.assertEqual(self.counters['history_retries'], 3)
+
+    def test_partial_failures(self):
+        self.empty = {'TLT': 3}
+
+        bars = self.fetch(3)
+
+        self.assertEqual(list(bars), self.symbols)
+        self.assertEqual(bars['TLT'], [])
+        self.assertEqual(self.attempts['TLT'], 3)
+        self.assertTrue(all(bars[symbol] for symbol in self.symbols
+                            if symbol != 'TLT'))
+
+
+class TestShardedHistory(FakeIBTestCase):
+    symbols = ['S%d' % n for n in range(7)]
+
+    def setUp(self):
+        super().setUp()
+        AutoBroker.ib = FakeIB.synthetic(self.symbols)
+        AutoBroker.settings = {'TWS_ip': '127.0.0.1', 'TWS_port': 7497,
+                               'TWS_id': 0, 'history_shard_size': 3,
+                               'history_shard_retries': 1}
+        self.pools = list()
+        self.failing = set()
+        self.failing_pools = 2
+
+    def pool(self, workers, context, initializer, initargs):
+        # Stands in for ProcessPoolExecutor, a chunk fails in the first
+        # failing_pools pools if it has a ticker in failing
+        test = self
+        bars = AutoBroker.ib.bars
+
+        class Pool:
+            def __enter__(self):
+                test.pools.append((workers, initializer, initargs))
+                return self
+
+            def __exit__(self, *args):
+                pass
+
+            def submit(self, fn, fields):
+                future = concurrent.futures.Future()
+
+                if (test.failing & set(fields)
+                        and len(test.pools) <= test.failing_pools):
+                    future.set_exception(BrokenProcessPool())
+                else:
+                    future.set_result({
+                        ticker: [(bar.date.isoformat(), bar.close)
+                                 for bar in bars[ticker]
+                                 if bar.date > bars[ticker][-1].date
+                                 - timedelta(days=730)]
+                        for ticker in fields})
+
+                return future
+
+        return Pool()
+
+    def fetch(self):
+        with mock.patch('concurrent.futures.ProcessPoolExecutor',
+                        self.pool):
+            bars = self.loop.run_until_complete(
+                AutoBroker.fetch_sharded_async(
+                    self.contracts(self.symbols), 2))
+
+        return {ticker: [(bar.date, bar.close) for bar in ticker_bars]
+                for ticker, ticker_bars in bars.items()}
+
+    def expected(self):
+        bars = AutoBroker.fetch_bars(self.contracts(self.symbols), '2 Y')
+        return {ticker: [(bar.date, bar.close) for bar in ticker_bars]
+                for ticker, ticker_bars in bars.items()}
+
+    def test_chunks_over_workers(self):
+        bars = self.fetch()
+
+        self.assertEqual(list(bars), self.symbols)
+        self.assertEqual(bars, self.expected())
+
+        (workers, initializer, (client_ids, settings)), = self.pools
+        self.assertEqual(workers, 2)
+        self.assertIs(initializer, AutoBroker.init_shard)
+        self.assertEqual(sorted([client_ids.get(), client_ids.get()]),
+                         [1, 2])
+        self.assertEqual(settings['history_shards'], 1)
+        self.assertEqual(settings['pacing_history_requests'], 30)
+
+    def test_failed_chunks_are_retried(self):
+        self.failing = {'S4'}
+        self.failing_pools = 1
+
+        self.assertEqual(self.fetch(), self.expected())
+        self.assertEqual([workers for workers, _, _ in self.pools], [2, 1])
+        self.assertEqual(AutoBroker.ib.requests['reqHistoricalData'], 7)
+
+    def test_falls_back_to_main_connection(self):
+        self.failing = {'S4'}
+
+        self.assertEqual(self.fetch(), self.expected())
+        self.assertEqual([workers for workers, _, _ in self.pools], [2, 1])
+
+        # The failed chunk of 3 tickers, and the 7 of expected()
+        self.assertEqual(AutoBroker.ib.requests['reqHistoricalData'], 10)
+
+    def test_worker(self):
+        client_ids = queue.Queue()
+        client_ids.put(3)
+
+        with mock.patch.object(AutoBroker, 'IB',
+                               lambda: FakeIB.synthetic(self.symbols)):
+            AutoBroker.init_shard(client_ids, AutoBroker.settings)
+
+        self.assertEqual(AutoBroker.settings['TWS_id'], 3)
+        self.assertTrue(AutoBroker.ib.isConnected())
+
+        fields = {ticker: {'symbol': ticker, 'secType': 'STK',
+                           'exchange': 'SMART', 'currency': 'USD'}
+                  for ticker in ['S1', 'S2']}
+        bars = AutoBroker.fetch_shard(fields)
+
+        self.assertEqual(list(bars), ['S1', 'S2'])
+        self.assertEqual(bars['S1'][-1],
+                         (AutoBroker.ib.bars['S1'][-1].date.isoformat(),
+                          AutoBroker.ib.bars['S1'][-1].close))
+
+
+class TestBarCache(FakeIBTestCase):
+    symbols = ['SPY', 'QQQ']
+
+    def setUp(self):
+        super().setUp()
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'cache.db')
+        self.cached = (AutoBroker.cached_closes, AutoBroker.cached_refreshes)
+        AutoBroker.cached_closes = dict()
+        AutoBroker.cached_refreshes = dict()
+        AutoBroker.settings = {'bar_cache_refresh_days': 7}
+
+        # The last bar is today's, still forming
+        fake = FakeIB.synthetic(self.symbols, end=date.today())
+        for bars in fake.bars.values():
+            if bars[-1].date != date.today():
+                bars.append(BarData(date=date.today(), close=bars[-1].close))
+        AutoBroker.ib = fake
+
+        self.durations = list()
+        request = fake.reqHistoricalDataAsync
+
+        async def spy(**kwargs):
+            self.durations.append(kwargs['durationStr'])
+            return await request(**kwargs)
+
+        fake.reqHistoricalDataAsync = spy
+
+    def tearDown(self):
+        AutoBroker.cached_closes, AutoBroker.cached_refreshes = self.cached
+        self.directory.cleanup()
+        super().tearDown()
+
+    def cached_bars(self):
+        self.durations.clear()
+        bars = AutoBroker.cached_bars(self.contracts(self.symbols), self.path)
+        return {symbol: [(bar.date, bar.close) for bar in symbol_bars]
+                for symbol, symbol_bars in bars.items()}
+
+    def expected(self):
+        return {symbol: [(bar.date, bar.close) for bar in bars
+                         if bar.date > date.today() - timedelta(days=730)]
+                for symbol, bars in AutoBroker.ib.bars.items()}
+
+    def test_tail_fetch(self):
+        self.assertEqual(self.cached_bars(), self.expected())
+        self.assertEqual(self.durations, ['2 Y', '2 Y'])
+
+        # The forming bar moved since the last run
+        AutoBroker.ib.bars['SPY'][-1].close += 1
+
+        self.assertEqual(self.cached_bars(), self.expected())
+        self.assertNotIn('2 Y', self.durations)
+
+        connection = sqlite3.connect(self.path)
+        days = [day for day, in connection.execute('SELECT date FROM bars')]
+        connection.close()
+        self.assertNotIn(date.today().isoformat(), days)
+
+    def test_restated_bars_are_refreshed(self):
+        self.cached_bars()
+
+        bars = AutoBroker.ib.bars['QQQ']
+        for bar in bars:
+            bar.close = round(bar.close * 0.5, 2)
+
+        self.assertEqual(self.cached_bars(), self.expected())
+        self.assertEqual(self.durations.count('2 Y'), 1)
+
+    def test_refresh_days_expiry(self):
+        self.cached_bars()
+
+        AutoBroker.cached_refreshes['SPY'] -= timedelta(days=7)
+
+        self.assertEqual(self.cached_bars(), self.expected())
+        self.assertEqual(self.durations.count('2 Y'), 1)
+
+
+class TestPipelined(FakeIBTestCase):
+    def setUp(self):
+        super().setUp()
+        self.use_order_settings()
+
+        # Selling SPY pays for QQQ, the account starts without cash
+        AutoBroker.ib = FakeIB(
+            quotes={'SPY': {'bid': 100.0, 'ask': 100.0},
+                    'QQQ': {'bid': 50.0, 'ask': 50.0}},
+            positions={'SPY': (100, 90.0)}, fill_delay=0.05)
+
+        AutoBroker.portfolio = AutoBroker.Portfolio()
+        AutoBroker.portfolio.set('Price', ['SPY', 'QQQ'], [100.0, 50.0])
+
+        contracts = self.contracts(['SPY', 'QQQ'])
+        AutoBroker.sell_orders = [(contracts['SPY'], Order(
+            action='SELL', orderType='MKT', totalQuantity=100, account=''))]
+        self.buy = Order(action='BUY', orderType='MKT', totalQuantity=150,
+                         account='')
+        AutoBroker.buy_orders = [(contracts['QQQ'], self.buy)]
+
+    def execute(self, funds=0.0):
+        return AutoBroker.execute_pipelined({'': funds},
+                                            {('', 'QQQ'): 7500.0})
+
+    def test_buys_wait_for_sell_proceeds(self):
+        buy_trades = self.execute()
+
+        sell, buy = AutoBroker.ib.trades()
+        self.assertEqual(buy_trades, [buy])
+        self.assertEqual(buy.contract.symbol, 'QQQ')
+        self.assertEqual(buy.order.totalQuantity, 150)
+        self.assertTrue(buy.isDone())
+        self.assertGreaterEqual(buy.log[0].time, sell.fills[0].time)
+        self.assertEqual(AutoBroker.ib.holdings['QQQ'][0], 150)
+
+    def test_buys_from_available_funds_go_first(self):
+        self.execute(funds=7500.0)
+
+        buy, sell = AutoBroker.ib.trades()
+        self.assertEqual(buy.contract.symbol, 'QQQ')
+        self.assertEqual(sell.contract.symbol, 'SPY')
+
+    def test_final_pass_shrinks_buys(self):
+        # 10000 of proceeds at 51 a share (2% buffer) buys 196 shares,
+        # rounded down to 175
+        AutoBroker.settings['buying_power_buffer'] = 2
+        self.buy.totalQuantity = 300
+
+        buy_trades = self.execute()
+
+        self.assertEqual(len(buy_trades), 1)
+        self.assertEqual(buy_trades[0].order.totalQuantity, 175)
+        self.assertEqual(AutoBroker.ib.holdings['QQQ'][0], 175)
+
+    def test_final_pass_drops_buys_without_cash(self):
+        AutoBroker.sell_orders = list()
+
+        self.assertEqual(self.execute(), [])
+        self.assertEqual(AutoBroker.ib.trades(), [])
+
+    def test_execution_handler_removed_on_error(self):
+        handlers = len(AutoBroker.ib.execDetailsEvent)
+
+        with mock.patch.object(AutoBroker, 'execute_sell_orders',
+                               side_effect=RuntimeError('connection lost')):
+            with self.assertRaises(RuntimeError):
+                self.execute()
+
+        self.assertEqual(len(AutoBroker.ib.execDetailsEvent), handlers)
+
+
+class TestWaitForTrades(FakeIBTestCase):
+    def setUp(self):
+        super().setUp()
+        self.use_order_settings()
+        AutoBroker.ib = FakeIB(quotes={'SPY': {'bid': 99.0, 'ask': 101.0},
+                                       'QQQ': {'bid': 49.0, 'ask': 51.0}},
+                               fill_delay=0.05)
+        self.trades = [AutoBroker.place_order(contract, Order(
+            action='BUY', orderType='MKT', totalQuantity=10))
+            for contract in self.contracts(['SPY', 'QQQ']).values()]
+
+    def wait(self, seconds):
+        cutoff = datetime.now(pytz.utc) + timedelta(seconds=seconds)
+        start = time.time()
+        complete = AutoBroker.wait_for_trades(self.trades, cutoff)
+        return complete, time.time() - start
+
+    def assert_handlers_removed(self):
+        for trade in self.trades:
+            self.assertEqual(len(trade.statusEvent), 0)
+            self.assertEqual(len(trade.fillEvent), 0)
+
+    def test_wakes_on_last_fill(self):
+        complete, seconds = self.wait(5)
+
+        self.assertTrue(complete)
+        self.assertLess(seconds, 1)
+        self.assertTrue(all(trade.isDone() for trade in self.trades))
+        self.assert_handlers_removed()
+
+    def test_timeout(self):
+        AutoBroker.ib.fill_delay = None
+        self.trades.append(AutoBroker.place_order(
+            self.trades[0].contract,
+            Order(action='SELL', orderType='MKT', totalQuantity=10)))
+
+        complete, seconds = self.wait(0.1)
+
+        self.assertFalse(complete)
+        self.assertGreaterEqual(seconds, 0.1)
+        self.assertLess(seconds, 1)
+        self.assert_handlers_removed()
+
+    def test_cutoff_in_the_past(self):
+        complete, seconds = self.wait(-60)
+
+        self.assertFalse(complete)
+        self.assertLess(seconds, 0.05)
+
+    def test_trades_already_done(self):
+        AutoBroker.ib.sleep(0.1)
+
+        # Done trades need no waiting, even past the cutoff
+        complete, seconds = self.wait(-60)
+
+        self.assertTrue(complete)
+        self.assertLess(seconds, 0.05)
+        self.assertTrue(AutoBroker.wait_for_trades([]))
+
+    def test_cancelled_trades_are_done(self):
+        # Limit orders far below the market never fill
+        self.trades = [AutoBroker.place_order(trade.contract, Order(
+            action='BUY', orderType='LMT', totalQuantity=10, lmtPrice=1.0))
+            for trade in self.trades]
+        for trade in self.trades:
+            self.loop.call_later(0.1, AutoBroker.ib.cancelOrder, trade.order)
+
+        complete, seconds = self.wait(5)
+
+        self.assertTrue(complete)
+        self.assertLess(seconds, 1)
+        self.assertEqual([trade.orderStatus.status for trade in self.trades],
+                         ['Cancelled', 'Cancelled'])
+        self.assert_handlers_removed()
+
+
+class TestRepricing(FakeIBTestCase):
+    def setUp(self):
+        super().setUp()
+        self.use_order_settings(reprice_steps=4, reprice_interval=0.01)
+        AutoBroker.ib = FakeIB(quotes={'SPY': {'bid': 99.0, 'ask': 101.0}},
+                               fill_delay=0.001)
+        self.spy = self.contracts(['SPY'])['SPY']
+
+    def place(self, order_type):
+        order = Order(action='BUY', orderType=order_type, totalQuantity=100)
+        AutoBroker.price_orders([(self.spy, order)])
+        return AutoBroker.place_order(self.spy, order)
+
+    def test_limit_price_steps(self):
+        ticker = Ticker(bid=99.0, ask=101.0)
+
+        self.assertEqual([AutoBroker.limit_price(ticker, 'BUY', step, 4)
+                          for step in range(5)],
+                         [100.0, 100.25, 100.5, 100.75, 101.0])
+        self.assertEqual([AutoBroker.limit_price(ticker, 'SELL', step, 4)
+                          for step in range(5)],
+                         [100.0, 99.75, 99.5, 99.25, 99.0])
+        self.assertTrue(math.isnan(AutoBroker.limit_price(Ticker(), 'BUY')))
+
+    def test_walks_to_touch(self):
+        trade = self.place('LMT')
+        prices = [trade.order.lmtPrice]
+        trade.modifyEvent += lambda trade: prices.append(trade.order.lmtPrice)
+
+        self.assertTrue(AutoBroker.wait_for_trades(
+            [trade], datetime.now(pytz.utc) + timedelta(seconds=5),
+            reprice=True))
+        self.assertEqual(prices, [100.0, 100.25, 100.5, 100.75, 101.0])
+        self.assertEqual(trade.orderStatus.avgFillPrice, 101.0)
+
+    def test_only_limit_orders_are_repriced(self):
+        AutoBroker.ib.fill_delay = None
+        trade = self.place('MIDPRICE')
+
+        self.loop.run_until_complete(
+            AutoBroker.reprice_trades_async([trade], 4, 0.01))
+
+        self.assertEqual(AutoBroker.ib.requests['placeOrder'], 1)
+        self.assertNotIn('reqTickers', AutoBroker.ib.requests)
+
+    def test_resubmit_trades(self):
+        AutoBroker.ib.fill_delay = None
+        trade = self.place('LMT')
+        trades = [trade]
+
+        new_trades = AutoBroker.resubmit_trades(trades, 'BUY', 'MKT')
+
+        self.assertEqual(trade.orderStatus.status, 'Cancelled')
+        self.assertEqual(trades, new_trades)
+        self.assertEqual(new_trades[0].order.orderType, 'MKT')
+        self.assertEqual(new_trades[0].order.totalQuantity, 100)
+        self.assertEqual(AutoBroker.ib.openTrades(), new_trades)
+
+
+class TestAllocate(unittest.TestCase):
+    sharpes = pd.Series([1.0, 5.0, 3.0, 2.0, 4.0],
+                        index=['E', 'A', 'C', 'D', 'B'])
+    adjusted = pd.Series([0.04, 0.6, 0.1, 0.06, 0.2],
+                         index=['E', 'A', 'C', 'D', 'B'])
+    prices = pd.Series([10.0, 20.0, 0.0, 40.0, 50.0],
+                       index=['E', 'A', 'C', 'D', 'B'])
+
+    def test_cap_carries_excess(self):
+        allocation = AutoBroker.allocate(self.sharpes, self.adjusted,
+                                         self.prices, 1000, 13, 0.25)
+
+        self.assertEqual(list(allocation.tickers), ['A', 'B', 'C', 'D', 'E'])
+        for share, expected in zip(allocation.shares,
+                                   [0.25, 0.25, 0.25, 0.21, 0.04]):
+            self.assertAlmostEqual(share, expected)
+
+        self.assertAlmostEqual(allocation.values[0], 250)
+        self.assertAlmostEqual(allocation.counts[0], 12.5)
+        self.assertTrue(math.isnan(allocation.counts[2]))
+
+    def test_max_size(self):
+        allocation = AutoBroker.allocate(self.sharpes, self.adjusted,
+                                         self.prices, 1000, 2, None)
+
+        for share, expected in zip(allocation.shares,
+                                   [0.75, 0.25, 0, 0, 0]):
+            self.assertAlmostEqual(share, expected)
+
+        self.assertEqual(list(allocation.weights), [0.6, 0.2, 0, 0, 0])
+
+    def test_leftover_stays_in_cash(self):
+        shares, _ = AutoBroker.target_shares([2.0, 1.0], [0.5, 0.5], 13, 0.25)
+
+        self.assertEqual(list(shares), [0.25, 0.25])
+
+    def test_rows_are_independent(self):
+        sharpes = np.array([self.sharpes.to_numpy(),
+                            self.sharpes.to_numpy()[::-1]])
+        adjusted = np.array([self.adjusted.to_numpy(),
+                             self.adjusted.to_numpy()[::-1]])
+
+        shares, _ = AutoBroker.target_shares(sharpes, adjusted, 3, 0.25)
+
+        for row in range(2):
+            expected, _ = AutoBroker.target_shares(
+                sharpes[row], adjusted[row], 3, 0.25)
+            np.testing.assert_allclose(shares[row], expected)
+
+
+class TestOrderQuantities(unittest.TestCase):
+    actual_cnt = np.array([100.0, 100.0, 10.0, 0.0, 50.0])
+    target_cnt = np.array([0.0, 60.0, 8.0, 40.0, float('nan')])
+    actual_pct = np.array([10.0, 10.0, 10.0, 0.0, 5.0])
+    target_pct = np.array([0.0, 6.0, 9.0, 4.0, 0.0])
+
+    def test_sell_quantities(self):
+        numbers = AutoBroker.sell_quantities(
+            self.actual_cnt, self.target_cnt, self.actual_pct,
+            self.target_pct, 25)
+
+        self.assertEqual(list(numbers), [100, 50, 0, 0, 0])
+
+    def test_buy_quantities(self):
+        numbers = AutoBroker.buy_quantities(
+            self.actual_cnt, self.target_cnt, self.actual_pct,
+            self.target_pct, 25)
+
+        self.assertEqual(list(numbers), [0, 0, 0, 25, 0])
+
+
+class TestMetrics(unittest.TestCase):
+    def setUp(self):
+        AutoBroker.timeline.clear()
+
+    def test_stage_records_counters(self):
+        with AutoBroker.stage('history'):
+            AutoBroker.count('bars', 500)
+            AutoBroker.count('bars', 250)
+            AutoBroker.observe('fill_seconds', [0.5, 1.5])
+
+        AutoBroker.count('bars', 100)  # outside of a stage
+
+        metrics = AutoBroker.timeline[0]
+        self.assertEqual(metrics['stage'], 'history')
+        self.assertEqual(metrics['counters'], {'bars': 750})
+        self.assertEqual(metrics['observations'],
+                         {'fill_seconds': [0.5, 1.5]})
+        self.assertGreaterEqual(metrics['seconds'], 0)
+
+    def test_write_prometheus(self):
+        with AutoBroker.stage('history'):
+            AutoBroker.count('bars', 750)
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'autobroker.prom')
+            AutoBroker.write_prometheus(path)
+
+            with open(path, 'r') as file:
+                lines = file.read().splitlines()
+
+        self.assertIn('autobroker_stage_count{stage="history",'
+                      'counter="bars"} 750', lines)
+        self.assertIn('# TYPE autobroker_stage_seconds gauge', lines)
+
+
+class TestScheduler(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+    def tearDown(self):
+        self.loop.close()
+
+    def test_priority_order(self):
+        bucket = AutoBroker.TokenBucket(rate=50, capacity=1)
+        served = list()
+
+        async def request(name, priority):
+            await bucket.acquire(1, priority)
+            served.append(name)
+
+        async def requests():
+            await bucket.acquire()  # empty the bucket
+            await asyncio.gather(
+                request('data', AutoBroker.PRIORITY_DATA),
+                request('quotes', AutoBroker.PRIORITY_QUOTES),
+                request('order', AutoBroker.PRIORITY_ORDER))
+
+        self.loop.run_until_complete(requests())
+
+        self.assertEqual(served, ['order', 'quotes', 'data'])
+
+    def test_identical_requests_made_once(self):
+        scheduler = AutoBroker.RequestScheduler()
+        made = list()
+
+        async def factory():
+            made.append(1)
+            await asyncio.sleep(0.01)
+            return ['bar']
+
+        async def requests():
+            return await asyncio.gather(*[
+                scheduler.request('history', factory, key=('SPY', '2 Y'))
+                for _ in range(3)])
+
+        results = self.loop.run_until_complete(requests())
+
+        self.assertEqual(results, [['bar']] * 3)
+        self.assertEqual(len(made), 1)
+
+    def test_stages_overlap(self):
+        AutoBroker.timeline.clear()
+        events = list()
+
+        def network(name):
+            async def request():
+                events.append(f'{name} start')
+                await asyncio.sleep(0.05)
+                AutoBroker.count('requests')
+                events.append(f'{name} end')
+            return request
+
+        stages = {
+            'history': (network('history'), []),
+            'quotes': (network('quotes'), []),
+            'sharpe': (lambda: events.append('sharpe'), ['history']),
+            'target': (lambda: events.append('target'),
+                       ['sharpe', 'quotes']),
+        }
+
+        self.loop.run_until_complete(AutoBroker.run_stages_async(stages))
+
+        self.assertEqual(events[:2], ['history start', 'quotes start'])
+        self.assertLess(events.index('history end'), events.index('sharpe'))
+        self.assertEqual(events[-1], 'target')
+
+        # Counters stay with their own stage while stages overlap
+        counters = {m['stage']: m['counters'] for m in AutoBroker.timeline}
+        self.assertEqual(counters['history'], {'requests': 1})
+        self.assertEqual(counters['quotes'], {'requests': 1})
+
+        with self.assertRaises(ValueError):
+            self.loop.run_until_complete(AutoBroker.run_stages_async(
+                {'a': (print, ['b']), 'b': (print, ['a'])}))
+
+
+class TestDaemonSchedule(unittest.TestCase):
+    def test_parse_schedule(self):
+        minutes, hours, days, months, weekdays = daemon.parse_schedule(
+            '35 15 * * 1-5')
+
+        self.assertEqual(minutes, {35})
+        self.assertEqual(hours, {15})
+        self.assertEqual(days, set(range(1, 32)))
+        self.assertEqual(months, set(range(1, 13)))
+        self.assertEqual(weekdays, {0, 1, 2, 3, 4})
+
+    def test_weekdays_count_from_sunday(self):
+        # Cron Sunday is 0 or 7, datetime.weekday() Sunday is 6
+        self.assertEqual(daemon.parse_schedule('0 0 * * 0')[4], {6})
+        self.assertEqual(daemon.parse_schedule('0 0 * * 7')[4], {6})
+        self.assertEqual(daemon.parse_schedule('0 0 * * 6')[4], {5})
+        self.assertEqual(daemon.parse_schedule('0 0 * * *')[4],
+                         set(range(7)))
+
+    def test_lists_ranges_and_steps(self):
+        minutes, hours, days, _, _ = daemon.parse_schedule(
+            '*/15 0-12/6 1,15 * *')
+
+        self.assertEqual(minutes, {0, 15, 30, 45})
+        self.assertEqual(hours, {0, 6, 12})
+        self.assertEqual(days, {1, 15})
+        self.assertEqual(daemon.parse_schedule('5/20 * * * *')[0],
+                         {5, 25, 45})
+
+    def test_invalid_schedules(self):
+        for expression in ['* * * *', '60 * * * *', '* 0-24 * * *',
+                           '* * 0 * *', '* * * * 8']:
+            with self.assertRaises(ValueError):
+                daemon.parse_schedule(expression)
+
+    def test_next_time(self):
+        schedule = daemon.parse_schedule('35 15 * * 1-5')
+        friday = datetime(2020, 1, 3)
+
+        self.assertEqual(daemon.next_time(schedule, friday.replace(hour=9)),
+                         datetime(2020, 1, 3, 15, 35))
+        self.assertEqual(
+            daemon.next_time(schedule, friday.replace(hour=15, minute=35)),
+            datetime(2020, 1, 6, 15, 35))
+        self.assertEqual(
+            daemon.next_time(daemon.parse_schedule('0 0 29 2 *'),
+                             datetime(2023, 3, 1)),
+            datetime(2024, 2, 29))
+
+    def test_never_matches(self):
+        self.assertIsNone(daemon.next_time(
+            daemon.parse_schedule('0 0 30 2 *'), datetime(2020, 1, 1)))
+        self.assertIsNone(daemon.next_time(
+            daemon.parse_schedule('0 0 29 2 *'), datetime(2021, 3, 1)))
+
+
+class TestDaemonCommands(FakeIBTestCase):
+    def setUp(self):
+        super().setUp()
+        AutoBroker.ib = FakeIB(quotes=dict())
+        AutoBroker.ib.connect()
+        self.qualified = dict(AutoBroker.qualified_contracts)
+        daemon.tickers = {'SPY'}
+        daemon.stopping = False
+
+    def tearDown(self):
+        AutoBroker.qualified_contracts.clear()
+        AutoBroker.qualified_contracts.update(self.qualified)
+        daemon.tickers = None
+        daemon.stopping = False
+        daemon.busy = False
+        super().tearDown()
+
+    def send(self, command):
+        async def send():
+            server = await asyncio.start_server(daemon.handle_command,
+                                                '127.0.0.1', 0)
+            port = server.sockets[0].getsockname()[1]
+            reader, writer = await asyncio.open_connection('127.0.0.1', port)
+            writer.write((command + '\n').encode())
+            answer = await reader.readline()
+            writer.close()
+            server.close()
+            return json.loads(answer)
+
+        return self.loop.run_until_complete(send())
+
+    def test_status(self):
+        answer = self.send('status')
+
+        self.assertTrue(answer['connected'])
+        self.assertFalse(answer['busy'])
+
+    def test_reload(self):
+        AutoBroker.qualified_contracts['SPY'] = Stock('SPY', 'SMART', 'USD')
+
+        self.assertEqual(self.send('reload'), {'status': 'done'})
+        self.assertIsNone(daemon.tickers)
+        self.assertEqual(AutoBroker.qualified_contracts, dict())
+
+    def test_rebalance(self):
+        with mock.patch.object(daemon, 'rebalance_now',
+                               return_value={'status': 'done'}) as rebalance:
+            self.assertEqual(self.send('rebalance'), {'status': 'done'})
+
+        rebalance.assert_called_once_with()
+
+    def test_rebalance_refused(self):
+        daemon.busy = True
+        self.assertEqual(daemon.rebalance_now(), {'status': 'busy'})
+
+        daemon.busy = False
+        AutoBroker.ib.disconnect()
+        self.assertEqual(daemon.rebalance_now()['status'], 'error')
+
+    def test_unknown_command(self):
+        self.assertEqual(self.send('sell everything')['status'], 'error')
+
+
+class TestTickers(unittest.TestCase):
+    def test_compiled_ticker_sheet(self):
+        sheet = pd.DataFrame([['SPY'], ['QQQ'], [None]])
+
+        with tempfile.TemporaryDirectory() as directory, \
+                mock.patch.object(pd, 'read_excel',
+                                  return_value=sheet) as read_excel:
+            path = os.path.join(directory, 'tickers.xlsx')
+            cache = os.path.join(directory, 'cache.db')
+            open(path, 'w').close()
+
+            first = AutoBroker.read_tickers(path, cache)
+            second = AutoBroker.read_tickers(path, cache)
+            self.assertEqual(read_excel.call_count, 1)
+
+            os.utime(path, (0, os.path.getmtime(path) + 60))
+            third = AutoBroker.read_tickers(path, cache)
+            self.assertEqual(read_excel.call_count, 2)
+
+        self.assertEqual(first, {'SPY', 'QQQ'})
+        self.assertEqual(second, first)
+        self.assertEqual(third, first)
+
+
+class TestPrices(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.portfolio = AutoBroker.portfolio
+        self.ib = AutoBroker.ib
+        AutoBroker.portfolio = AutoBroker.Portfolio()
+
+    def tearDown(self):
+        self.loop.close()
+        AutoBroker.portfolio = self.portfolio
+        AutoBroker.ib = self.ib
+
+    def test_price_preference(self):
+        ticker = Ticker(bid=9.0, ask=11.0, last=float('nan'), close=8.0)
+
+        self.assertEqual(AutoBroker.quote_price(ticker, ['last', 'mid']),
+                         (10.0, 'mid'))
+        self.assertEqual(AutoBroker.quote_price(ticker, ['close', 'mid']),
+                         (8.0, 'close'))
+        self.assertTrue(math.isnan(
+            AutoBroker.quote_price(ticker, ['last'])[0]))
+
+    def test_falls_back_to_history(self):
+        fake = FakeIB.synthetic(['SPY', 'QQQ'], days=30)
+        del fake.quotes['QQQ']
+
+        AutoBroker.settings = {}
+        AutoBroker.ib = fake
+        AutoBroker.contracts = {symbol: Stock(symbol, 'SMART', 'USD')
+                                for symbol in ['SPY', 'QQQ']}
+        AutoBroker.historical_data = pd.DataFrame(
+            {'SPY': [1.0, 2.0], 'QQQ': [3.0, 4.0]})
+
+        prices = AutoBroker.get_prices()
+
+        self.assertEqual(prices['SPY'], fake.quotes['SPY']['last'])
+        self.assertEqual(prices['QQQ'], 4.0)
+
+        # Quotes later than the deadline are not waited for
+        AutoBroker.ib = FakeIB.synthetic(['SPY', 'QQQ'], days=30, latency=1)
+        AutoBroker.settings = {'price_timeout': 0.1}
+
+        prices = AutoBroker.get_prices()
+
+        self.assertEqual(prices, {'SPY': 2.0, 'QQQ': 4.0})
+
+
+class TestAccounts(unittest.TestCase):
+    def setUp(self):
+        self.portfolio = AutoBroker.portfolio
+        self.ib = AutoBroker.ib
+        AutoBroker.portfolio = AutoBroker.Portfolio()
+        self.orders = (AutoBroker.sell_orders, AutoBroker.buy_orders)
+
+    def tearDown(self):
+        AutoBroker.portfolio = self.portfolio
+        AutoBroker.ib = self.ib
+        AutoBroker.sell_orders, AutoBroker.buy_orders = self.orders
+
+    def test_account_orders(self):
+        quotes = {'SPY': {'last': 100.0}, 'QQQ': {'last': 50.0}}
+        AutoBroker.ib = FakeIB(quotes=quotes, cash=10000,
+                               positions={'SPY': (100, 100.0)},
+                               accounts={'DU1': (20000, dict())})
+        AutoBroker.settings = {
+            'TWS_account': '', 'max_portfolio_size': 2,
+            'max_position_percent': 100, 'round_quantities_to': 1,
+            'primary_sell_type': 'MKT', 'primary_buy_type': 'MKT'}
+        AutoBroker.contracts = {
+            symbol: Stock(symbol, 'SMART', 'USD',
+                          conId=AutoBroker.ib.con_id(symbol))
+            for symbol in quotes}
+
+        AutoBroker.sell_orders = list()
+        AutoBroker.buy_orders = list()
+
+        shared = AutoBroker.Portfolio(['SPY', 'QQQ'])
+        shared.set('Price', ['SPY', 'QQQ'], [100.0, 50.0])
+        shared.set('Sharpe (unadjusted)', ['SPY', 'QQQ'], 1.0)
+        shared.set('Sharpe (adjusted)', ['SPY', 'QQQ'], 1.0)
+        before = shared.to_frame()
+
+        states = {account: AutoBroker.account_orders(account, shared)
+                  for account in ['DU0', 'DU1']}
+
+        def summary(account):
+            return sorted((contract.symbol, order.totalQuantity)
+                          for contract, order in AutoBroker.buy_orders
+                          if order.account == account)
+
+        self.assertEqual(summary('DU0'), [('QQQ', 200)])
+        self.assertEqual(summary('DU1'), [('QQQ', 200), ('SPY', 100)])
+        self.assertEqual(AutoBroker.sell_orders, [])
+        self.assertEqual(states['DU1'].value, 20000)
+        self.assertEqual(states['DU1'].account, 'DU1')
+        self.assertEqual(AutoBroker.settings['TWS_account'], '')
+        pd.testing.assert_frame_equal(shared.to_frame(), before)
+
+    def test_portfolio(self):
+        state = AutoBroker.Portfolio(['SPY', 'QQQ'])
+        state.set('Sharpe (unadjusted)', ['QQQ', 'TLT'], [2.0, 3.0])
+        state.fillna(['Actual (cnt)'])
+        state.sort('Sharpe (unadjusted)')
+
+        self.assertEqual(state.tickers, ['TLT', 'QQQ', 'SPY'])
+        self.assertEqual(state.get('Sharpe (unadjusted)', 'QQQ'), 2.0)
+        self.assertEqual(list(state['Actual (cnt)']), [0.0, 0.0, 0.0])
+        self.assertTrue(math.isnan(state.get('Price', 'SPY')))
+
+
+class TestJournal(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.portfolio = AutoBroker.portfolio
+        self.ib = AutoBroker.ib
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'cache.db')
+        AutoBroker.settings = {'run_journal': True}
+
+    def tearDown(self):
+        self.loop.close()
+        AutoBroker.portfolio = self.portfolio
+        AutoBroker.ib = self.ib
+        AutoBroker.close_journal()
+        self.directory.cleanup()
+
+    def test_resume_restores_stages(self):
+        calls = list()
+
+        def sharpe():
+            calls.append('sharpe')
+            AutoBroker.portfolio.set('Sharpe (unadjusted)', ['SPY'], 1.5)
+            AutoBroker.portfolio.set('Sharpe (adjusted)', ['SPY'], 2.0)
+
+        def failing():
+            raise RuntimeError('connection lost')
+
+        stages = {'sharpe': (sharpe, []), 'target': (failing, ['sharpe'])}
+
+        AutoBroker.portfolio = AutoBroker.Portfolio()
+        self.assertFalse(AutoBroker.start_journal({'SPY'}, self.path))
+        with self.assertRaises(RuntimeError):
+            self.loop.run_until_complete(AutoBroker.run_stages_async(
+                AutoBroker.journaled_stages(stages)))
+
+        AutoBroker.portfolio = AutoBroker.Portfolio()
+        self.assertTrue(AutoBroker.start_journal({'SPY'}, self.path))
+        stages['target'] = (lambda: calls.append('target'), ['sharpe'])
+        self.loop.run_until_complete(AutoBroker.run_stages_async(
+            AutoBroker.journaled_stages(stages)))
+
+        self.assertEqual(calls, ['sharpe', 'target'])
+        self.assertEqual(
+            AutoBroker.portfolio.get('Sharpe (adjusted)', 'SPY'), 2.0)
+
+        # A finished run or other tickers start over
+        AutoBroker.checkpoint('done', True)
+        self.assertFalse(AutoBroker.start_journal({'SPY'}, self.path))
+        self.assertFalse(AutoBroker.start_journal({'QQQ'}, self.path))
+
+    def test_reconcile_orders(self):
+        AutoBroker.ib = FakeIB(quotes={'SPY': {'last': 100.0}})
+        AutoBroker.start_journal({'SPY', 'QQQ'}, self.path)
+
+        spy = Stock('SPY', 'SMART', 'USD')
+        qqq = Stock('QQQ', 'SMART', 'USD')
+        AutoBroker.place_order(spy, Order(action='SELL', orderType='MKT',
+                                          totalQuantity=60))
+        AutoBroker.place_order(qqq, Order(action='SELL', orderType='MKT',
+                                          totalQuantity=50))
+        AutoBroker.ib.placeOrder(qqq, Order(action='SELL', orderType='MKT',
+                                            totalQuantity=25))
+
+        orders = [(spy, Order(action='SELL', totalQuantity=100)),
+                  (qqq, Order(action='SELL', totalQuantity=50))]
+        trades = AutoBroker.reconcile_orders(orders, 'SELL')
+
+        self.assertEqual(len(trades), 2)
+        self.assertEqual([(c.symbol, o.totalQuantity) for c, o in orders],
+                         [('SPY', 40)])
+        self.assertEqual(
+            sorted(r['symbol'] for r in AutoBroker.journal_trades.values()),
+            ['QQQ', 'SPY'])
+
+    def test_trades_are_journaled_by_row(self):
+        AutoBroker.ib = FakeIB(quotes={'SPY': {'bid': 99.0, 'ask': 101.0}},
+                               fill_delay=None)
+        AutoBroker.start_journal({'SPY'}, self.path)
+        connection = AutoBroker.journal_connection
+
+        spy = Stock('SPY', 'SMART', 'USD')
+        trades = [AutoBroker.place_order(spy, Order(
+            action='BUY', orderType='MKT', totalQuantity=quantity))
+            for quantity in (10, 20)]
+        changes = connection.total_changes
+
+        # A status event without a change of state writes nothing, a
+        # fill only rewrites the row of its trade
+        trades[0].statusEvent.emit(trades[0])
+        self.assertEqual(connection.total_changes, changes)
+
+        AutoBroker.ib.try_fill(trades[0])
+        self.assertEqual(connection.total_changes, changes + 1)
+
+        AutoBroker.close_journal()
+        self.assertTrue(AutoBroker.start_journal({'SPY'}, self.path))
+        self.assertEqual(
+            sorted((r['quantity'], r['status'])
+                   for r in AutoBroker.journal_trades.values()),
+            [(10, 'Filled'), (20, 'Submitted')])
+
+
 class TestSharpe(unittest.TestCase):
     expected_results = get_expected_results()
     weekly_data = get_weekly_data(get_sample_data())
@@ -54,6 +1299,43 @@ class TestSharpe(unittest.TestCase):
                 msg=(f'{ticker} sharpe: {sharpe} expected: {expected} '
                      f'difference: {abs(sharpe - expected)}'))
 
+    def test_engine_matches_single(self):
+        weekly_change = self.weekly_data.pct_change()
+        windows = [52, 26, 13, 4]
+
+        ratios = AutoBroker.sharpe_engine(weekly_change, windows)
+
+        for ticker in weekly_change.columns:
+            for weeks in windows:
+                expected = AutoBroker.sharpe_single(
+                    weekly_change[ticker], weeks)
+
+                self.assertAlmostEqual(ratios.loc[ticker, weeks], expected,
+                                       msg=f'{ticker} over {weeks} weeks')
+
+    def test_rolling_matches_engine(self):
+        daily_data = get_sample_data().iloc[::-1]
+        windows = [52, 26, 13]
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'cache.db')
+            AutoBroker.sharpe_state = dict()
+
+            # Build state one week early, then push the newest week
+            AutoBroker.rolling_sharpes(
+                AutoBroker.weekly_sample(daily_data.iloc[:-5]), windows, path)
+            ratios = AutoBroker.rolling_sharpes(
+                self.weekly_data, windows, path)
+
+        expected = AutoBroker.sharpe_engine(
+            self.weekly_data.pct_change(), windows)
+
+        for ticker in expected.index:
+            for weeks in windows:
+                self.assertAlmostEqual(ratios.loc[ticker, weeks],
+                                       expected.loc[ticker, weeks],
+                                       msg=f'{ticker} over {weeks} weeks')
+
     def test_target_share(self):
         AutoBroker.settings = {'max_portfolio_size': 13}
         AutoBroker.historical_data = self.weekly_data
@@ -75,5 +1357,52 @@ class TestSharpe(unittest.TestCase):
                      f'difference: {abs(expected - share)}'))
 
 
+
+class TestBacktest(unittest.TestCase):
+    daily_data = backtest.load_prices('tests/resources/SampleData.csv')
+
+    def test_too_few_weeks(self):
+        # The sample year is all warm up for the 52 week sharpe window
+        with self.assertRaises(ValueError):
+            backtest.run_backtest(self.daily_data)
+
+    def test_sample_data(self):
+        with self.assertLogs(level='WARNING'):
+            result = backtest.run_backtest(self.daily_data, windows=[13, 4])
+
+        weeks = AutoBroker.weekly_sample(self.daily_data, 53).index
+        self.assertEqual(list(result.equity.index), list(weeks[13:]))
+        self.assertEqual(result.equity.iloc[0], 100000)
+        self.assertFalse(result.equity.isna().any())
+
+        holdings = result.holdings.to_numpy()
+        self.assertTrue((holdings >= 0).all())
+        self.assertTrue((holdings % 25 == 0).all())
+
+        stats = result.stats
+        self.assertAlmostEqual(
+            stats['total_return'],
+            result.equity.iloc[-1] / result.equity.iloc[0] - 1)
+        self.assertTrue(0 <= stats['max_drawdown'] < 1)
+        self.assertGreater(stats['orders'], 0)
+        for name in ['cagr', 'volatility', 'sharpe', 'turnover']:
+            self.assertTrue(math.isfinite(stats[name]), msg=name)
+
+    def test_sweep_skips_short_windows(self):
+        grid = {'max_portfolio_size': [13], 'round_quantities_to': [25],
+                'max_position_percent': [25], 'sharpe_floor': [0.2],
+                'sharpe_exponent': [1.5],
+                'sharpe_windows': [[52, 26, 13], [26, 13]]}
+
+        with self.assertLogs(level='WARNING'):
+            results = sweep.run_sweep(self.daily_data, grid, workers=1)
+
+        self.assertEqual(list(results['sharpe_windows']), ['26/13'])
+        self.assertTrue(math.isfinite(results['sharpe'][0]))
+
+        grid['sharpe_windows'] = [[52], [52, 13]]
+        with self.assertRaises(ValueError):
+            sweep.run_sweep(self.daily_data, grid, workers=1)
+
 if __name__ == '__main__':
     unittest.main()